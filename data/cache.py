@@ -0,0 +1,106 @@
+"""
+A small in-process cache with LRU eviction and per-entry expiry.
+We use it to keep read-mostly data from hitting the database on every
+request.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+HITS = 'hits'
+MISSES = 'misses'
+EVICTIONS = 'evictions'
+SIZE = 'size'
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries expire after a
+    time-to-live given when they are stored.
+    Entries can be tagged with a group so that a whole group can be
+    invalidated at once. `generation` counts invalidations: a reader
+    takes it before fetching a value and passes it to set(), so a value
+    fetched before an invalidation is not stored after it.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (expires_at, group, value)
+        self.groups = {}  # group -> set of keys
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+
+    def get(self, key, default=MISSING):
+        """
+        Return the live value for key, or default if absent or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, ttl: float, group=None, generation=None):
+        """
+        Store value under key for ttl seconds, evicting the least recently
+        used entries if we are over max_size.
+        If generation is given, value is only stored if nothing has been
+        invalidated since the cache was at that generation.
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, group, value)
+            self.groups.setdefault(group, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, group):
+        """
+        Drop every entry in group.
+        """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.groups.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                HITS: self.hits,
+                MISSES: self.misses,
+                EVICTIONS: self.evictions,
+                SIZE: len(self.entries),
+            }
+
+    def _remove(self, key):
+        """
+        Remove key; the caller must hold the lock.
+        """
+        _, group, _ = self.entries.pop(key)
+        keys = self.groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.groups[group]
@@ -1,9 +1,19 @@
+import base64
+import copy
+import hashlib
 import os
+from datetime import datetime, timezone
 from urllib.parse import quote_plus
 
+import gridfs
 import pymongo as pm
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 from dotenv import load_dotenv
-from pymongo.errors import ConnectionFailure
+from gridfs.errors import NoFile
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError  # noqa: F401
+
+from data.cache import MISSING, TTLCache
 
 load_dotenv()
 
@@ -16,6 +26,12 @@ MONGO_ID = '_id'
 
 WEMA_DB = 'wemaDB'
 
+# Read-through cache for read-mostly collections: set DB_CACHE_SIZE=0
+# to turn it off.
+read_cache = TTLCache(int(os.environ.get('DB_CACHE_SIZE', 1024)))
+cache_ttls = {}  # (db, collection) -> seconds; uncached if absent
+cache_private = {}  # (db, collection) -> fields never held in the cache
+
 
 def connect_db():
     """
@@ -67,70 +83,436 @@ def connect_db():
     return client
 
 
+def cache_collection(collection, ttl, db=WEMA_DB, private=()):
+    """
+    Cache reads of collection for up to ttl seconds.
+    Writes made through this module invalidate the cached reads at once;
+    the ttl bounds how stale we can be about writes made by other
+    processes. Reads that may return one of the `private` fields (like
+    password hashes) are not cached, so those never linger in memory.
+    """
+    cache_ttls[(db, collection)] = ttl
+    cache_private[(db, collection)] = frozenset(private)
+
+
+def cache_stats() -> dict:
+    """
+    Hit, miss and eviction counts of the read cache.
+    """
+    return read_cache.stats()
+
+
+def invalidate_cache(collection, db=WEMA_DB):
+    read_cache.invalidate((db, collection))
+
+
+def may_return(projection, fields) -> bool:
+    """
+    Whether a read with projection may return any of fields.
+    """
+    if not fields:
+        return False
+    if not projection:
+        return True
+    if any(val for fld, val in projection.items() if fld != MONGO_ID):
+        return any(projection.get(fld) for fld in fields)  # fields to include
+    return any(fld not in projection for fld in fields)  # fields to exclude
+
+
+def _cached_read(fetch, kind, collection, db, projection, *args):
+    """
+    Return fetch() through the read cache if collection is cached.
+    The key covers the kind of read, its projection and all its other
+    arguments (filter...). Callers get their own copy so they can
+    mutate it.
+    A value fetched while the collection was written to is returned but
+    not cached, since it may predate the write.
+    """
+    ttl = cache_ttls.get((db, collection))
+    if not ttl or may_return(projection, cache_private.get((db, collection))):
+        return fetch()
+    key = (db, collection, kind, json_util.dumps((projection, *args), sort_keys=True))
+    value = read_cache.get(key)
+    if value is MISSING:
+        generation = read_cache.generation
+        value = fetch()
+        read_cache.set(key, copy.deepcopy(value), ttl, group=(db, collection),
+                       generation=generation)
+        return value
+    return copy.deepcopy(value)
+
+
 def create(collection, doc, db=WEMA_DB):
     """
     Insert a single doc into collection.
     """
     print(f'Inserted {doc} into {collection} for DB: {db}')
-    return client[db][collection].insert_one(doc)
+    try:
+        return client[db][collection].insert_one(doc)
+    finally:
+        invalidate_cache(collection, db)
 
 
-def fetch_one(collection, filt, db=WEMA_DB):
+# bulk write result fields:
+INSERTED = 'inserted'
+MATCHED = 'matched'
+MODIFIED = 'modified'
+UPSERTED = 'upserted'
+ERRORS = 'errors'
+INDEX = 'index'
+CODE = 'code'
+MESSAGE = 'message'
+
+
+def _bulk_errors(err: BulkWriteError) -> list:
+    """
+    Per-item errors from a bulk write, indexed by position in the batch.
+    """
+    return [
+        {INDEX: write_err['index'], CODE: write_err.get('code'),
+         MESSAGE: write_err.get('errmsg')}
+        for write_err in err.details.get('writeErrors', [])
+    ]
+
+
+def bulk_create(collection, docs, ordered=True, db=WEMA_DB) -> dict:
+    """
+    Insert many docs into collection in one round trip.
+    With ordered=True, inserting stops at the first failure; otherwise
+    every doc is attempted.
+    Returns the insert count and per-item errors.
+    """
+    if not docs:
+        return {INSERTED: 0, ERRORS: []}
+    try:
+        result = client[db][collection].insert_many(docs, ordered=ordered)
+        return {INSERTED: len(result.inserted_ids), ERRORS: []}
+    except BulkWriteError as err:
+        return {INSERTED: err.details.get('nInserted', 0), ERRORS: _bulk_errors(err)}
+    finally:
+        invalidate_cache(collection, db)
+
+
+def bulk_write(collection, ops, ordered=True, db=WEMA_DB) -> dict:
+    """
+    Run a list of pymongo write operations (UpdateOne etc.) in one round trip.
+    Returns the counts and per-item errors.
+    """
+    if not ops:
+        return {INSERTED: 0, MATCHED: 0, MODIFIED: 0, UPSERTED: 0, ERRORS: []}
+    try:
+        result = client[db][collection].bulk_write(ops, ordered=ordered)
+        details, errors = result.bulk_api_result, []
+    except BulkWriteError as err:
+        details, errors = err.details, _bulk_errors(err)
+    finally:
+        invalidate_cache(collection, db)
+    return {
+        INSERTED: details.get('nInserted', 0),
+        MATCHED: details.get('nMatched', 0),
+        MODIFIED: details.get('nModified', 0),
+        UPSERTED: details.get('nUpserted', 0),
+        ERRORS: errors,
+    }
+
+
+def bulk_upsert(collection, docs, key, ordered=True, insert_only=(), db=WEMA_DB) -> dict:
+    """
+    Insert docs, or update the existing doc with the same `key`.
+    Fields not present in a doc are left alone on update, and so are the
+    fields named in insert_only: those are only written by an insert.
+    """
+    ops = []
+    for doc in docs:
+        update = {'$set': {fld: val for fld, val in doc.items() if fld not in insert_only}}
+        on_insert = {fld: doc[fld] for fld in insert_only if fld in doc}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        ops.append(pm.UpdateOne({key: doc[key]}, update, upsert=True))
+    return bulk_write(collection, ops, ordered=ordered, db=db)
+
+
+def bulk_update(collection, updates, ordered=True, db=WEMA_DB) -> dict:
+    """
+    Apply many (filter, update_dict) pairs, each like update_doc(),
+    in one round trip.
+    """
+    ops = [pm.UpdateOne(filt, {'$set': update_dict})
+           for filt, update_dict in updates]
+    return bulk_write(collection, ops, ordered=ordered, db=db)
+
+
+def prepare_bulk(items, prepare, ordered=True) -> tuple:
+    """
+    Turn the raw items of a bulk request into docs with prepare(item),
+    which should raise ValueError for an invalid item.
+    Returns (docs, positions, errors): positions[i] is the index in items
+    of docs[i], and errors are the per-item validation errors.
+    In ordered mode we stop at the first invalid item.
+    """
+    docs, positions, errors = [], [], []
+    for i, item in enumerate(items):
+        try:
+            doc = prepare(item)
+        except (ValueError, KeyError, TypeError) as e:
+            errors.append({INDEX: i, CODE: None, MESSAGE: str(e)})
+            if ordered:
+                break
+            continue
+        docs.append(doc)
+        positions.append(i)
+    return docs, positions, errors
+
+
+def merge_bulk_errors(result: dict, positions: list, errors: list) -> dict:
+    """
+    Map the errors of a bulk write over prepare_bulk() docs back to the
+    original item indices, and merge in the validation errors.
+    """
+    db_errors = [{**err, INDEX: positions[err[INDEX]]} for err in result[ERRORS]]
+    result[ERRORS] = sorted(db_errors + errors, key=lambda err: err[INDEX])
+    return result
+
+
+def succeeded(count: int, errors: list, ordered=True) -> list:
+    """
+    The indices, out of `count` items, of those a bulk write applied.
+    """
+    failed = {err[INDEX] for err in errors}
+    if ordered and failed:
+        count = min(failed)
+    return [i for i in range(count) if i not in failed]
+
+
+def fetch_one(collection, filt, db=WEMA_DB, projection=None, cached=True):
     """
     Find with a filter and return on the first doc found.
+    `projection` limits which fields are returned; cached=False skips
+    the read cache.
     Return None if not found.
     """
-    doc = client[db][collection].find_one(filt)
-    print(f"Fetched document: {doc}")  # Debug
-
+    def fetch():
+        return client[db][collection].find_one(filt, projection)
+    doc = _cached_read(fetch, 'one', collection, db, projection, filt) if cached else fetch()
     if doc and MONGO_ID in doc:
-        print(f"Converting {MONGO_ID}: {doc[MONGO_ID]}, type: {type(doc[MONGO_ID])}")  # Debug
         doc[MONGO_ID] = str(doc[MONGO_ID])
-        print(f"After conversion: {doc}")  # Debug
     return doc
 
 
+def create_index(collection, keys, unique=False, db=WEMA_DB, **options):
+    """
+    Create (or verify) an index on collection.
+    `keys` is either a single field name or a list of (field, direction)
+    pairs; other options (e.g. expireAfterSeconds) are passed to Mongo.
+    Mongo treats re-creating an identical index as a no-op, so this
+    is safe to call on every startup.
+    Returns the index name.
+    """
+    return client[db][collection].create_index(keys, unique=unique, **options)
+
+
 def delete(collection: str, filt: dict, db=WEMA_DB):
     """
     Find with a filter and return on the first doc found.
     """
     print(f'{filt=}')
-    result = client[db][collection].delete_one(filt)
+    try:
+        result = client[db][collection].delete_one(filt)
+    finally:
+        invalidate_cache(collection, db)
     return result.deleted_count
 
 
 def update_doc(collection, filters, update_dict, db=WEMA_DB):
-    return client[db][collection].update_one(filters, {'$set': update_dict})
+    try:
+        return client[db][collection].update_one(filters, {'$set': update_dict})
+    finally:
+        invalidate_cache(collection, db)
 
 
-def read(collection, db=WEMA_DB, no_id=True) -> list:
+DEFAULT_BATCH_SIZE = 100
+
+
+def fetch_one_and_update(collection, filt, update, db=WEMA_DB, projection=None,
+                         return_before=False, upsert=False):
+    """
+    Atomically apply `update` (a full update document or pipeline, e.g.
+    {'$addToSet': ...}) to the first doc matching filt, and return that doc
+    as it is after the update (or before it, with return_before).
+    With upsert, a doc is created if none matches.
+    Return None if nothing matched.
+    """
+    return_doc = pm.ReturnDocument.BEFORE if return_before else pm.ReturnDocument.AFTER
+    try:
+        doc = client[db][collection].find_one_and_update(
+            filt, update, projection=projection, return_document=return_doc,
+            upsert=upsert)
+    finally:
+        invalidate_cache(collection, db)
+    if doc and MONGO_ID in doc:
+        doc[MONGO_ID] = str(doc[MONGO_ID])
+    return doc
+
+
+def read_iter(collection, db=WEMA_DB, no_id=True, filt=None, projection=None,
+              sort=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Lazily yield docs from the db.
+    Only one cursor batch (`batch_size` docs) is held in memory at a time.
+    `sort` is a list of (field, direction) pairs.
+    """
+    cursor = client[db][collection].find(filt or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    cursor = cursor.batch_size(batch_size)
+    try:
+        for doc in cursor:
+            if no_id:
+                doc.pop(MONGO_ID, None)
+            elif MONGO_ID in doc:
+                doc[MONGO_ID] = str(doc[MONGO_ID])
+            yield doc
+    finally:
+        cursor.close()
+
+
+def read(collection, db=WEMA_DB, no_id=True, projection=None, filt=None,
+         sort=None) -> list:
     """
     This will return a list from the db.
+    `projection` limits which fields are returned, and `filt` which docs.
+    `sort` is a list of (field, direction) pairs.
+    """
+    return _cached_read(
+        lambda: list(read_iter(collection, db=db, no_id=no_id, filt=filt,
+                               projection=projection, sort=sort)),
+        'read', collection, db, projection, no_id, filt, sort,
+    )
+
+
+def read_dict(collection, key, db=WEMA_DB, no_id=True, projection=None) -> dict:
+    def fetch():
+        recs_as_dict = {}
+        for rec in read_iter(collection, db=db, no_id=no_id, projection=projection):
+            recs_as_dict[rec[key]] = rec
+        return recs_as_dict
+    return _cached_read(fetch, 'dict', collection, db, projection, key, no_id)
+
+
+def fetch_all_as_dict(key, collection, db=WEMA_DB, projection=None):
+    return read_dict(collection, key, db=db, projection=projection)
+
+
+def parse_date(value) -> datetime:
+    """
+    Dates are stored as (UTC) BSON datetimes, which the db returns naive.
+    This turns an ISO date or date-time string into one. Datetimes with a
+    timezone are converted to UTC.
+    Raises ValueError if value isn't a date.
+    """
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Bad date: {value}')
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+DEFAULT_PAGE_SIZE = 20
+
+PAGE_KEY = 'k'
+PAGE_ID = 'id'
+
+
+def encode_page_token(last_key, last_id) -> str:
+    """
+    Build the opaque `next` token for a page ending at the given sort key
+    value and _id.
+    """
+    raw = json_util.dumps({PAGE_KEY: last_key, PAGE_ID: last_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_page_token(token: str) -> tuple:
+    """
+    Inverse of encode_page_token(): returns (last_key, last_id).
+    """
+    try:
+        rec = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        return rec[PAGE_KEY], rec[PAGE_ID]
+    except Exception:
+        raise ValueError(f'Invalid page token: {token}')
+
+
+def _after_filter(sort_key, last_key, last_id, descending) -> dict:
+    """
+    The filter selecting docs strictly after (last_key, last_id) in
+    (sort_key, _id) order.
+    Missing/null sort keys sort first, and can't be compared with
+    $gt/$lt, so they get special treatment.
+    """
+    cmp = '$lt' if descending else '$gt'
+    if sort_key == MONGO_ID:
+        return {MONGO_ID: {cmp: last_id}}
+    same_key = {sort_key: last_key, MONGO_ID: {cmp: last_id}}
+    if last_key is None:
+        if descending:
+            return same_key
+        return {'$or': [{sort_key: {'$ne': None}}, same_key]}
+    after_key = {sort_key: {cmp: last_key}}
+    if descending:
+        after_key = {'$or': [after_key, {sort_key: None}]}
+    return {'$or': [after_key, same_key]}
+
+
+def read_page(collection, limit=DEFAULT_PAGE_SIZE, after=None,
+              sort_key=MONGO_ID, descending=False, db=WEMA_DB, no_id=True,
+              filt=None, projection=None) -> tuple:
+    """
+    Keyset pagination: return (docs, next_token) for one page of at most
+    `limit` docs ordered by (sort_key, _id).
+    Pass the returned token back as `after` to get the next page;
+    next_token is None on the last page.
+    The cost of a page does not depend on how deep into the collection it
+    is, as long as (sort_key, _id) is indexed.
     """
-    ret = []
-    for doc in client[db][collection].find():
+    direction = pm.DESCENDING if descending else pm.ASCENDING
+    if sort_key == MONGO_ID:
+        sort = [(MONGO_ID, direction)]
+    else:
+        sort = [(sort_key, direction), (MONGO_ID, direction)]
+        if projection and any(projection.values()):
+            # we need the sort key to build the next token
+            projection = {**projection, sort_key: 1}
+
+    filt = filt or {}
+    if after:
+        last_key, last_id = decode_page_token(after)
+        after_filt = _after_filter(sort_key, last_key, last_id, descending)
+        filt = {'$and': [filt, after_filt]} if filt else after_filt
+
+    cursor = client[db][collection].find(filt, projection).sort(sort).limit(limit + 1)
+    docs = list(cursor)
+    next_token = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_token = encode_page_token(last.get(sort_key), last[MONGO_ID])
+    for doc in docs:
         if no_id:
-            del doc[MONGO_ID]
+            doc.pop(MONGO_ID, None)
         else:
             doc[MONGO_ID] = str(doc[MONGO_ID])
-        ret.append(doc)
-    return ret
+    return docs, next_token
 
 
-def read_dict(collection, key, db=WEMA_DB, no_id=True) -> dict:
-    recs = read(collection, db=db, no_id=no_id)
-    recs_as_dict = {}
-    for rec in recs:
-        recs_as_dict[rec[key]] = rec
-    return recs_as_dict
-
-
-def fetch_all_as_dict(key, collection, db=WEMA_DB):
-    ret = {}
-    for doc in client[db][collection].find():
-        del doc[MONGO_ID]
-        ret[doc[key]] = doc
-    return ret
+def aggregate(collection, pipeline, db=WEMA_DB) -> list:
+    """
+    Run an aggregation pipeline on the server and return the results.
+    """
+    return list(client[db][collection].aggregate(pipeline))
 
 
 def count_documents(collection, filt={}, db=WEMA_DB):
@@ -146,9 +528,136 @@ def delete_many(collection, filt, db=WEMA_DB):
     Delete multiple documents in the collection that match the filter.
     Returns the count of deleted documents.
     """
-    result = client[db][collection].delete_many(filt)
+    try:
+        result = client[db][collection].delete_many(filt)
+    finally:
+        invalidate_cache(collection, db)
     return result.deleted_count
 
 
+# Large blobs (manuscript bodies, attachments) live in GridFS, which
+# splits them into chunks so they are never held in memory whole.
+FILES_BUCKET = 'files'
+FILE_CHUNK_SIZE = 255 * 1024
+SHA256 = 'sha256'
+FILE_SHA256 = f'metadata.{SHA256}'
+# How many references (e.g. attachments) a stored file has.
+REFS = 'refs'
+FILE_REFS = f'metadata.{REFS}'
+FILE_ID = 'file_id'
+LENGTH = 'length'
+FILENAME = 'filename'
+CONTENT_TYPE = 'content_type'
+
+
+def get_bucket(db=WEMA_DB, bucket=FILES_BUCKET):
+    return gridfs.GridFSBucket(client[db], bucket_name=bucket,
+                               chunk_size_bytes=FILE_CHUNK_SIZE)
+
+
+def ensure_file_indexes(db=WEMA_DB, bucket=FILES_BUCKET):
+    """
+    Index file hashes so put_file() can find duplicates without a scan.
+    """
+    return create_index(f'{bucket}.files', FILE_SHA256, db=db)
+
+
+class _HashingReader:
+    """
+    Wrap a readable stream, hashing and counting what is read through it.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+        self.length = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        self.length += len(data)
+        return data
+
+
+def put_file(stream, filename, content_type=None, db=WEMA_DB,
+             bucket=FILES_BUCKET) -> dict:
+    """
+    Stream a file into GridFS one chunk at a time.
+    Files are deduplicated by their SHA-256: if an identical file is
+    already stored, the new copy is dropped and the old one is returned.
+    (We can only know the hash once the whole stream has been read.)
+    Either way the caller gets a reference to the file, to be dropped
+    with release_file() when it no longer uses it.
+    Returns {file_id, sha256, length, filename, content_type}.
+    """
+    grid = get_bucket(db, bucket)
+    reader = _HashingReader(stream)
+    file_id = grid.upload_from_stream(filename, reader,
+                                      metadata={CONTENT_TYPE: content_type})
+    digest = reader.hash.hexdigest()
+    files = client[db][f'{bucket}.files']
+    # Taking the reference is what makes the existing file ours to share:
+    # one whose last reference is being released no longer matches.
+    existing = files.find_one_and_update(
+        {FILE_SHA256: digest, MONGO_ID: {'$ne': file_id}, FILE_REFS: {'$gt': 0}},
+        {'$inc': {FILE_REFS: 1}}, {MONGO_ID: 1})
+    if existing:
+        grid.delete(file_id)
+        file_id = existing[MONGO_ID]
+    else:
+        files.update_one({MONGO_ID: file_id}, {'$set': {FILE_SHA256: digest, FILE_REFS: 1}})
+    return {
+        FILE_ID: str(file_id),
+        SHA256: digest,
+        LENGTH: reader.length,
+        FILENAME: filename,
+        CONTENT_TYPE: content_type,
+    }
+
+
+def release_file(file_id, db=WEMA_DB, bucket=FILES_BUCKET):
+    """
+    Drop a reference to a stored file, deleting it once none are left.
+    Returns whether it was deleted, or None if the file doesn't count
+    its references (it was stored before they were counted) and the
+    caller has to decide.
+    """
+    try:
+        object_id = ObjectId(file_id)
+    except InvalidId:
+        return None
+    doc = client[db][f'{bucket}.files'].find_one_and_update(
+        {MONGO_ID: object_id, FILE_REFS: {'$exists': True}},
+        {'$inc': {FILE_REFS: -1}}, {'metadata': 1},
+        return_document=pm.ReturnDocument.AFTER)
+    if doc is None:
+        return None
+    if doc['metadata'][REFS] > 0:
+        return False
+    return delete_file(file_id, db, bucket)
+
+
+def open_file(file_id, db=WEMA_DB, bucket=FILES_BUCKET):
+    """
+    Open a stored file for reading; the result is seekable and knows its
+    `length`. Return None if there is no such file.
+    """
+    try:
+        return get_bucket(db, bucket).open_download_stream(ObjectId(file_id))
+    except (InvalidId, NoFile):
+        return None
+
+
+def delete_file(file_id, db=WEMA_DB, bucket=FILES_BUCKET) -> bool:
+    """
+    Delete a stored file and its chunks. Return False if it was not there.
+    """
+    try:
+        get_bucket(db, bucket).delete(ObjectId(file_id))
+    except (InvalidId, NoFile):
+        return False
+    return True
+
+
 if __name__ == '__main__':
     connect_db()
@@ -0,0 +1,97 @@
+"""
+An append-only log of manuscript state changes.
+Each event records one manuscript moving from one state to another:
+which action did it, who did it, and when. Events are only ever
+inserted, so the log can be read incrementally by _id.
+
+An event's _id is made by the process that records it, before the
+insert, and only orders events to the second (ties depend on the
+process). An event can therefore be inserted after one with a later
+_id has been read. Reads that resume after an event start again
+RESUME_OVERLAP earlier, so they may repeat events the reader already
+has; readers drop those by _id.
+"""
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+import data.db_connect as dbc
+import data.manuscripts.fields as flds
+
+EVENTS_COLLECT = 'manuscript_events'
+
+MANU_ID = 'manu_id'
+FROM_STATE = 'from'
+TO_STATE = 'to'
+ACTION = flds.ACTION
+ACTOR = 'actor'
+AT = 'at'
+
+# How far back before the last event a resumed read starts again: the
+# clock skew between processes plus the time from making an _id to
+# inserting it.
+RESUME_OVERLAP = timedelta(seconds=60)
+
+CREATE = 'create'  # the action logged when a manuscript is created
+UPDATE = 'update'  # ... and when its state is set directly
+
+
+def ensure_indexes():
+    """
+    A manuscript's history is read by (manu_id, _id); the feed of all
+    events uses the _id index.
+    """
+    dbc.create_index(EVENTS_COLLECT, [(MANU_ID, 1), (dbc.MONGO_ID, 1)])
+
+
+def build_event(manu_id: str, from_state: str, to_state: str, action: str,
+                actor: str = None, at: datetime = None) -> dict:
+    return {
+        MANU_ID: str(manu_id),
+        FROM_STATE: from_state,
+        TO_STATE: to_state,
+        ACTION: action,
+        ACTOR: actor,
+        AT: at or datetime.now(timezone.utc),
+    }
+
+
+def record(events: list):
+    """
+    Append events to the log in one round trip.
+    """
+    if not events:
+        return
+    try:
+        dbc.bulk_create(EVENTS_COLLECT, events, ordered=False)
+    except Exception as e:
+        # The change itself already happened; don't fail it over the log.
+        print(f'Error logging manuscript events: {e}')
+
+
+def since_filter(since: datetime) -> dict:
+    """
+    Events recorded at or after since. An event's _id holds when it was
+    made, so this is a range on the _id index.
+    """
+    return {dbc.MONGO_ID: {'$gte': ObjectId.from_datetime(since)}}
+
+
+def after_filter(event_id: str) -> dict:
+    """
+    Events other than the one with event_id, from RESUME_OVERLAP before
+    it on: any recorded after it, and some the reader may already have.
+    """
+    try:
+        last_id = ObjectId(event_id)
+    except Exception:
+        raise ValueError(f'Invalid event id: {event_id}')
+    start = ObjectId.from_datetime(last_id.generation_time - RESUME_OVERLAP)
+    return {dbc.MONGO_ID: {'$gte': start, '$ne': last_id}}
+
+
+def read_page(filt: dict, limit: int, after: str = None) -> tuple:
+    """
+    A page of events matching filt, oldest first: (events, next_token).
+    """
+    return dbc.read_page(EVENTS_COLLECT, limit=limit, after=after, no_id=False, filt=filt)
@@ -4,7 +4,13 @@ DISPLAY_NAME = 'display_name'
 REFEREES = 'ref'
 ABSTRACT = 'abstract'
 CONTENT = 'content'
+CONTENT_FILE = 'content_file'
+ATTACHMENTS = 'attachments'
 SUBMISSION_DATE = 'submission_date'
+STATE_SINCE = 'state_since'
+PREV_STATE = 'prev_state'
+PREV_STATE_SINCE = 'prev_state_since'
+RECENT_ACTIONS = 'recent_actions'  # the last few batch actions applied, so each can be confirmed
 
 #FSM 
 STATE = 'state'
@@ -1,7 +1,19 @@
 import data.db_connect as dbc
 import data.manuscripts.fields as flds
+import data.manuscripts.events as events
+import data.manuscripts.role_permissions as role_perms
+import data.manuscripts.search as search
+import data.manuscripts.stats as stats
 from data.manuscripts.fields import STATE
-from bson import ObjectId
+from data.roles import ALL_ROLES_MASK, role_mask
+import io
+import os
+import threading
+import time
+import zlib
+import pymongo as pm
+from bson import Binary, ObjectId
+from datetime import datetime, timedelta, timezone
 
 # states:
 COPY_EDIT = 'CED'
@@ -69,36 +81,205 @@ VALID_ACTIONS = [
 # Collection name for manuscripts
 MANUSCRIPT_COLLECT = 'manuscript'
 
+# Fields returned when listing manuscripts in summary mode.
+SUMMARY_FIELDS = [
+    flds.TITLE,
+    flds.AUTHOR,
+    STATE,
+    flds.SUBMISSION_DATE,
+    flds.REFEREES,
+]
+SUMMARY_PROJECTION = {fld: 1 for fld in SUMMARY_FIELDS}
+
+# Large text fields are stored compressed, as {CODEC: ..., DATA: ...}.
+# CODEC names the (versioned) format so we can change it later and still
+# read old manuscripts.
+COMPRESSED_FIELDS = [flds.ABSTRACT, flds.CONTENT]
+COMPRESS_THRESHOLD = 4096  # bytes of UTF-8; smaller texts are stored as is
+# Bodies larger than this (bytes of UTF-8) are kept in file storage, in
+# chunks, rather than in the manuscript, whose size is limited.
+CONTENT_FILE_THRESHOLD = 1 << 20
+COMPRESS_LEVEL = 6
+CODEC = 'codec'
+DATA = 'data'
+ZLIB_V1 = 'zlib-1'
+
+# Keys manuscripts can be sorted and paged by; each has an index on
+# (key, _id).
+PAGE_SORT_KEYS = [dbc.MONGO_ID, flds.SUBMISSION_DATE]
+
+# Fields manuscripts can be filtered on by equality. Each leads a compound
+# index ending in (submission_date, _id), so a filtered listing sorted by
+# date is a single index scan. The referee index also has the state, for
+# "everything in state X assigned to referee Y".
+FILTER_FIELDS = [STATE, flds.AUTHOR, flds.REFEREES]
+FILTER_INDEXES = [
+    [(STATE, 1), (flds.SUBMISSION_DATE, 1), (dbc.MONGO_ID, 1)],
+    [(flds.AUTHOR, 1), (flds.SUBMISSION_DATE, 1), (dbc.MONGO_ID, 1)],
+    [(flds.REFEREES, 1), (STATE, 1), (flds.SUBMISSION_DATE, 1), (dbc.MONGO_ID, 1)],
+]
 
-def assign_ref(manu: dict, ref: str, extra=None) -> str:
+client = dbc.connect_db()
+
+
+def ensure_indexes():
     """
-    Assign a referee to a manuscript and update in database.
-    
-    :param manu: manuscript id
-    :param ref: the name of the referee
-    :param extra: extra fields to assign
+    Create (or verify) the indexes the manuscript queries rely on.
     """
-    if ref not in manu.get(flds.REFEREES, []):
-        if flds.REFEREES in manu:
-            manu[flds.REFEREES].append(ref)
-        else:
-            manu[flds.REFEREES] = [ref]
-        update_manuscript(manu["_id"], {flds.REFEREES: manu[flds.REFEREES]})
-    return IN_REF_REVIEW
+    try:
+        dbc.create_index(MANUSCRIPT_COLLECT,
+                         [(flds.SUBMISSION_DATE, 1), (dbc.MONGO_ID, 1)])
+        for keys in FILTER_INDEXES:
+            dbc.create_index(MANUSCRIPT_COLLECT, keys)
+        events.ensure_indexes()
+        dbc.create_index(SEARCH_CHANGES_COLLECT, CHANGED_AT,
+                         expireAfterSeconds=SEARCH_CHANGES_TTL_SECS)
+        dbc.ensure_file_indexes()
+    except Exception as e:
+        print(f"Error creating manuscript indexes: {e}")
 
 
-def delete_ref(manu: dict, ref: str) -> str:
+if client:
+    ensure_indexes()
+
+
+def compress_text(text):
     """
-    Remove a referee from a manuscript and update in database.
+    Compress a large string for storage; other values are returned as is.
+    The output is deterministic, so equal texts compress to equal values.
     """
-    if ref in manu[flds.REFEREES]:
-        manu[flds.REFEREES].remove(ref)
-        update_manuscript(manu["_id"], {flds.REFEREES: manu[flds.REFEREES]})
+    if not isinstance(text, str):
+        return text
+    raw = text.encode('utf-8')
+    if len(raw) < COMPRESS_THRESHOLD:
+        return text
+    return {CODEC: ZLIB_V1, DATA: Binary(zlib.compress(raw, COMPRESS_LEVEL))}
+
+
+def decompress_text(value):
+    """
+    Inverse of compress_text().
+    """
+    if not isinstance(value, dict) or CODEC not in value:
+        return value
+    if value[CODEC] == ZLIB_V1:
+        return zlib.decompress(bytes(value[DATA])).decode('utf-8')
+    raise ValueError(f'Unknown text codec: {value[CODEC]}')
+
+
+def compress_manuscript(manu: dict) -> dict:
+    """
+    A copy of manu with its large text fields compressed, for storage.
+    """
+    return {fld: compress_text(val) if fld in COMPRESSED_FIELDS else val
+            for fld, val in manu.items()}
+
+
+def decompress_manuscript(manu: dict) -> dict:
+    """
+    Decompress the text fields of a stored manuscript, in place.
+    Only fields that were actually fetched get decompressed, so reads that
+    project them away (like summary listings) never pay for it.
+    """
+    if manu:
+        for fld in COMPRESSED_FIELDS:
+            if fld in manu:
+                manu[fld] = decompress_text(manu[fld])
+    return manu
+
+
+class ManuscriptNotFound(ValueError):
+    """
+    Raised when the manuscript an operation targets does not exist.
+    """
+
+
+class AttachmentNotFound(ValueError):
+    pass
+
+
+class StateConflict(ValueError):
+    """
+    Raised when a manuscript is not in the state an action expected,
+    typically because another editor moved it first.
+    """
+
+
+def to_object_id(manu_id: str) -> ObjectId:
+    try:
+        return ObjectId(manu_id)
+    except Exception:
+        raise ValueError(f'Invalid MongoDB ObjectId: {manu_id}')
+
+
+def add_referee(manu_id: str, ref: str) -> list:
+    """
+    Atomically add a referee to a manuscript (if not already there).
+    Returns the manuscript's referees after the update, in one round trip.
+    """
+    doc = dbc.fetch_one_and_update(MANUSCRIPT_COLLECT,
+                                   {"_id": to_object_id(manu_id)},
+                                   {'$addToSet': {flds.REFEREES: ref}},
+                                   projection={flds.REFEREES: 1})
+    if not doc:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    return doc[flds.REFEREES]
+
+
+def remove_referee(manu_id: str, ref: str) -> list:
+    """
+    Atomically remove a referee from a manuscript.
+    Returns the manuscript's referees after the update, in one round trip.
+    """
+    doc = dbc.fetch_one_and_update(MANUSCRIPT_COLLECT,
+                                   {"_id": to_object_id(manu_id)},
+                                   {'$pull': {flds.REFEREES: ref}},
+                                   projection={flds.REFEREES: 1})
+    if not doc:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    return doc.get(flds.REFEREES, [])
 
-    if len(manu[flds.REFEREES]) > 0:
-        return IN_REF_REVIEW
-    else:
-        return SUBMITTED
+
+def referees_expr() -> dict:
+    """
+    Aggregation expression for a manuscript's referees (none if missing).
+    """
+    return {'$ifNull': [f'${flds.REFEREES}', []]}
+
+
+def assign_ref_update(ref: str = None, **kwargs) -> list:
+    """
+    The update pipeline for ASSIGN_REF: add the referee (once) and move
+    the manuscript into referee review.
+    """
+    if not ref:
+        raise ValueError('A referee is required')
+    refs = referees_expr()
+    return [{'$set': {
+        flds.REFEREES: {'$cond': [{'$in': [ref, refs]}, refs,
+                                  {'$concatArrays': [refs, [ref]]}]},
+        STATE: IN_REF_REVIEW,
+    }}]
+
+
+def delete_ref_update(ref: str = None, **kwargs) -> list:
+    """
+    The update pipeline for DELETE_REF: remove the referee, and go back
+    to SUBMITTED if that was the last one.
+    """
+    if not ref:
+        raise ValueError('A referee is required')
+    return [
+        {'$set': {flds.REFEREES: {'$filter': {
+            'input': referees_expr(),
+            'cond': {'$ne': ['$$this', ref]},
+        }}}},
+        {'$set': {STATE: {'$cond': [
+            {'$gt': [{'$size': f'${flds.REFEREES}'}, 0]},
+            IN_REF_REVIEW,
+            SUBMITTED,
+        ]}}},
+    ]
 
 
 def get_actions() -> list:
@@ -110,6 +291,10 @@ def is_valid_action(action: str) -> bool:
 
 
 FUNC = 'f'
+# Builds the database update for actions whose new state depends on the
+# stored manuscript; other actions just $set the state FUNC returns.
+# A transition has one or the other.
+UPDATE = 'u'
 
 
 COMMON_ACTIONS = {
@@ -122,7 +307,7 @@ COMMON_ACTIONS = {
 STATE_TABLE = {
     SUBMITTED: {
         ASSIGN_REF: {
-            FUNC: assign_ref,
+            UPDATE: assign_ref_update,
         },
         REJECT: {
             FUNC: lambda **kwargs: REJECTED,
@@ -131,10 +316,10 @@ STATE_TABLE = {
     },
     IN_REF_REVIEW: {
         ASSIGN_REF: {
-            FUNC: assign_ref,
+            UPDATE: assign_ref_update,
         },
         DELETE_REF: {
-            FUNC: delete_ref,
+            UPDATE: delete_ref_update,
         },
         ACCEPT: {
             FUNC: lambda **kwargs: COPY_EDIT,
@@ -192,6 +377,30 @@ def get_valid_actions_by_state(state: str):
     return valid_actions
 
 
+def compile_valid_actions() -> dict:
+    """
+    The actions each set of roles may take in each state, for every
+    possible role mask: {(state, mask): tuple of actions}.
+    """
+    return {(state, mask): tuple(action for action in actions
+                                 if role_perms.can_perform_action(state, action, mask))
+            for state, actions in STATE_TABLE.items()
+            for mask in range(ALL_ROLES_MASK + 1)}
+
+
+VALID_ACTIONS_BY_MASK = compile_valid_actions()
+
+
+def get_valid_actions(state: str, user_roles) -> tuple:
+    """
+    The actions a user with user_roles (a list, or its role_mask()) may
+    take on a manuscript in state.
+    """
+    if not isinstance(user_roles, int):
+        user_roles = role_mask(user_roles)
+    return VALID_ACTIONS_BY_MASK.get((state, user_roles), ())
+
+
 def get_manuscript(manu_id: str) -> dict:
     """
     Retrieve a specific manuscript by MongoDB _id.
@@ -202,28 +411,145 @@ def get_manuscript(manu_id: str) -> dict:
         raise ValueError(f'Invalid MongoDB ObjectId: {manu_id}')
 
     manuscript = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": object_id})
-    return manuscript
+    return from_storage(manuscript)
 
 
-def get_all_manuscripts() -> list:
+def get_projection(summary: bool = False):
     """
-    Retrieve all manuscripts from the database.
+    The projection to list manuscripts with: summary mode leaves out
+    the (potentially huge) abstract and content.
     """
-    return dbc.read(MANUSCRIPT_COLLECT, no_id=False)
+    return SUMMARY_PROJECTION if summary else None
 
 
-def create_manuscript(
+def format_date(value):
+    """
+    The ISO string the API shows a stored submission date as.
+    Strings not migrated yet are shown the same way if we can parse them.
+    """
+    try:
+        date = dbc.parse_date(value)
+    except ValueError:
+        return value
+    return date.replace(tzinfo=timezone.utc).isoformat(timespec='seconds')
+
+
+DATE_FIELDS = [flds.SUBMISSION_DATE, flds.STATE_SINCE, flds.PREV_STATE_SINCE]
+
+
+def from_storage(manu: dict) -> dict:
+    """
+    Turn a stored manuscript into what the API returns, in place:
+    decompress its text, show its dates as ISO strings and drop our
+    own bookkeeping.
+    """
+    if manu:
+        manu.pop(flds.RECENT_ACTIONS, None)
+        for fld in DATE_FIELDS:
+            if manu.get(fld) is not None:
+                manu[fld] = format_date(manu[fld])
+    return decompress_manuscript(manu)
+
+
+def build_filter(state: str = None, author: str = None, ref: str = None,
+                 since: str = None, until: str = None) -> dict:
+    """
+    The filter for listing manuscripts: in a state, by an author, assigned
+    to a referee, and/or submitted in [since, until).
+    """
+    filt = {}
+    if state:
+        if not is_valid_state(state):
+            raise ValueError(f'Bad state: {state}')
+        filt[STATE] = state
+    if author:
+        filt[flds.AUTHOR] = author
+    if ref:
+        filt[flds.REFEREES] = ref
+    date_range = {}
+    if since:
+        date_range['$gte'] = dbc.parse_date(since)
+    if until:
+        date_range['$lt'] = dbc.parse_date(until)
+    if date_range:
+        filt[flds.SUBMISSION_DATE] = date_range
+    return filt
+
+
+def get_sort(sort_key: str = None, descending: bool = False) -> list:
+    """
+    The sort for listing manuscripts: by sort_key (unsorted if not given),
+    ties broken by _id.
+    """
+    if not sort_key:
+        return None
+    if sort_key not in PAGE_SORT_KEYS:
+        raise ValueError(f'Cannot sort manuscripts by: {sort_key}')
+    direction = pm.DESCENDING if descending else pm.ASCENDING
+    if sort_key == dbc.MONGO_ID:
+        return [(dbc.MONGO_ID, direction)]
+    return [(sort_key, direction), (dbc.MONGO_ID, direction)]
+
+
+def get_all_manuscripts(summary: bool = False, filt: dict = None,
+                        sort_key: str = None, descending: bool = False) -> list:
+    """
+    Retrieve all manuscripts (matching filt) from the database.
+    """
+    manuscripts = dbc.read(MANUSCRIPT_COLLECT, no_id=False,
+                           projection=get_projection(summary), filt=filt,
+                           sort=get_sort(sort_key, descending))
+    return [from_storage(manu) for manu in manuscripts]
+
+
+def stream_manuscripts(batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+                       summary: bool = False, filt: dict = None,
+                       sort_key: str = None, descending: bool = False):
+    """
+    Lazily yield manuscripts (matching filt) from the database, one cursor
+    batch at a time.
+    """
+    manuscripts = dbc.read_iter(MANUSCRIPT_COLLECT, no_id=False,
+                                projection=get_projection(summary), filt=filt,
+                                sort=get_sort(sort_key, descending),
+                                batch_size=batch_size)
+    return (from_storage(manu) for manu in manuscripts)
+
+
+def get_manuscripts_page(limit: int = dbc.DEFAULT_PAGE_SIZE, after: str = None,
+                         sort_key: str = None, descending: bool = False,
+                         summary: bool = False, filt: dict = None) -> tuple:
+    """
+    Retrieve one page of manuscripts (matching filt), keyset-paginated on
+    sort_key (_id if not given).
+    Returns (manuscripts, next_token).
+    """
+    sort_key = sort_key or dbc.MONGO_ID
+    if sort_key not in PAGE_SORT_KEYS:
+        raise ValueError(f'Cannot sort manuscripts by: {sort_key}')
+    manuscripts, next_token = dbc.read_page(
+        MANUSCRIPT_COLLECT, limit=limit, after=after, sort_key=sort_key,
+        descending=descending, no_id=False, filt=filt,
+        projection=get_projection(summary))
+    return [from_storage(manu) for manu in manuscripts], next_token
+
+
+def build_manuscript(
     title: str,
     author: str,
     abstract: str,
     content: str,
-    submission_date: str = None,
+    submission_date=None,
     state: str = SUBMITTED,
 ) -> dict:
     """
-    Create a new manuscript entry in the database.
+    Build the document to store for a new manuscript.
+    submission_date is a datetime or ISO string, and defaults to now.
     """
-    new_manuscript = {
+    if submission_date is None:
+        submission_date = datetime.now(timezone.utc)
+    submission_date = dbc.parse_date(submission_date)
+    return {
         "_id": ObjectId(),
         flds.TITLE: title,
         flds.AUTHOR: author,
@@ -231,22 +557,228 @@ def create_manuscript(
         flds.CONTENT: content,
         flds.SUBMISSION_DATE: submission_date,
         flds.STATE: state,
+        flds.STATE_SINCE: submission_date,
     }
-    result = dbc.create(MANUSCRIPT_COLLECT, new_manuscript)
+
+
+def create_manuscript(
+    title: str,
+    author: str,
+    abstract: str,
+    content: str,
+    submission_date=None,
+    state: str = SUBMITTED,
+    actor: str = None,
+) -> dict:
+    """
+    Create a new manuscript entry in the database.
+    """
+    new_manuscript = build_manuscript(title, author, abstract, content,
+                                      submission_date, state)
+    doc = dict(new_manuscript)
+    info = move_large_content(doc)
+    try:
+        result = dbc.create(MANUSCRIPT_COLLECT, compress_manuscript(doc))
+    except Exception:
+        if info:
+            release_file(info[dbc.FILE_ID])
+        raise
 
     new_manuscript["_id"] = result.inserted_id
+    search_index.add(str(result.inserted_id), new_manuscript)
+    log_search_changes([result.inserted_id])
+    stats.apply({state: stats.entered(new_manuscript[flds.STATE_SINCE])})
+    events.record([events.build_event(result.inserted_id, None, state, events.CREATE,
+                                      actor)])
     return new_manuscript
 
 
-def update_manuscript(manu_id: str, updates: dict) -> dict:
+REQUIRED_FIELDS = [flds.TITLE, flds.AUTHOR, flds.ABSTRACT, flds.CONTENT]
+# Submission dates used to be stored as strings in this format.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+IDS = 'ids'
+
+
+def prepare_manuscript(record: dict) -> dict:
+    """
+    Build the document to store for one record of a bulk import.
+    Records may carry their own submission date and state.
+    """
+    missing = [fld for fld in REQUIRED_FIELDS if fld not in record]
+    if missing:
+        raise ValueError(f'Missing required fields: {missing}')
+    state = record.get(STATE, SUBMITTED)
+    if not is_valid_state(state):
+        raise ValueError(f'Bad state: {state}')
+    doc = build_manuscript(
+        title=record[flds.TITLE],
+        author=record[flds.AUTHOR],
+        abstract=record[flds.ABSTRACT],
+        content=record[flds.CONTENT],
+        submission_date=record.get(flds.SUBMISSION_DATE),
+        state=state,
+    )
+    move_large_content(doc)
+    return compress_manuscript(doc)
+
+
+MIGRATED = 'migrated'
+SKIPPED = 'skipped'
+LEGACY_DATE_FILTER = {flds.SUBMISSION_DATE: {'$type': 'string'}}
+
+
+def migrate_submission_dates(batch_size: int = 500, after: str = None) -> dict:
+    """
+    Convert submission dates still stored as strings into datetimes, a
+    batch (one bulk write) at a time, walking the manuscripts by _id.
+    It is resumable: converted manuscripts no longer match, so running it
+    again picks up where it stopped. Pass `after` (a page token, printed
+    after each batch) to skip what has already been looked at.
+    Strings that aren't dates are left alone and counted as skipped.
+    """
+    totals = {MIGRATED: 0, SKIPPED: 0}
+    while True:
+        docs, after = dbc.read_page(MANUSCRIPT_COLLECT, limit=batch_size, after=after,
+                                    filt=LEGACY_DATE_FILTER, no_id=False,
+                                    projection={flds.SUBMISSION_DATE: 1})
+        updates = []
+        for doc in docs:
+            try:
+                date = dbc.parse_date(doc[flds.SUBMISSION_DATE])
+            except ValueError:
+                totals[SKIPPED] += 1
+                continue
+            # only if it still holds the string we read
+            updates.append(({"_id": ObjectId(doc["_id"]),
+                             flds.SUBMISSION_DATE: doc[flds.SUBMISSION_DATE]},
+                            {flds.SUBMISSION_DATE: date}))
+        if updates:
+            result = dbc.bulk_update(MANUSCRIPT_COLLECT, updates, ordered=False)
+            totals[MIGRATED] += result[dbc.MODIFIED]
+        print(f'{totals}, resume with after={after}')
+        if after is None:
+            return totals
+
+
+def bulk_create_manuscripts(records: list, ordered: bool = True) -> dict:
     """
-    Update a manuscript in the database using MongoDB _id.
+    Create many manuscripts in one round trip.
+    Returns the insert count, per-record errors, and the new ids
+    (None for records that were not inserted), both indexed by position
+    in records.
     """
-    manuscript = get_manuscript(manu_id)
-    if not manuscript:
-        raise ValueError(f'Manuscript with _id "{manu_id}" not found')
+    docs, positions, errors = dbc.prepare_bulk(records, prepare_manuscript, ordered)
+    result = dbc.bulk_create(MANUSCRIPT_COLLECT, docs, ordered=ordered)
+    result = dbc.merge_bulk_errors(result, positions, errors)
+    new_docs = dict(zip(positions, docs))
+    ok = set(dbc.succeeded(len(records), result[dbc.ERRORS], ordered))
+    result[IDS] = [str(new_docs[i]["_id"]) if i in ok else None
+                   for i in range(len(records))]
+    for i, doc in new_docs.items():
+        if i not in ok and doc.get(flds.CONTENT_FILE):
+            release_file(doc[flds.CONTENT_FILE][dbc.FILE_ID])
+    incs = {}
+    new_events = []
+    for i in ok:
+        doc = new_docs[i]
+        search_index.add(str(doc["_id"]), {**decompress_manuscript(dict(doc)),
+                                           flds.CONTENT: records[i][flds.CONTENT]})
+        stats.merge(incs, doc[STATE], stats.entered(doc[flds.STATE_SINCE]))
+        new_events.append(events.build_event(doc["_id"], None, doc[STATE], events.CREATE))
+    stats.apply(incs)
+    events.record(new_events)
+    log_search_changes([new_docs[i]["_id"] for i in ok])
+    return result
 
-    dbc.update_doc(MANUSCRIPT_COLLECT, {"_id": ObjectId(manu_id)}, updates)
+
+STATE_PROJECTION = {STATE: 1, flds.STATE_SINCE: 1}
+
+
+def track_state(stages: list, now: datetime) -> list:
+    """
+    Wrap an update pipeline that may change a manuscript's state so that,
+    if it does, the old state and when it was entered are kept as
+    prev_state(_since), and state_since becomes now.
+    """
+    old = '_old'
+    changed = {'$ne': [f'${STATE}', f'${old}.{STATE}']}
+    return [
+        {'$set': {old: {STATE: f'${STATE}',
+                        flds.STATE_SINCE: {'$ifNull': [f'${flds.STATE_SINCE}', None]}}}},
+        *stages,
+        {'$set': {
+            flds.PREV_STATE: {'$cond': [changed, f'${old}.{STATE}',
+                                        f'${flds.PREV_STATE}']},
+            flds.PREV_STATE_SINCE: {'$cond': [changed, f'${old}.{flds.STATE_SINCE}',
+                                              f'${flds.PREV_STATE_SINCE}']},
+            flds.STATE_SINCE: {'$cond': [changed, now, f'${flds.STATE_SINCE}']},
+        }},
+        {'$unset': old},
+    ]
+
+
+def update_manuscript(manu_id: str, updates: dict, actor: str = None) -> bool:
+    """
+    Update the given fields of a manuscript in one round trip.
+    The filter only matches if at least one field would change, so an
+    update that changes nothing writes nothing. There's no pre-read.
+    (Compression is deterministic, so this works for compressed fields too.)
+    A body over CONTENT_FILE_THRESHOLD goes to file storage instead, as
+    with put_content().
+    Returns True if the manuscript changed.
+    """
+    object_id = to_object_id(manu_id)
+    updates = {fld: val for fld, val in updates.items() if fld != "_id"}
+    if STATE in updates and not is_valid_state(updates[STATE]):
+        raise ValueError(f'Bad state: {updates[STATE]}')
+    body = large_content(updates.get(flds.CONTENT))
+    body_changed = False
+    if body is not None:
+        del updates[flds.CONTENT]
+        info = dbc.put_file(io.BytesIO(body), f'{manu_id}.content', TEXT_CONTENT_TYPE)
+        body_changed = set_content_file(manu_id, object_id, info)
+    updates = compress_manuscript(updates)
+    if not updates:
+        return body_changed
+
+    filt = {
+        "_id": object_id,
+        '$or': [{fld: {'$ne': val}} for fld, val in updates.items()],
+    }
+    if STATE in updates:
+        matched = update_state(filt, updates, actor)
+    else:
+        matched = dbc.update_doc(MANUSCRIPT_COLLECT, filt, updates).matched_count
+    if matched:
+        if flds.CONTENT in updates:
+            drop_content_file(object_id)
+        if any(fld in updates for fld in search.SEARCH_FIELDS):
+            reindex_manuscript(manu_id)
+        return True
+    if not dbc.count_documents(MANUSCRIPT_COLLECT, {"_id": object_id}):
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    return body_changed
+
+
+def update_state(filt: dict, updates: dict, actor: str = None) -> bool:
+    """
+    Apply updates that include a state, keeping the state stats and the
+    event log current. Returns True if a manuscript matched filt.
+    """
+    now = dbc.parse_date(datetime.now(timezone.utc))
+    set_stage = {'$set': {fld: {'$literal': val} for fld, val in updates.items()}}
+    before = dbc.fetch_one_and_update(MANUSCRIPT_COLLECT, filt,
+                                      track_state([set_stage], now),
+                                      projection=STATE_PROJECTION,
+                                      return_before=True)
+    if not before:
+        return False
+    stats.record_transition(before.get(STATE), before.get(flds.STATE_SINCE),
+                            updates[STATE], now)
+    if before.get(STATE) != updates[STATE]:
+        events.record([events.build_event(before["_id"], before.get(STATE),
+                                          updates[STATE], events.UPDATE, actor, now)])
+    return True
 
 
 def delete_manuscript(manu_id: str) -> bool:
@@ -258,24 +790,624 @@ def delete_manuscript(manu_id: str) -> bool:
     except Exception:
         raise ValueError(f'Invalid MongoDB ObjectId: {manu_id}')
 
+    stored = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": object_id},
+                           projection={**FILES_PROJECTION, **STATE_PROJECTION})
     result = dbc.delete(MANUSCRIPT_COLLECT, {"_id": object_id})
+    if result:
+        search_index.remove(manu_id)
+        log_search_changes([manu_id])
+    if result and stored and stored.get(STATE):
+        stats.apply({stored[STATE]: stats.left(stored.get(flds.STATE_SINCE))})
+    if result and stored:
+        for file_id in get_file_ids(stored):
+            release_file(file_id)
     return result > 0
 
 
-def withdraw_manuscript(manu_id: str):
+def get_stats() -> dict:
+    """
+    Per-state counts and time-in-state, from the stats view.
+    """
+    return stats.get_stats(VALID_STATES)
+
+
+def rebuild_stats() -> dict:
+    """
+    Recompute the stats view's counts from the manuscripts.
+    """
+    return stats.rebuild(MANUSCRIPT_COLLECT, VALID_STATES)
+
+
+# Outcomes of the items of apply_actions().
+RESULT = 'result'
+INDEX = 'index'
+MESSAGE = 'message'
+APPLIED = 'applied'
+INVALID = 'invalid'
+FORBIDDEN = 'forbidden'
+NOT_FOUND = 'not_found'
+CONFLICT = 'conflict'
+MAX_BATCH_ACTIONS = 500
+# How many batch actions a manuscript keeps in recent_actions. Each one
+# is read back right after its batch, so only writes landing in between
+# could push it out.
+RECENT_ACTIONS_KEPT = 8
+ACTION_TOKEN = 'token'
+
+
+def note_action(token: ObjectId) -> dict:
+    """
+    The last stage of a batch action: add its token to recent_actions,
+    with the state and prev_state_since it left, keeping the last
+    RECENT_ACTIONS_KEPT. Another writer can push an entry out, but never
+    change it.
+    """
+    entry = {ACTION_TOKEN: token, STATE: f'${STATE}',
+             flds.PREV_STATE_SINCE: f'${flds.PREV_STATE_SINCE}'}
+    recent = {'$concatArrays': [{'$ifNull': [f'${flds.RECENT_ACTIONS}', []]}, [entry]]}
+    return {'$set': {flds.RECENT_ACTIONS: {'$slice': [recent, -RECENT_ACTIONS_KEPT]}}}
+
+
+def prepare_action(item: dict, roles: list, now: datetime) -> tuple:
+    """
+    Check one item of apply_actions() and build its conditional update.
+    Raises PermissionError if roles may not take the action, ValueError
+    if the item is bad in any other way.
+    Returns (manu_id, curr_state, action, token, pymongo UpdateOne), where
+    the update also notes the (unique) token in recent_actions.
+    """
+    manu_id = item.get("_id")
+    curr_state = item.get(STATE)
+    action = item.get(flds.ACTION)
+    kwargs = {k: v for k, v in item.items()
+              if k not in ["_id", STATE, flds.ACTION, events.ACTOR]}
+    object_id = to_object_id(manu_id)
+    stages = get_transition_update(curr_state, action, **kwargs)
+    if not role_perms.can_perform_action(curr_state, action, roles):
+        raise PermissionError(f'{action} in {curr_state} is not allowed for {roles}')
+    token = ObjectId()
+    op = pm.UpdateOne({"_id": object_id, STATE: curr_state},
+                      [*track_state(stages, now), note_action(token)])
+    return manu_id, curr_state, action, token, op
+
+
+def apply_actions(items: list, roles: list, actor: str = None) -> list:
+    """
+    Apply many FSM actions at once. Each item is like the arguments of
+    apply_action(): {_id, state, action, ...}, and each is checked against
+    the STATE_TABLE and the ROLE_PERMISSIONS of the given roles.
+    The valid ones are applied in one unordered bulk write of conditional
+    updates, then one read of their recent_actions tells which of them
+    matched, and what they left.
+    Returns one result per item, in order: {index, _id, result} plus the
+    new `state` if applied or a `message` if not.
+    """
+    if len(items) > MAX_BATCH_ACTIONS:
+        raise ValueError(f'At most {MAX_BATCH_ACTIONS} actions at a time')
+    now = dbc.parse_date(datetime.now(timezone.utc))
+    results = []
+    pending = {}  # manu_id -> (index, curr_state, action, token, op)
+    for i, item in enumerate(items):
+        result = {INDEX: i, "_id": item.get("_id") if isinstance(item, dict) else None}
+        results.append(result)
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('Each item must be an object')
+            manu_id, *prepared = prepare_action(item, roles, now)
+            if manu_id in pending:
+                raise ValueError(f'Manuscript "{manu_id}" is in the batch twice')
+            pending[manu_id] = (i, *prepared)
+        except PermissionError as e:
+            result.update({RESULT: FORBIDDEN, MESSAGE: str(e)})
+        except ValueError as e:
+            result.update({RESULT: INVALID, MESSAGE: str(e)})
+    if not pending:
+        return results
+
+    written = dbc.bulk_write(MANUSCRIPT_COLLECT, [op for *_, op in pending.values()],
+                             ordered=False)
+    failed = {err[dbc.INDEX]: err[dbc.MESSAGE] for err in written[dbc.ERRORS]}
+    stored = dbc.read(MANUSCRIPT_COLLECT, no_id=False,
+                      filt={"_id": {'$in': [ObjectId(manu_id) for manu_id in pending]}},
+                      projection={STATE: 1, flds.RECENT_ACTIONS: 1})
+    stored = {doc["_id"]: doc for doc in stored}
+    incs = {}
+    new_events = []
+    for pos, (manu_id, (i, curr_state, action, token, _)) in enumerate(pending.items()):
+        doc = stored.get(manu_id)
+        applied = next((entry for entry in (doc or {}).get(flds.RECENT_ACTIONS, [])
+                        if entry.get(ACTION_TOKEN) == token), None)
+        if applied:
+            results[i].update({RESULT: APPLIED, STATE: applied[STATE]})
+            stats.merge_transition(incs, curr_state, applied.get(flds.PREV_STATE_SINCE),
+                                   applied[STATE], now)
+            new_events.append(events.build_event(manu_id, curr_state, applied[STATE],
+                                                 action, actor, now))
+        elif pos in failed:
+            results[i].update({RESULT: INVALID, MESSAGE: failed[pos]})
+        elif not doc:
+            results[i].update({RESULT: NOT_FOUND,
+                               MESSAGE: f'Manuscript with _id "{manu_id}" not found'})
+        else:
+            results[i].update({
+                RESULT: CONFLICT,
+                MESSAGE: f'Manuscript "{manu_id}" is in state {doc[STATE]}, not {curr_state}',
+            })
+    if incs:
+        stats.apply(incs)
+    events.record(new_events)
+    return results
+
+
+def format_event(event: dict) -> dict:
+    event[events.AT] = format_date(event[events.AT])
+    return event
+
+
+def get_history(manu_id: str, limit: int = dbc.DEFAULT_PAGE_SIZE,
+                after: str = None) -> tuple:
+    """
+    One page of a manuscript's events, oldest first: (events, next_token).
+    """
+    to_object_id(manu_id)
+    page, next_token = events.read_page({events.MANU_ID: manu_id}, limit, after)
+    return [format_event(event) for event in page], next_token
+
+
+def get_events(since: str = None, limit: int = dbc.DEFAULT_PAGE_SIZE,
+               after: str = None, after_event: str = None) -> tuple:
+    """
+    One page of the events of all manuscripts recorded at or after since
+    (an ISO date or date-time), oldest first: (events, next_token). With
+    after_event, the page resumes after that event, starting
+    events.RESUME_OVERLAP earlier so events inserted late aren't missed;
+    the caller drops the ones it already has.
+    """
+    filters = []
+    if since:
+        filters.append(events.since_filter(dbc.parse_date(since)))
+    if after_event:
+        filters.append(events.after_filter(after_event))
+    filt = {'$and': filters} if len(filters) > 1 else (filters[0] if filters else {})
+    page, next_token = events.read_page(filt, limit, after)
+    return [format_event(event) for event in page], next_token
+
+
+# Full-text search. Each process keeps its own index, loaded from the db
+# on its first search and kept up to date by the writes above. Those
+# writes are also logged in the search changes collection, which each
+# process reads (on a search, at most every SEARCH_SYNC_SECS) to pick up
+# the writes of the others.
+SCORE = 'score'
+SEARCH_PROJECTION = {**{fld: 1 for fld in search.SEARCH_FIELDS}, flds.CONTENT_FILE: 1}
+# A body kept in file storage is indexed if it is text; only its first
+# SEARCH_FILE_BYTES are read.
+SEARCH_FILE_BYTES = 1 << 20
+SEARCH_CHANGES_COLLECT = 'search_changes'
+CHANGED_AT = 'at'
+SEARCH_SYNC_SECS = float(os.environ.get('SEARCH_SYNC_SECS', 2))
+# Changes are read again for this long, in case one was committed after
+# a later one had already been read.
+SEARCH_SYNC_OVERLAP = timedelta(seconds=60)
+# The log only has to outlive the overlap; a process that hasn't read it
+# for longer than this reloads its index instead.
+SEARCH_CHANGES_TTL_SECS = 24 * 60 * 60
+search_index = search.InvertedIndex()
+search_load_lock = threading.Lock()
+search_synced_at = None  # when the index last caught up with the log
+search_checked = 0.0  # time.monotonic() of that
+search_seen_changes = {}  # change id -> when it was read or made here
+search_seen_lock = threading.Lock()
+
+
+def searchable(manu: dict) -> dict:
+    """
+    A stored manuscript with its text fields decompressed, and its body
+    read from file storage if it is kept there as text.
+    """
+    decompress_manuscript(manu)
+    info = manu.pop(flds.CONTENT_FILE, None)
+    if manu.get(flds.CONTENT) is None and info \
+            and (info.get(dbc.CONTENT_TYPE) or '').startswith('text/'):
+        stream = dbc.open_file(info[dbc.FILE_ID])
+        if stream is not None:
+            try:
+                manu[flds.CONTENT] = stream.read(SEARCH_FILE_BYTES).decode('utf-8', errors='ignore')
+            finally:
+                stream.close()
+    return manu
+
+
+def log_search_changes(manu_ids: list):
+    """
+    Log that the searchable fields of these manuscripts changed, for the
+    other processes to re-index them.
+    """
+    if not manu_ids:
+        return
+    now = datetime.now(timezone.utc)
+    changes = [{"_id": ObjectId(), events.MANU_ID: str(manu_id), CHANGED_AT: now}
+               for manu_id in manu_ids]
+    with search_seen_lock:
+        for change in changes:
+            search_seen_changes[str(change["_id"])] = now  # already indexed here
+    try:
+        dbc.bulk_create(SEARCH_CHANGES_COLLECT, changes, ordered=False)
+    except Exception as e:
+        # The change itself already happened; other processes will see
+        # it when they next reload.
+        print(f'Error logging search changes: {e}')
+
+
+def load_search_index():
+    """
+    (Re)load the search index from the db, a batch at a time, into a new
+    index that then replaces the old one; the caller must hold
+    search_load_lock. Writers are not blocked while it loads: what they
+    write meanwhile is picked up from the log by the next sync.
+    """
+    global search_index, search_synced_at, search_checked
+    synced_at = datetime.now(timezone.utc)
+    index = search.InvertedIndex()
+    for manu in dbc.read_iter(MANUSCRIPT_COLLECT, no_id=False, projection=SEARCH_PROJECTION):
+        index.add(manu["_id"], searchable(manu))
+    index.loaded = True
+    search_index = index
+    search_synced_at, search_checked = synced_at, time.monotonic()
+
+
+def sync_search_index():
+    """
+    Re-index the manuscripts changed since the index last caught up (by
+    any process), or reload it if the log no longer goes back that far.
+    The caller must hold search_load_lock.
+    """
+    global search_synced_at, search_checked
+    now = datetime.now(timezone.utc)
+    if (search_synced_at is None
+            or now - search_synced_at > timedelta(seconds=SEARCH_CHANGES_TTL_SECS) - SEARCH_SYNC_OVERLAP):
+        load_search_index()
+        return
+    since = search_synced_at - SEARCH_SYNC_OVERLAP
+    changes = dbc.read(SEARCH_CHANGES_COLLECT, no_id=False,
+                       filt={CHANGED_AT: {'$gte': since}})
+    with search_seen_lock:
+        new = [change for change in changes if change["_id"] not in search_seen_changes]
+    reindex_manuscripts({change[events.MANU_ID] for change in new})
+    with search_seen_lock:
+        for change in new:
+            search_seen_changes[change["_id"]] = now
+        for change_id, seen_at in list(search_seen_changes.items()):
+            if seen_at < since:
+                del search_seen_changes[change_id]
+    search_synced_at, search_checked = now, time.monotonic()
+
+
+def get_search_index() -> search.InvertedIndex:
+    """
+    The search index, loaded on first use and caught up with the other
+    processes' writes every SEARCH_SYNC_SECS.
+    """
+    if not search_index.loaded or time.monotonic() - search_checked >= SEARCH_SYNC_SECS:
+        with search_load_lock:
+            if not search_index.loaded:
+                load_search_index()
+            elif time.monotonic() - search_checked >= SEARCH_SYNC_SECS:
+                sync_search_index()
+    return search_index
+
+
+def reindex_manuscripts(manu_ids):
+    """
+    Re-read the searchable fields of these manuscripts into the index, in
+    one round trip. Skipped if the index hasn't been loaded yet, since
+    loading will read them anyway.
+    """
+    if not search_index.loaded or not manu_ids:
+        return
+    object_ids = []
+    for manu_id in manu_ids:
+        try:
+            object_ids.append(ObjectId(manu_id))
+        except Exception:
+            continue
+    found = set()
+    for manu in dbc.read(MANUSCRIPT_COLLECT, no_id=False, projection=SEARCH_PROJECTION,
+                         filt={"_id": {'$in': object_ids}}):
+        search_index.add(manu["_id"], searchable(manu))
+        found.add(manu["_id"])
+    for object_id in object_ids:
+        if str(object_id) not in found:
+            search_index.remove(str(object_id))
+
+
+def reindex_manuscript(manu_id: str):
+    """
+    Re-read one manuscript into the index after this process changed it,
+    and log the change for the others.
+    """
+    reindex_manuscripts([manu_id])
+    log_search_changes([manu_id])
+
+
+def search_manuscripts(query: str, limit: int = search.DEFAULT_LIMIT) -> list:
+    """
+    Manuscripts whose title, abstract or content match query, best match
+    first. Each result has the summary fields plus its `score`.
+    """
+    hits = get_search_index().search(query, limit)
+    if not hits:
+        return []
+    docs = dbc.read(MANUSCRIPT_COLLECT, no_id=False, projection=SUMMARY_PROJECTION,
+                    filt={"_id": {'$in': [ObjectId(doc_id) for doc_id, _ in hits]}})
+    by_id = {doc["_id"]: doc for doc in docs}
+    results = []
+    for doc_id, score in hits:
+        if doc_id in by_id:
+            by_id[doc_id][SCORE] = score
+            results.append(from_storage(by_id[doc_id]))
+    return results
+
+
+def withdraw_manuscript(manu_id: str, actor: str = None):
     """
     Withdraw a manuscript using MongoDB _id.
     """
-    manuscript = get_manuscript(manu_id)
-    if not manuscript:
-        raise ValueError(f'Manuscript with _id "{manu_id}" not found')
+    update_manuscript(manu_id, {STATE: WITHDRAWN}, actor)
+
+
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+CONTENT_FILE_ID = f'{flds.CONTENT_FILE}.{dbc.FILE_ID}'
+ATTACHMENT_FILE_ID = f'{flds.ATTACHMENTS}.{dbc.FILE_ID}'
+FILES_PROJECTION = {flds.CONTENT_FILE: 1, flds.ATTACHMENTS: 1}
+
+
+def get_file_ids(manu: dict) -> list:
+    """
+    The ids of every stored file a manuscript refers to.
+    """
+    file_ids = [att[dbc.FILE_ID] for att in manu.get(flds.ATTACHMENTS, [])]
+    if manu.get(flds.CONTENT_FILE):
+        file_ids.append(manu[flds.CONTENT_FILE][dbc.FILE_ID])
+    return file_ids
+
+
+def release_file(file_id: str):
+    """
+    Drop a manuscript's reference to a stored file, deleting the file if
+    that was the last. Identical files are stored once and shared.
+    Files stored before references were counted are deleted once no
+    manuscript refers to them.
+    """
+    if dbc.release_file(file_id) is not None:
+        return
+    in_use = dbc.count_documents(MANUSCRIPT_COLLECT, {'$or': [
+        {CONTENT_FILE_ID: file_id},
+        {ATTACHMENT_FILE_ID: file_id},
+    ]})
+    if not in_use:
+        dbc.delete_file(file_id)
+
+
+def large_content(content) -> bytes:
+    """
+    A body's UTF-8 bytes if it is too large to keep in the manuscript,
+    else None.
+    """
+    if not isinstance(content, str):
+        return None
+    raw = content.encode('utf-8')
+    return raw if len(raw) > CONTENT_FILE_THRESHOLD else None
 
-    dbc.update_doc(MANUSCRIPT_COLLECT, {"_id": ObjectId(manu_id)}, {STATE: WITHDRAWN})
+
+def move_large_content(manu: dict) -> dict:
+    """
+    Move a new manuscript's body into file storage if it is too large to
+    keep inline, in place. Returns the stored file's info, or None.
+    """
+    body = large_content(manu.get(flds.CONTENT))
+    if body is None:
+        return None
+    info = dbc.put_file(io.BytesIO(body), f'{manu["_id"]}.content', TEXT_CONTENT_TYPE)
+    del manu[flds.CONTENT]
+    manu[flds.CONTENT_FILE] = info
+    return info
+
+
+def drop_content_file(object_id: ObjectId):
+    """
+    Once a manuscript's body has been set inline, forget (and release)
+    the file its body used to be stored in. Only if the body is still
+    inline: a concurrent upload may have replaced it with a new file.
+    """
+    before = dbc.fetch_one_and_update(
+        MANUSCRIPT_COLLECT,
+        {"_id": object_id, flds.CONTENT_FILE: {'$exists': True}, flds.CONTENT: {'$ne': None}},
+        {'$unset': {flds.CONTENT_FILE: ''}},
+        projection={flds.CONTENT_FILE: 1}, return_before=True)
+    if before and before.get(flds.CONTENT_FILE):
+        release_file(before[flds.CONTENT_FILE][dbc.FILE_ID])
+
+
+def _open_stored(info: dict) -> tuple:
+    stream = dbc.open_file(info[dbc.FILE_ID])
+    if stream is None:
+        raise AttachmentNotFound(f'File {info[dbc.FILE_ID]} is missing')
+    return stream, info
+
+
+def put_content(manu_id: str, stream, content_type=None) -> dict:
+    """
+    Stream a manuscript's body into file storage, a chunk at a time,
+    replacing the body stored in the manuscript itself.
+    Returns the stored file's info.
+    """
+    object_id = to_object_id(manu_id)
+    info = dbc.put_file(stream, f'{manu_id}.content', content_type)
+    set_content_file(manu_id, object_id, info)
+    return info
+
+
+def set_content_file(manu_id: str, object_id: ObjectId, info: dict) -> bool:
+    """
+    Make the stored file info a manuscript's body, in place of its inline
+    body or older file. Returns True unless the body was that file already.
+    """
+    before = dbc.fetch_one_and_update(
+        MANUSCRIPT_COLLECT, {"_id": object_id},
+        {'$set': {flds.CONTENT_FILE: info}, '$unset': {flds.CONTENT: ''}},
+        projection={flds.CONTENT: 1, flds.CONTENT_FILE: 1}, return_before=True)
+    if not before:
+        release_file(info[dbc.FILE_ID])
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    old = before.get(flds.CONTENT_FILE)
+    if old:
+        release_file(old[dbc.FILE_ID])  # if it's the same file, we hold another reference
+    reindex_manuscript(manu_id)  # now the body is the stored file
+    return before.get(flds.CONTENT) is not None or not old or old[dbc.FILE_ID] != info[dbc.FILE_ID]
 
 
-def handle_action(curr_state, action, **kwargs) -> str:
+def open_content(manu_id: str) -> tuple:
+    """
+    Open a manuscript's body for reading: returns (stream, info) where the
+    stream is seekable and info has its length and content type.
+    A body set inline (at creation or by a later update) wins over a
+    stored file.
+    """
+    manu = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": to_object_id(manu_id)},
+                         projection={flds.CONTENT: 1, flds.CONTENT_FILE: 1})
+    if not manu:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    if manu.get(flds.CONTENT) is not None or not manu.get(flds.CONTENT_FILE):
+        raw = (decompress_text(manu.get(flds.CONTENT)) or '').encode('utf-8')
+        return io.BytesIO(raw), {dbc.LENGTH: len(raw),
+                                 dbc.CONTENT_TYPE: TEXT_CONTENT_TYPE}
+    return _open_stored(manu[flds.CONTENT_FILE])
+
+
+def add_attachment(manu_id: str, stream, filename: str, content_type=None) -> dict:
+    """
+    Stream a file into storage and attach it to a manuscript.
+    Attaching the same contents twice returns the existing attachment.
+    """
+    object_id = to_object_id(manu_id)
+    info = dbc.put_file(stream, filename, content_type)
+    manu = dbc.fetch_one_and_update(
+        MANUSCRIPT_COLLECT,
+        {"_id": object_id, ATTACHMENT_FILE_ID: {'$ne': info[dbc.FILE_ID]}},
+        {'$push': {flds.ATTACHMENTS: info}}, projection={"_id": 1})
+    if manu:
+        return info
+    # Not attached: either there's no such manuscript, or it already has
+    # this file and the existing attachment holds a reference to it.
+    release_file(info[dbc.FILE_ID])
+    stored = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": object_id},
+                           projection={flds.ATTACHMENTS: 1})
+    if not stored:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    return next(att for att in stored[flds.ATTACHMENTS]
+                if att[dbc.FILE_ID] == info[dbc.FILE_ID])
+
+
+def get_attachments(manu_id: str) -> list:
+    manu = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": to_object_id(manu_id)},
+                         projection={flds.ATTACHMENTS: 1})
+    if not manu:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    return manu.get(flds.ATTACHMENTS, [])
+
+
+def open_attachment(manu_id: str, file_id: str) -> tuple:
+    """
+    Open one of a manuscript's attachments: returns (stream, info).
+    """
+    for att in get_attachments(manu_id):
+        if att[dbc.FILE_ID] == file_id:
+            return _open_stored(att)
+    raise AttachmentNotFound(f'Manuscript "{manu_id}" has no attachment {file_id}')
+
+
+def delete_attachment(manu_id: str, file_id: str):
+    """
+    Detach a file from a manuscript, deleting it if nothing else uses it.
+    """
+    manu = dbc.fetch_one_and_update(
+        MANUSCRIPT_COLLECT,
+        {"_id": to_object_id(manu_id), ATTACHMENT_FILE_ID: file_id},
+        {'$pull': {flds.ATTACHMENTS: {dbc.FILE_ID: file_id}}},
+        projection={"_id": 1})
+    if not manu:
+        raise AttachmentNotFound(f'Manuscript "{manu_id}" has no attachment {file_id}')
+    release_file(file_id)
+
+
+def get_transition(curr_state, action) -> dict:
     if curr_state not in STATE_TABLE:
         raise ValueError(f'Bad state: {curr_state}')
     if action not in STATE_TABLE[curr_state]:
         raise ValueError(f'{action} not available in {curr_state}')
-    return STATE_TABLE[curr_state][action][FUNC](**kwargs)
+    return STATE_TABLE[curr_state][action]
+
+
+def handle_action(curr_state, action, manu: dict = None, **kwargs) -> str:
+    """
+    Apply action to manu, a manuscript in curr_state, with apply_action().
+    Returns its new state.
+    """
+    get_transition(curr_state, action)
+    return apply_action(manu["_id"], curr_state, action, **kwargs)[STATE]
+
+
+def get_transition_update(curr_state, action, **kwargs) -> list:
+    """
+    The update pipeline that applies action to a manuscript in curr_state.
+    """
+    transition = get_transition(curr_state, action)
+    if UPDATE in transition:
+        return transition[UPDATE](**kwargs)
+    return [{'$set': {STATE: transition[FUNC](**kwargs)}}]
+
+
+def apply_action(manu_id: str, curr_state: str, action: str, actor: str = None,
+                 **kwargs) -> dict:
+    """
+    Apply an FSM action to a manuscript as one conditional update: it only
+    happens if the stored state is still curr_state. The action is logged
+    as an event, with the actor who took it.
+    Returns the updated manuscript (summary fields only).
+    Raises StateConflict if the manuscript is in another state, and
+    ManuscriptNotFound if it doesn't exist. If curr_state is None the
+    stored state is read first.
+    """
+    object_id = to_object_id(manu_id)
+    if curr_state is None:
+        stored = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": object_id},
+                               projection={STATE: 1})
+        if not stored:
+            raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+        curr_state = stored[STATE]
+
+    now = dbc.parse_date(datetime.now(timezone.utc))
+    update = track_state(get_transition_update(curr_state, action, **kwargs), now)
+    manu = dbc.fetch_one_and_update(
+        MANUSCRIPT_COLLECT, {"_id": object_id, STATE: curr_state}, update,
+        projection={**SUMMARY_PROJECTION, flds.PREV_STATE_SINCE: 1})
+    if manu:
+        prev_since = manu.pop(flds.PREV_STATE_SINCE, None)
+        stats.record_transition(curr_state, prev_since, manu[STATE], now)
+        events.record([events.build_event(manu_id, curr_state, manu[STATE],
+                                          action, actor, now)])
+        return from_storage(manu)
+
+    # Only on failure do we pay for a second read, to say why.
+    stored = dbc.fetch_one(MANUSCRIPT_COLLECT, {"_id": object_id},
+                           projection={STATE: 1})
+    if not stored:
+        raise ManuscriptNotFound(f'Manuscript with _id "{manu_id}" not found')
+    raise StateConflict(
+        f'Manuscript "{manu_id}" is in state {stored[STATE]}, not {curr_state}'
+    )
+
+
+if __name__ == '__main__':
+    migrate_submission_dates()
@@ -1,3 +1,7 @@
+import time
+
+from data.roles import role_mask
+
 AUTHOR = 'author'
 EDITOR = 'editor'
 REFEREE = 'referee'
@@ -46,21 +50,114 @@ ROLE_PERMISSIONS = {
     },
 }
 
+
+def compile_permissions(permissions: dict) -> dict:
+    """
+    Turn {state: {action: [roles]}} into {(state, action): role mask}, so a
+    check is one dict lookup and one bitwise and.
+    """
+    return {(state, action): role_mask(roles)
+            for state, actions in permissions.items()
+            for action, roles in actions.items()}
+
+
+ACTION_MASKS = compile_permissions(ROLE_PERMISSIONS)
+
+
 def can_perform_action(state, action, user_roles):
     """
     Check if a user with given roles can perform an action on a manuscript in a specific state
-    
+
     :param state: Current state of the manuscript (e.g., 'SUB', 'REV')
     :param action: Action to perform (e.g., 'ARF', 'DON')
-    :param user_roles: List of roles the user has
+    :param user_roles: List of roles the user has, or their role_mask()
     :return: Boolean indicating whether the user can perform the action
     """
+    if not isinstance(user_roles, int):
+        user_roles = role_mask(user_roles)
+    return bool(ACTION_MASKS.get((state, action), 0) & user_roles)
+
+
+def scan_can_perform_action(state, action, user_roles):
+    """
+    The uncompiled check, walking ROLE_PERMISSIONS; kept to benchmark
+    against.
+    """
     if state not in ROLE_PERMISSIONS:
         return False
-    
     if action not in ROLE_PERMISSIONS[state]:
         return False
-    
     allowed_roles = ROLE_PERMISSIONS[state][action]
-    
     return any(role in allowed_roles for role in user_roles)
+
+
+def time_calls(fn, calls: list, repeat: int = 20) -> float:
+    """
+    Nanoseconds per call of fn over calls, a list of args tuples.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for args in calls:
+            fn(*args)
+    return (time.perf_counter() - start) * 1e9 / (repeat * len(calls))
+
+
+def benchmark():
+    """
+    Time the compiled permission checks against scanning the policies:
+    manuscript actions, valid-action listings and security records.
+    """
+    import security.security as sec
+    import data.manuscripts.query as qry
+    from data.roles import Role
+
+    role_sets = [[role.value] for role in Role] + [
+        [Role.AUTHOR.value, Role.REFEREE.value],
+        [Role.AUTHOR.value, Role.EDITOR.value, Role.MANAGING_EDITOR.value],
+        [],
+    ]
+    action_calls = [(state, action, roles)
+                    for state in qry.STATE_TABLE
+                    for action in qry.VALID_ACTIONS
+                    for roles in role_sets]
+    # A request works out its user's role mask once, then reuses it.
+    mask_calls = [(state, action, role_mask(roles)) for state, action, roles in action_calls]
+    print(f'can_perform_action: scan {time_calls(scan_can_perform_action, action_calls):.0f}ns, '
+          f'compiled {time_calls(can_perform_action, action_calls):.0f}ns, '
+          f'compiled from mask {time_calls(can_perform_action, mask_calls):.0f}ns')
+
+    def scan_valid_actions(state, roles):
+        return [action for action in qry.STATE_TABLE[state]
+                if scan_can_perform_action(state, action, roles)]
+    list_calls = [(state, roles) for state in qry.STATE_TABLE for roles in role_sets]
+    mask_calls = [(state, role_mask(roles)) for state, roles in list_calls]
+    print(f'valid actions: scan {time_calls(scan_valid_actions, list_calls):.0f}ns, '
+          f'compiled {time_calls(qry.get_valid_actions, list_calls):.0f}ns, '
+          f'compiled from mask {time_calls(qry.get_valid_actions, mask_calls):.0f}ns')
+
+    @sec.needs_recs
+    def scan_is_permitted(feature, action, roles, **kwargs):
+        prot = sec.security_recs.get(feature)
+        if prot is None or not roles or action not in prot:
+            return False
+        if not any(role in prot[action][sec.ROLE_LIST] for role in roles):
+            return False
+        for check_name in prot[action][sec.CHECKS]:
+            if check_name not in sec.CHECK_FUNCS:
+                raise ValueError(f'Bad check passed to is_permitted: {check_name}')
+        return all(sec.CHECK_FUNCS[check_name](roles, **kwargs)
+                   for check_name, required in prot[action][sec.CHECKS].items() if required)
+    sec.read()
+    sec_calls = [(feature, action, roles)
+                 for feature in sec.security_recs
+                 for action in [sec.CREATE, sec.READ, sec.UPDATE, sec.DELETE]
+                 for roles in role_sets]
+
+    def timed(fn):
+        return time_calls(lambda *args: fn(*args, login_key='key'), sec_calls)
+    print(f'is_permitted: scan {timed(scan_is_permitted):.0f}ns, '
+          f'compiled {timed(sec.is_permitted):.0f}ns')
+
+
+if __name__ == '__main__':
+    benchmark()
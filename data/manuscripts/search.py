@@ -0,0 +1,225 @@
+"""
+An in-process inverted index for full-text search over manuscripts,
+ranked with BM25.
+It lives in memory, so each server process keeps its own copy: query.py
+loads it from the db on first use and keeps it up to date as manuscripts
+are written through it.
+"""
+import heapq
+import itertools
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import data.manuscripts.fields as flds
+
+# How much a match in each field counts for.
+FIELD_WEIGHTS = {
+    flds.TITLE: 3,
+    flds.ABSTRACT: 2,
+    flds.CONTENT: 1,
+}
+SEARCH_FIELDS = list(FIELD_WEIGHTS)
+
+# BM25 parameters: K1 caps how much repeating a term helps, B how much
+# long manuscripts are penalised.
+K1 = 1.2
+B = 0.75
+
+DEFAULT_LIMIT = 20
+
+# Terms in more than this share of manuscripts barely affect the ranking.
+# Once rarer terms have matched enough manuscripts that nothing matching
+# only common terms could outscore them, we only score those matches for
+# the common terms instead of walking their (huge) postings.
+COMMON_TERM_SHARE = 0.1
+
+TOKEN_RE = re.compile(r'\w+')
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was',
+    'were', 'with',
+])
+
+
+def tokenize(text) -> list:
+    """
+    Lower-cased words of text, without stop words.
+    """
+    if not isinstance(text, str):
+        return []
+    return [tok for tok in TOKEN_RE.findall(text.lower())
+            if tok not in STOP_WORDS]
+
+
+def weighted_terms(doc: dict) -> Counter:
+    """
+    Term frequencies of a manuscript, weighted by the field they are in.
+    """
+    terms = Counter()
+    for fld, weight in FIELD_WEIGHTS.items():
+        for tok in tokenize(doc.get(fld)):
+            terms[tok] += weight
+    return terms
+
+
+class InvertedIndex:
+    """
+    Maps each term to the manuscripts containing it.
+    All methods are thread-safe. add() replaces a manuscript that is
+    already indexed, so it can be used for updates too.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # term -> {doc_id: weighted tf}
+        self.doc_terms = {}  # doc_id -> tuple of its terms, for remove()
+        self.doc_lens = {}  # doc_id -> weighted length
+        self.total_len = 0
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def add(self, doc_id: str, doc: dict):
+        terms = weighted_terms(doc)
+        with self.lock:
+            self._remove(doc_id)
+            for term, freq in terms.items():
+                self.postings[term][doc_id] = freq
+            self.doc_terms[doc_id] = tuple(terms)
+            length = sum(terms.values())
+            self.doc_lens[doc_id] = length
+            self.total_len += length
+
+    def remove(self, doc_id: str):
+        with self.lock:
+            self._remove(doc_id)
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.doc_terms.clear()
+            self.doc_lens.clear()
+            self.total_len = 0
+            self.loaded = False
+
+    def search(self, query: str, limit: int = DEFAULT_LIMIT) -> list:
+        """
+        The best `limit` matches for query as (doc_id, score) pairs, best
+        first. A manuscript matches if it has any of the query's terms.
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            num_docs = len(self.doc_lens)
+            if not terms or not num_docs or limit <= 0:
+                return []
+            # BM25's length normalisation, K1 * (1 - B + B * len / avg_len),
+            # split into a constant and a per-length part.
+            norm = K1 * (1 - B)
+            per_len = K1 * B * num_docs / self.total_len
+            doc_lens = self.doc_lens
+            scores = defaultdict(float)
+
+            def idf(postings):
+                return math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            def add(postings, doc_ids):
+                term_idf = idf(postings)
+                for doc_id in doc_ids:
+                    freq = postings[doc_id]
+                    scores[doc_id] += term_idf * freq * (K1 + 1) / (
+                        freq + norm + per_len * doc_lens[doc_id])
+
+            all_postings = [self.postings[term] for term in terms if term in self.postings]
+            common = [postings for postings in all_postings
+                      if len(postings) > COMMON_TERM_SHARE * num_docs]
+            for postings in all_postings:
+                if len(postings) <= COMMON_TERM_SHARE * num_docs:
+                    add(postings, postings)
+            seen = set(scores)
+            if seen and common:
+                for postings in common:
+                    add(postings, [doc_id for doc_id in seen if doc_id in postings])
+                # A term adds less than idf * (K1 + 1) to a score, so if
+                # the matches so far fill the results with scores at least
+                # that of a manuscript having every common term, the rest
+                # can't make it in.
+                best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+                if len(best) == limit and best[-1][1] >= (K1 + 1) * sum(map(idf, common)):
+                    return best
+            for postings in common:
+                add(postings, [doc_id for doc_id in postings if doc_id not in seen])
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def _remove(self, doc_id):
+        """
+        Remove doc_id; the caller must hold the lock.
+        """
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+        self.total_len -= self.doc_lens.pop(doc_id)
+
+
+def synthetic_manuscripts(num: int, vocab_size: int = 20000, seed: int = 0):
+    """
+    Yield num (doc_id, manuscript) pairs of random text whose word
+    frequencies fall off like natural language (Zipf).
+    """
+    rng = random.Random(seed)
+    vocab = [f'w{i}' for i in range(vocab_size)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocab_size)))
+
+    def words(count):
+        return ' '.join(rng.choices(vocab, cum_weights=cum_weights, k=count))
+    for i in range(num):
+        yield str(i), {
+            flds.TITLE: words(8),
+            flds.ABSTRACT: words(40),
+            flds.CONTENT: words(150),
+        }
+
+
+def benchmark(num_docs: int = 100_000, num_queries: int = 200):
+    """
+    Time building an index of num_docs synthetic manuscripts, then
+    searching it with queries that mix common and rare words.
+    """
+    index = InvertedIndex()
+    start = time.perf_counter()
+    for doc_id, doc in synthetic_manuscripts(num_docs):
+        index.add(doc_id, doc)
+    build_secs = time.perf_counter() - start
+    print(f'Indexed {len(index)} manuscripts ({len(index.postings)} terms) '
+          f'in {build_secs:.1f}s')
+
+    rng = random.Random(1)
+    for label, lo, hi in [('rare', 1000, 20000), ('mixed', 10, 20000), ('common', 0, 10)]:
+        queries = [f'w{rng.randrange(lo, hi)} w{rng.randrange(1000, 20000)}'
+                   for _ in range(num_queries)]
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query)
+            times.append((time.perf_counter() - start) * 1000)
+        times.sort()
+        print(f'{label:>6} queries: p50 {times[len(times) // 2]:.2f}ms, '
+              f'p95 {times[int(len(times) * .95)]:.2f}ms')
+
+    start = time.perf_counter()
+    for doc_id, doc in synthetic_manuscripts(1000, seed=2):
+        index.add(doc_id, doc)
+    print(f'Re-indexed 1000 manuscripts in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    benchmark()
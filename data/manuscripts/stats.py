@@ -0,0 +1,162 @@
+"""
+Per-state manuscript statistics, kept as a small materialized view: one
+document per state in the stats collection, updated with $inc as
+manuscripts are created, deleted and moved between states.
+Reading the stats is then one small read, however many manuscripts
+there are. query.rebuild_stats() recomputes the view if it drifts.
+"""
+from datetime import datetime, timezone
+
+import pymongo as pm
+
+import data.db_connect as dbc
+import data.manuscripts.fields as flds
+
+STATS_COLLECT = 'manuscript_stats'
+
+# Fields of a state's stats document.
+COUNT = 'count'  # manuscripts in the state now
+TIMED = 'timed'  # of those, how many have a known state_since
+SINCE_TOTAL = 'since_total'  # sum of their state_since, in epoch seconds
+EXITS = 'exits'  # timed moves out of the state so far
+EXIT_SECONDS = 'exit_seconds'  # total time spent in the state by those
+
+# Fields of the stats we return.
+AVG_SECONDS_IN_STATE = 'avg_seconds_in_state'
+AVG_SECONDS_PER_EXIT = 'avg_seconds_per_exit'
+
+
+def to_seconds(date) -> float:
+    """
+    Epoch seconds of a stored (naive UTC) datetime; None if it isn't one.
+    """
+    if not isinstance(date, datetime):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def entered(since=None, count: int = 1) -> dict:
+    """
+    The $inc for `count` manuscripts entering a state at `since`.
+    """
+    seconds = to_seconds(since)
+    inc = {COUNT: count}
+    if seconds is not None:
+        inc[TIMED] = count
+        inc[SINCE_TOTAL] = seconds * count
+    return inc
+
+
+def left(since=None, until=None) -> dict:
+    """
+    The $inc for a manuscript that entered a state at `since` leaving it at
+    `until` (or being deleted, if until is None).
+    """
+    seconds = to_seconds(since)
+    inc = {COUNT: -1}
+    if seconds is not None:
+        inc[TIMED] = -1
+        inc[SINCE_TOTAL] = -seconds
+        if until is not None:
+            inc[EXITS] = 1
+            inc[EXIT_SECONDS] = to_seconds(until) - seconds
+    return inc
+
+
+def apply(incs: dict):
+    """
+    Apply {state: $inc doc} to the stats in one round trip.
+    """
+    ops = [pm.UpdateOne({dbc.MONGO_ID: state}, {'$inc': inc}, upsert=True)
+           for state, inc in incs.items() if inc]
+    try:
+        dbc.bulk_write(STATS_COLLECT, ops, ordered=False)
+    except Exception as e:
+        # The write that changed the manuscript already happened; the
+        # stats can be rebuilt.
+        print(f'Error updating manuscript stats: {e}')
+
+
+def merge_transition(incs: dict, from_state: str, from_since, to_state: str, to_since):
+    """
+    Add a manuscript moving from one state to another into incs.
+    """
+    if from_state != to_state:
+        merge(incs, from_state, left(from_since, to_since))
+        merge(incs, to_state, entered(to_since))
+
+
+def record_transition(from_state: str, from_since, to_state: str, to_since):
+    """
+    Record a manuscript moving from one state to another.
+    """
+    incs = {}
+    merge_transition(incs, from_state, from_since, to_state, to_since)
+    if incs:
+        apply(incs)
+
+
+def merge(incs: dict, state: str, inc: dict):
+    """
+    Add one $inc doc into {state: $inc doc}, to apply() many at once.
+    """
+    total = incs.setdefault(state, {})
+    for fld, amount in inc.items():
+        total[fld] = total.get(fld, 0) + amount
+
+
+def rebuild(manuscript_collect: str, states: list) -> dict:
+    """
+    Recompute the current counts and entry times of every state from the
+    manuscripts, with one aggregation. The exit totals are running sums
+    that can't be recomputed from the manuscripts, so they are kept.
+    Returns {state: count}.
+    """
+    since = f'${flds.STATE_SINCE}'
+    is_date = {'$eq': [{'$type': since}, 'date']}
+    rows = dbc.aggregate(manuscript_collect, [{'$group': {
+        dbc.MONGO_ID: f'${flds.STATE}',
+        COUNT: {'$sum': 1},
+        TIMED: {'$sum': {'$cond': [is_date, 1, 0]}},
+        SINCE_TOTAL: {'$sum': {'$cond': [
+            is_date, {'$divide': [{'$toLong': since}, 1000]}, 0,
+        ]}},
+    }}])
+    counts = {state: {COUNT: 0, TIMED: 0, SINCE_TOTAL: 0} for state in states}
+    for row in rows:
+        counts[row.pop(dbc.MONGO_ID)] = row
+    ops = [pm.UpdateOne({dbc.MONGO_ID: state}, {'$set': fields}, upsert=True)
+           for state, fields in counts.items()]
+    dbc.bulk_write(STATS_COLLECT, ops, ordered=False)
+    return {state: fields[COUNT] for state, fields in counts.items()}
+
+
+def summarize(doc: dict, now: float) -> dict:
+    """
+    Turn a stats document into what we report for its state.
+    """
+    timed = doc.get(TIMED, 0)
+    exits = doc.get(EXITS, 0)
+    return {
+        COUNT: doc.get(COUNT, 0),
+        AVG_SECONDS_IN_STATE: (now - doc[SINCE_TOTAL] / timed) if timed else None,
+        EXITS: exits,
+        AVG_SECONDS_PER_EXIT: (doc[EXIT_SECONDS] / exits) if exits else None,
+    }
+
+
+def get_stats(states: list) -> dict:
+    """
+    The stats of each state: how many manuscripts are in it, how long they
+    have been there on average, and how long those that left it stayed.
+    """
+    docs = {doc[dbc.MONGO_ID]: doc for doc in dbc.read(STATS_COLLECT, no_id=False)}
+    now = datetime.now(timezone.utc).timestamp()
+    return {state: summarize(docs.get(state, {}), now) for state in states}
+
+
+if __name__ == '__main__':
+    import data.manuscripts.query as qry
+    print(qry.rebuild_stats())
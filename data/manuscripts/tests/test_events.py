@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+from bson import ObjectId
+
+import data.manuscripts.events as events
+
+
+def test_build_event():
+    event = events.build_event('some id', 'SUB', 'REV', 'ARF', 'ed@nyu.edu',
+                               datetime(2024, 1, 1))
+    assert event == {
+        events.MANU_ID: 'some id',
+        events.FROM_STATE: 'SUB',
+        events.TO_STATE: 'REV',
+        events.ACTION: 'ARF',
+        events.ACTOR: 'ed@nyu.edu',
+        events.AT: datetime(2024, 1, 1),
+    }
+    assert isinstance(events.build_event('some id', None, 'SUB', events.CREATE)[events.AT],
+                      datetime)
+
+
+@patch('data.db_connect.bulk_create', autospec=True)
+def test_record(mock_create):
+    events.record([])
+    mock_create.assert_not_called()
+    events.record([events.build_event('some id', 'SUB', 'REJ', 'REJ')])
+    assert mock_create.call_args.args[0] == events.EVENTS_COLLECT
+
+
+@patch('data.db_connect.read_page', autospec=True, return_value=([], None))
+def test_read_page_is_by_id(mock_page):
+    events.read_page({events.MANU_ID: 'some id'}, 10)
+    kwargs = mock_page.call_args.kwargs
+    assert 'sort_key' not in kwargs  # _id, the order events were recorded in
+    assert kwargs['filt'] == {events.MANU_ID: 'some id'}
+
+
+def test_since_filter():
+    filt = events.since_filter(datetime(2024, 1, 1))
+    assert filt['_id']['$gte'].generation_time == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_after_filter():
+    event_id = ObjectId()
+    filt = events.after_filter(str(event_id))['_id']
+    assert filt['$ne'] == event_id
+    assert filt['$gte'].generation_time == event_id.generation_time - events.RESUME_OVERLAP
+    with pytest.raises(ValueError):
+        events.after_filter('junk')
@@ -1,9 +1,18 @@
+import io
 import random
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
 
 import pytest
+from bson import ObjectId
 
+import data.db_connect as dbc
 import data.manuscripts.query as mqry
 import data.manuscripts.fields as flds
+import data.manuscripts.events as events
+import data.manuscripts.search as search
+import data.manuscripts.role_permissions as role_perms
+import data.roles as rls
 
 
 def gen_random_not_valid_str() -> str:
@@ -58,7 +67,7 @@ def test_handle_action_valid_return():
         author='John Doe',
         abstract='abstract goes here',
         content='content goes here',
-        submission_date='today',
+        submission_date=datetime(2024, 9, 24),
     )
     try:
         manu_id = str(SAMPLE_MANU["_id"])
@@ -66,8 +75,633 @@ def test_handle_action_valid_return():
 
         for state in mqry.get_states():
             for action in mqry.get_valid_actions_by_state(state):
+                mqry.update_manuscript(manu_id, {flds.STATE: state})
                 new_state = mqry.handle_action(state, action, manu=SAMPLE_MANU, ref="a referee")
                 assert mqry.is_valid_state(new_state)
 
     finally:
         mqry.delete_manuscript(manu_id)
+
+
+def test_get_valid_actions():
+    roles_list = [[], [rls.Role.AUTHOR.value], [rls.Role.EDITOR.value],
+                  [rls.Role.AUTHOR.value, rls.Role.EDITOR.value], ['no such role']]
+    for state in mqry.get_states():
+        for roles in roles_list:
+            expected = tuple(action for action in mqry.STATE_TABLE[state]
+                             if role_perms.scan_can_perform_action(state, action, roles))
+            assert mqry.get_valid_actions(state, roles) == expected
+            assert mqry.get_valid_actions(state, rls.role_mask(roles)) == expected
+    assert mqry.get_valid_actions(mqry.SUBMITTED, [rls.Role.AUTHOR.value]) == (mqry.WITHDRAW,)
+    assert mqry.get_valid_actions('not a state', [rls.Role.EDITOR.value]) == ()
+
+
+def test_can_perform_action_matches_scan():
+    for state in mqry.get_states():
+        for action in mqry.get_actions():
+            for role in rls.Role:
+                roles = [role.value]
+                assert role_perms.can_perform_action(state, action, roles) == \
+                    role_perms.scan_can_perform_action(state, action, roles)
+
+
+def test_get_projection():
+    assert mqry.get_projection() is None
+    projection = mqry.get_projection(summary=True)
+    assert flds.CONTENT not in projection
+    assert flds.ABSTRACT not in projection
+    for fld in mqry.SUMMARY_FIELDS:
+        assert projection[fld]
+
+
+TEST_MANU_ID = '0123456789ab0123456789ab'
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.record_transition', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED})
+def test_handle_action_applies_transition_update(mock_update, mock_record, mock_events):
+    new_state = mqry.handle_action(mqry.IN_REF_REV, mqry.DELETE_REF,
+                                   manu={'_id': TEST_MANU_ID}, ref='a referee')
+    assert new_state == mqry.SUBMITTED
+    assert mock_update.call_args.args[1] == {'_id': ObjectId(TEST_MANU_ID), flds.STATE: mqry.IN_REF_REV}
+    assert mock_update.call_args.args[2] == mqry.track_state(
+        mqry.delete_ref_update(ref='a referee'), mock_record.call_args.args[3])
+
+
+def test_transition_update_sets_new_state():
+    assert mqry.get_transition_update(mqry.SUBMITTED, mqry.REJECT) == \
+        [{'$set': {flds.STATE: mqry.REJECTED}}]
+
+
+def test_transition_update_needs_ref():
+    with pytest.raises(ValueError):
+        mqry.get_transition_update(mqry.SUBMITTED, mqry.ASSIGN_REF)
+
+
+def test_transition_update_bad_action():
+    with pytest.raises(ValueError):
+        mqry.get_transition_update(mqry.TEST_STATE, gen_random_not_valid_str())
+
+
+@patch('data.db_connect.fetch_one', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.IN_REF_REVIEW})
+def test_apply_action_is_one_conditional_update(mock_update, mock_fetch):
+    manu = mqry.apply_action(TEST_MANU_ID, mqry.SUBMITTED, mqry.ASSIGN_REF, ref='a referee')
+    assert manu[flds.STATE] == mqry.IN_REF_REVIEW
+    mock_fetch.assert_not_called()
+    filt = mock_update.call_args.args[1]
+    assert filt == {'_id': ObjectId(TEST_MANU_ID), flds.STATE: mqry.SUBMITTED}
+
+
+@patch('data.db_connect.fetch_one', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.REJECTED})
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value=None)
+def test_apply_action_conflict(mock_update, mock_fetch):
+    with pytest.raises(mqry.StateConflict):
+        mqry.apply_action(TEST_MANU_ID, mqry.SUBMITTED, mqry.REJECT)
+
+
+@patch('data.db_connect.fetch_one', autospec=True, return_value=None)
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value=None)
+def test_apply_action_not_found(mock_update, mock_fetch):
+    with pytest.raises(mqry.ManuscriptNotFound):
+        mqry.apply_action(TEST_MANU_ID, mqry.SUBMITTED, mqry.REJECT)
+
+
+@patch('data.db_connect.count_documents', autospec=True)
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_manuscript_sets_only_given_fields(mock_update, mock_count):
+    mock_update.return_value.matched_count = 1
+    assert mqry.update_manuscript(TEST_MANU_ID, {'_id': TEST_MANU_ID, flds.TITLE: 'New'})
+    mock_update.assert_called_once_with(
+        mqry.MANUSCRIPT_COLLECT,
+        {'_id': ObjectId(TEST_MANU_ID), '$or': [{flds.TITLE: {'$ne': 'New'}}]},
+        {flds.TITLE: 'New'},
+    )
+    mock_count.assert_not_called()
+
+
+@patch('data.db_connect.count_documents', autospec=True, return_value=1)
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_manuscript_unchanged(mock_update, mock_count):
+    mock_update.return_value.matched_count = 0
+    assert not mqry.update_manuscript(TEST_MANU_ID, {flds.TITLE: 'Same'})
+
+
+@patch('data.db_connect.count_documents', autospec=True, return_value=0)
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_manuscript_not_found(mock_update, mock_count):
+    mock_update.return_value.matched_count = 0
+    with pytest.raises(mqry.ManuscriptNotFound):
+        mqry.update_manuscript(TEST_MANU_ID, {flds.TITLE: 'New'})
+
+
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_manuscript_nothing_to_do(mock_update):
+    assert not mqry.update_manuscript(TEST_MANU_ID, {})
+    mock_update.assert_not_called()
+
+
+@patch('data.manuscripts.query.release_file', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True)
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_content_drops_stored_body(mock_update, mock_drop, mock_release):
+    file_id = str(ObjectId())
+    mock_update.return_value.matched_count = 1
+    mock_drop.return_value = {'_id': TEST_MANU_ID, flds.CONTENT_FILE: {dbc.FILE_ID: file_id}}
+    with patch.object(mqry, 'search_index', search.InvertedIndex()):
+        assert mqry.update_manuscript(TEST_MANU_ID, {flds.CONTENT: 'inline again'})
+    filt, update = mock_drop.call_args.args[1:3]
+    assert filt[flds.CONTENT] == {'$ne': None}  # unless an upload replaced it meanwhile
+    assert update == {'$unset': {flds.CONTENT_FILE: ''}}
+    mock_release.assert_called_once_with(file_id)
+
+
+@patch('data.manuscripts.query.release_file', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value=None)
+@patch('data.db_connect.update_doc', autospec=True)
+def test_update_content_without_stored_body(mock_update, mock_drop, mock_release):
+    mock_update.return_value.matched_count = 1
+    with patch.object(mqry, 'search_index', search.InvertedIndex()):
+        assert mqry.update_manuscript(TEST_MANU_ID, {flds.CONTENT: 'inline'})
+    mock_release.assert_not_called()
+
+
+@patch('data.manuscripts.query.release_file', autospec=True)
+@patch('data.db_connect.fetch_one', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value=None)
+@patch('data.db_connect.put_file', autospec=True)
+def test_attaching_the_same_file_again_drops_the_new_reference(mock_put, mock_push, mock_fetch,
+                                                               mock_release):
+    info = {dbc.FILE_ID: str(ObjectId()), dbc.FILENAME: 'a.txt'}
+    mock_put.return_value = info
+    mock_fetch.return_value = {flds.ATTACHMENTS: [info]}
+    assert mqry.add_attachment(TEST_MANU_ID, io.BytesIO(b'abc'), 'a.txt') == info
+    mock_release.assert_called_once_with(info[dbc.FILE_ID])
+
+
+@patch('data.db_connect.count_documents', autospec=True)
+@patch('data.db_connect.delete_file', autospec=True)
+@patch('data.db_connect.release_file', autospec=True)
+def test_release_file(mock_release, mock_delete, mock_count):
+    mock_release.return_value = False
+    mqry.release_file('some file')
+    mock_count.assert_not_called()
+    # stored before references were counted: deleted once unused
+    mock_release.return_value = None
+    mock_count.return_value = 1
+    mqry.release_file('some file')
+    mock_delete.assert_not_called()
+    mock_count.return_value = 0
+    mqry.release_file('some file')
+    mock_delete.assert_called_once_with('some file')
+
+
+def test_referees_bad_id():
+    with pytest.raises(ValueError, match='Invalid MongoDB ObjectId'):
+        mqry.add_referee('junk', 'ref@nyu.edu')
+    with pytest.raises(ValueError, match='Invalid MongoDB ObjectId'):
+        mqry.remove_referee('junk', 'ref@nyu.edu')
+
+
+def test_small_text_is_not_compressed():
+    assert mqry.compress_text('short') == 'short'
+    assert mqry.compress_text(None) is None
+
+
+def test_compress_round_trip():
+    text = 'a long manuscript ' * 1000
+    stored = mqry.compress_text(text)
+    assert stored[mqry.CODEC] == mqry.ZLIB_V1
+    assert len(stored[mqry.DATA]) < len(text)
+    assert mqry.compress_text(text) == stored  # deterministic
+    assert mqry.decompress_text(stored) == text
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        mqry.decompress_text({mqry.CODEC: 'zstd-9', mqry.DATA: b''})
+
+
+def test_decompress_manuscript_only_touches_fetched_fields():
+    summary = {flds.TITLE: 'title'}
+    assert mqry.decompress_manuscript(summary) == {flds.TITLE: 'title'}
+    assert mqry.decompress_manuscript(None) is None
+
+
+@patch('data.db_connect.create', autospec=True)
+def test_create_manuscript_stores_compressed_content(mock_create):
+    content = 'content ' * 1000
+    manu = mqry.create_manuscript('title', 'author', 'abstract', content)
+    stored = mock_create.call_args.args[1]
+    assert stored[flds.CONTENT][mqry.CODEC] == mqry.ZLIB_V1
+    assert stored[flds.ABSTRACT] == 'abstract'
+    assert manu[flds.CONTENT] == content
+
+
+@patch('data.db_connect.create', autospec=True)
+@patch('data.db_connect.put_file', autospec=True)
+def test_create_manuscript_stores_large_content_as_file(mock_put, mock_create):
+    info = {dbc.FILE_ID: str(ObjectId()), dbc.CONTENT_TYPE: mqry.TEXT_CONTENT_TYPE}
+    mock_put.return_value = info
+    content = 'a long body'
+    with patch.object(mqry, 'CONTENT_FILE_THRESHOLD', 4):
+        manu = mqry.create_manuscript('title', 'author', 'abstract', content)
+    stored = mock_create.call_args.args[1]
+    assert flds.CONTENT not in stored
+    assert stored[flds.CONTENT_FILE] == info
+    assert mock_put.call_args.args[0].read() == content.encode('utf-8')
+    assert manu[flds.CONTENT] == content
+
+
+@patch('data.manuscripts.query.release_file', autospec=True)
+@patch('data.db_connect.create', autospec=True, side_effect=RuntimeError('db down'))
+@patch('data.db_connect.put_file', autospec=True)
+def test_create_manuscript_releases_file_if_insert_fails(mock_put, mock_create, mock_release):
+    mock_put.return_value = {dbc.FILE_ID: 'some file'}
+    with patch.object(mqry, 'CONTENT_FILE_THRESHOLD', 4), pytest.raises(RuntimeError):
+        mqry.create_manuscript('title', 'author', 'abstract', 'a long body')
+    mock_release.assert_called_once_with('some file')
+
+
+@patch('data.manuscripts.query.reindex_manuscript', autospec=True)
+@patch('data.db_connect.update_doc', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.CONTENT: 'short'})
+@patch('data.db_connect.put_file', autospec=True)
+def test_update_manuscript_stores_large_content_as_file(mock_put, mock_set, mock_update,
+                                                        mock_reindex):
+    info = {dbc.FILE_ID: str(ObjectId())}
+    mock_put.return_value = info
+    mock_update.return_value.matched_count = 1
+    with patch.object(mqry, 'CONTENT_FILE_THRESHOLD', 4):
+        assert mqry.update_manuscript(TEST_MANU_ID, {flds.TITLE: 'New', flds.CONTENT: 'a long body'})
+    assert mock_set.call_args.args[2] == {'$set': {flds.CONTENT_FILE: info},
+                                          '$unset': {flds.CONTENT: ''}}
+    assert mock_update.call_args.args[2] == {flds.TITLE: 'New'}
+
+
+@pytest.fixture
+def search_index():
+    """
+    A fresh search index, loaded and caught up with the change log.
+    """
+    index = search.InvertedIndex()
+    index.loaded = True
+    with patch.object(mqry, 'search_index', index), \
+            patch.object(mqry, 'search_synced_at', datetime.now(timezone.utc)), \
+            patch.object(mqry, 'search_checked', mqry.time.monotonic()), \
+            patch.object(mqry, 'search_seen_changes', {}):
+        yield index
+
+
+@patch('data.db_connect.read', autospec=True)
+def test_search_manuscripts(mock_read, search_index):
+    id1, id2 = str(ObjectId()), str(ObjectId())
+    mock_read.return_value = [{'_id': id2, flds.TITLE: 'Cooking'},
+                              {'_id': id1, flds.TITLE: 'Graphs'}]
+    search_index.add(id1, {flds.TITLE: 'Graphs', flds.ABSTRACT: 'graphs'})
+    search_index.add(id2, {flds.ABSTRACT: 'graphs'})
+    results = mqry.search_manuscripts('graphs')
+    assert [res['_id'] for res in results] == [id1, id2]
+    assert results[0][mqry.SCORE] > results[1][mqry.SCORE]
+
+
+@patch('data.db_connect.bulk_create', autospec=True)
+@patch('data.db_connect.update_doc', autospec=True)
+@patch('data.db_connect.read', autospec=True,
+       return_value=[{'_id': TEST_MANU_ID, flds.TITLE: 'New'}])
+def test_update_manuscript_reindexes(mock_read, mock_update, mock_log, search_index):
+    mock_update.return_value.matched_count = 1
+    search_index.add(TEST_MANU_ID, {flds.TITLE: 'Old'})
+    mqry.update_manuscript(TEST_MANU_ID, {flds.TITLE: 'New'})
+    assert search_index.search('old') == []
+    assert search_index.search('new')[0][0] == TEST_MANU_ID
+    collection, [change] = mock_log.call_args.args[:2]
+    assert collection == mqry.SEARCH_CHANGES_COLLECT
+    assert change[events.MANU_ID] == TEST_MANU_ID
+
+
+@patch('data.db_connect.bulk_create', autospec=True)
+@patch('data.db_connect.read', autospec=True)
+def test_search_picks_up_other_processes_writes(mock_read, mock_log, search_index):
+    mine, theirs, gone = str(ObjectId()), str(ObjectId()), str(ObjectId())
+    search_index.add(gone, {flds.TITLE: 'graphs'})
+    mqry.log_search_changes([mine])
+    [my_change] = mock_log.call_args.args[1]
+    changes = [{'_id': str(my_change['_id']), events.MANU_ID: mine},
+               {'_id': str(ObjectId()), events.MANU_ID: theirs},
+               {'_id': str(ObjectId()), events.MANU_ID: gone}]
+    mock_read.side_effect = [changes, [{'_id': theirs, flds.TITLE: 'Graphs'}]]
+    with patch.object(mqry, 'search_checked', 0.0):
+        index = mqry.get_search_index()
+    assert [doc_id for doc_id, _ in index.search('graphs')] == [theirs]
+    # only the manuscripts changed elsewhere are read again
+    refetched = mock_read.call_args.kwargs['filt']['_id']['$in']
+    assert sorted(map(str, refetched)) == sorted([theirs, gone])
+    # and the same changes aren't read again on the next sync
+    mock_read.side_effect = [changes]
+    with patch.object(mqry, 'search_checked', 0.0):
+        mqry.get_search_index()
+    assert mock_read.call_count == 3
+
+
+@patch('data.db_connect.read_iter', autospec=True)
+def test_search_index_reloads_when_log_is_too_old(mock_read_iter, search_index):
+    manu_id = str(ObjectId())
+    mock_read_iter.return_value = iter([{'_id': manu_id, flds.TITLE: 'graphs'}])
+    long_ago = datetime.now(timezone.utc) - timedelta(seconds=mqry.SEARCH_CHANGES_TTL_SECS)
+    with patch.object(mqry, 'search_synced_at', long_ago), \
+            patch.object(mqry, 'search_checked', 0.0):
+        index = mqry.get_search_index()
+        assert index is not search_index
+        assert index.search('graphs')[0][0] == manu_id
+
+
+@patch('data.db_connect.bulk_create', autospec=True)
+@patch('data.db_connect.open_file', autospec=True,
+       side_effect=lambda file_id: io.BytesIO('Graph colouring in depth'.encode('utf-8')))
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value={'_id': TEST_MANU_ID})
+@patch('data.db_connect.put_file', autospec=True)
+@patch('data.db_connect.read', autospec=True)
+def test_put_content_indexes_stored_text(mock_read, mock_put, mock_update, mock_open, mock_log,
+                                         search_index):
+    info = {dbc.FILE_ID: str(ObjectId()), dbc.CONTENT_TYPE: 'text/plain'}
+    mock_put.return_value = info
+    mock_read.return_value = [{'_id': TEST_MANU_ID, flds.TITLE: 'Notes', flds.CONTENT_FILE: info}]
+    search_index.add(TEST_MANU_ID, {flds.TITLE: 'Notes', flds.CONTENT: 'inline body'})
+    mqry.put_content(TEST_MANU_ID, io.BytesIO(b'Graph colouring in depth'), 'text/plain')
+    assert search_index.search('colouring')[0][0] == TEST_MANU_ID
+    assert search_index.search('inline') == []
+    mock_open.assert_called_once_with(info[dbc.FILE_ID])
+
+
+@patch('data.db_connect.open_file', autospec=True)
+@patch('data.db_connect.read', autospec=True)
+def test_stored_binary_body_is_not_indexed(mock_read, mock_open, search_index):
+    info = {dbc.FILE_ID: str(ObjectId()), dbc.CONTENT_TYPE: 'application/pdf'}
+    mock_read.return_value = [{'_id': TEST_MANU_ID, flds.TITLE: 'Notes', flds.CONTENT_FILE: info}]
+    mqry.reindex_manuscripts([TEST_MANU_ID])
+    assert search_index.search('notes')[0][0] == TEST_MANU_ID
+    mock_open.assert_not_called()
+
+
+def test_build_filter():
+    assert mqry.build_filter() == {}
+    filt = mqry.build_filter(state=mqry.IN_REF_REV, author='Ann', ref='r@nyu.edu',
+                             since='2024-01-01', until='2024-02-01T12:00')
+    assert filt == {
+        mqry.STATE: mqry.IN_REF_REV,
+        flds.AUTHOR: 'Ann',
+        flds.REFEREES: 'r@nyu.edu',
+        flds.SUBMISSION_DATE: {'$gte': datetime(2024, 1, 1),
+                               '$lt': datetime(2024, 2, 1, 12)},
+    }
+
+
+def test_build_filter_bad_values():
+    with pytest.raises(ValueError):
+        mqry.build_filter(state='NOPE')
+    with pytest.raises(ValueError):
+        mqry.build_filter(since='last week')
+
+
+def test_get_sort():
+    assert mqry.get_sort() is None
+    assert mqry.get_sort(flds.SUBMISSION_DATE, descending=True) == [
+        (flds.SUBMISSION_DATE, -1), ('_id', -1)]
+    with pytest.raises(ValueError):
+        mqry.get_sort(flds.TITLE)
+
+
+@patch('data.db_connect.read', autospec=True, return_value=[])
+def test_get_all_manuscripts_filtered(mock_read):
+    mqry.get_all_manuscripts(summary=True, filt={mqry.STATE: mqry.IN_REF_REV},
+                             sort_key=flds.SUBMISSION_DATE)
+    kwargs = mock_read.call_args.kwargs
+    assert kwargs['filt'] == {mqry.STATE: mqry.IN_REF_REV}
+    assert kwargs['sort'] == [(flds.SUBMISSION_DATE, 1), ('_id', 1)]
+
+
+def test_build_manuscript_stores_datetime():
+    manu = mqry.build_manuscript('title', 'author', 'abstract', 'content',
+                                 submission_date='2024-09-24 10:30:00')
+    assert manu[flds.SUBMISSION_DATE] == datetime(2024, 9, 24, 10, 30)
+    manu = mqry.build_manuscript('title', 'author', 'abstract', 'content')
+    assert isinstance(manu[flds.SUBMISSION_DATE], datetime)
+
+
+def test_from_storage_shows_iso_dates():
+    manu = mqry.from_storage({flds.SUBMISSION_DATE: datetime(2024, 9, 24, 10, 30)})
+    assert manu[flds.SUBMISSION_DATE] == '2024-09-24T10:30:00+00:00'
+    legacy = mqry.from_storage({flds.SUBMISSION_DATE: '2024-09-24 10:30:00'})
+    assert legacy[flds.SUBMISSION_DATE] == '2024-09-24T10:30:00+00:00'
+    assert mqry.from_storage({flds.SUBMISSION_DATE: 'today'})[flds.SUBMISSION_DATE] == 'today'
+
+
+@patch('data.db_connect.bulk_update', autospec=True, return_value={'modified': 1})
+@patch('data.db_connect.read_page', autospec=True)
+def test_migrate_submission_dates(mock_page, mock_bulk):
+    good, bad = ObjectId(), ObjectId()
+    mock_page.side_effect = [
+        ([{'_id': str(good), flds.SUBMISSION_DATE: '2024-09-24 10:30:00'},
+          {'_id': str(bad), flds.SUBMISSION_DATE: 'today'}], 'token'),
+        ([], None),
+    ]
+    totals = mqry.migrate_submission_dates(batch_size=2)
+    assert totals == {mqry.MIGRATED: 1, mqry.SKIPPED: 1}
+    updates = mock_bulk.call_args.args[1]
+    assert updates == [({'_id': good, flds.SUBMISSION_DATE: '2024-09-24 10:30:00'},
+                        {flds.SUBMISSION_DATE: datetime(2024, 9, 24, 10, 30)})]
+    assert mock_page.call_args.kwargs['after'] == 'token'
+
+
+@patch('data.manuscripts.stats.record_transition', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.IN_REF_REV,
+                     flds.PREV_STATE_SINCE: datetime(2024, 1, 1)})
+def test_apply_action_records_transition(mock_update, mock_record):
+    manu = mqry.apply_action(TEST_MANU_ID, mqry.SUBMITTED, mqry.ASSIGN_REF, ref='a referee')
+    assert flds.PREV_STATE_SINCE not in manu
+    args = mock_record.call_args.args
+    assert args[:3] == (mqry.SUBMITTED, datetime(2024, 1, 1), mqry.IN_REF_REV)
+    assert isinstance(args[3], datetime)
+
+
+@patch('data.manuscripts.stats.record_transition', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED})
+def test_update_manuscript_state_records_transition(mock_update, mock_record):
+    assert mqry.update_manuscript(TEST_MANU_ID, {flds.STATE: mqry.WITHDRAWN})
+    assert mock_update.call_args.kwargs['return_before']
+    assert mock_record.call_args.args[:3] == (mqry.SUBMITTED, None, mqry.WITHDRAWN)
+
+
+def test_update_manuscript_bad_state():
+    with pytest.raises(ValueError):
+        mqry.update_manuscript(TEST_MANU_ID, {flds.STATE: 'NOPE'})
+
+
+def test_track_state():
+    now = datetime(2024, 1, 1)
+    stages = mqry.track_state([{'$set': {flds.STATE: mqry.REJECTED}}], now)
+    assert stages[1] == {'$set': {flds.STATE: mqry.REJECTED}}
+    assert stages[-1] == {'$unset': '_old'}
+    assert stages[-2]['$set'][flds.STATE_SINCE]['$cond'][1] == now
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True,
+       return_value={'_id': TEST_MANU_ID, flds.STATE: mqry.REJECTED})
+def test_apply_action_logs_event(mock_update, mock_record):
+    mqry.apply_action(TEST_MANU_ID, mqry.SUBMITTED, mqry.REJECT, actor='ed@nyu.edu')
+    [event] = mock_record.call_args.args[0]
+    assert event[events.MANU_ID] == TEST_MANU_ID
+    assert (event[events.FROM_STATE], event[events.TO_STATE]) == (mqry.SUBMITTED, mqry.REJECTED)
+    assert (event[events.ACTION], event[events.ACTOR]) == (mqry.REJECT, 'ed@nyu.edu')
+
+
+@patch('data.manuscripts.events.read_page', autospec=True,
+       return_value=([{events.AT: datetime(2024, 1, 1)}], 'token'))
+def test_get_events(mock_page):
+    page, next_token = mqry.get_events('2024-01-01', 5)
+    assert page == [{events.AT: '2024-01-01T00:00:00+00:00'}]
+    assert next_token == 'token'
+    mock_page.assert_called_once_with(events.since_filter(datetime(2024, 1, 1)), 5, None)
+
+
+@patch('data.manuscripts.events.read_page', autospec=True, return_value=([], None))
+def test_get_events_after_event(mock_page):
+    event_id = str(ObjectId())
+    mqry.get_events('2024-01-01', 5, after_event=event_id)
+    mock_page.assert_called_once_with(
+        {'$and': [events.since_filter(datetime(2024, 1, 1)), events.after_filter(event_id)]},
+        5, None)
+    with pytest.raises(ValueError):
+        mqry.get_events(after_event='junk')
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.apply', autospec=True)
+@patch('data.db_connect.bulk_create', autospec=True)
+def test_bulk_create_logs_creation_time(mock_bulk, mock_stats, mock_record):
+    mock_bulk.return_value = {dbc.INSERTED: 1, dbc.ERRORS: []}
+    before = datetime.now(timezone.utc)
+    with patch.object(mqry, 'search_index', search.InvertedIndex()):
+        mqry.bulk_create_manuscripts([{flds.TITLE: 't', flds.AUTHOR: 'a', flds.ABSTRACT: 'b',
+                                       flds.CONTENT: 'c', flds.SUBMISSION_DATE: '2020-01-01'}])
+    [event] = mock_record.call_args.args[0]
+    assert event[events.AT] >= before
+
+
+@patch('data.manuscripts.query.release_file', autospec=True)
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.apply', autospec=True)
+@patch('data.db_connect.put_file', autospec=True)
+@patch('data.db_connect.bulk_create', autospec=True)
+def test_bulk_create_stores_large_content_as_files(mock_bulk, mock_put, mock_stats, mock_record,
+                                                   mock_release):
+    mock_put.side_effect = [{dbc.FILE_ID: 'first'}, {dbc.FILE_ID: 'second'}]
+    mock_bulk.return_value = {dbc.INSERTED: 1, dbc.ERRORS: [{dbc.INDEX: 1, dbc.CODE: 11000,
+                                                             dbc.MESSAGE: 'dup'}]}
+    record = {flds.TITLE: 't', flds.AUTHOR: 'a', flds.ABSTRACT: 'b', flds.CONTENT: 'a long body'}
+    index = search.InvertedIndex()
+    with patch.object(mqry, 'search_index', index), \
+            patch.object(mqry, 'CONTENT_FILE_THRESHOLD', 4):
+        result = mqry.bulk_create_manuscripts([record, dict(record)], ordered=False)
+    docs = mock_bulk.call_args_list[0].args[1]
+    assert [doc[flds.CONTENT_FILE][dbc.FILE_ID] for doc in docs] == ['first', 'second']
+    assert all(flds.CONTENT not in doc for doc in docs)
+    mock_release.assert_called_once_with('second')
+    assert index.search('body')[0][0] == result[mqry.IDS][0]
+
+
+def test_get_history_bad_id():
+    with pytest.raises(ValueError):
+        mqry.get_history('junk')
+
+
+def test_prepare_action_checks_roles():
+    now = datetime(2024, 1, 1)
+    with pytest.raises(PermissionError):
+        mqry.prepare_action({'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED,
+                             flds.ACTION: mqry.REJECT}, ['author'], now)
+    with pytest.raises(ValueError):
+        mqry.prepare_action({'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED,
+                             flds.ACTION: mqry.DONE}, ['editor'], now)
+    manu_id, state, action, token, op = mqry.prepare_action(
+        {'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        ['editor'], now)
+    assert (manu_id, state, action) == (TEST_MANU_ID, mqry.SUBMITTED, mqry.REJECT)
+    assert op._filter == {'_id': ObjectId(TEST_MANU_ID), flds.STATE: mqry.SUBMITTED}
+    assert op._doc[-1] == mqry.note_action(token)
+
+
+def applied_entry(op, state, prev_since=None):
+    """
+    The recent_actions entry the batch update op would leave.
+    """
+    entry = {mqry.ACTION_TOKEN: op._doc[-1]['$set'][flds.RECENT_ACTIONS]['$slice'][0]
+             ['$concatArrays'][1][0][mqry.ACTION_TOKEN], flds.STATE: state}
+    if prev_since:
+        entry[flds.PREV_STATE_SINCE] = prev_since
+    return entry
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.apply', autospec=True)
+@patch('data.db_connect.read', autospec=True)
+@patch('data.db_connect.bulk_write', autospec=True)
+def test_apply_actions(mock_write, mock_read, mock_stats, mock_events):
+    conflict_id, missing_id = str(ObjectId()), str(ObjectId())
+
+    def read(*args, **kwargs):
+        # the first update matched, the second didn't
+        applied_op = mock_write.call_args.args[1][0]
+        return [
+            {'_id': TEST_MANU_ID, flds.STATE: mqry.REJECTED,
+             flds.RECENT_ACTIONS: [applied_entry(applied_op, mqry.REJECTED, datetime(2024, 1, 1))]},
+            {'_id': conflict_id, flds.STATE: mqry.IN_REF_REV},
+        ]
+    mock_write.return_value = {dbc.ERRORS: []}
+    mock_read.side_effect = read
+    items = [
+        {'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        {'_id': conflict_id, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        {'_id': missing_id, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        {'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        {'_id': 'junk', flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT},
+        {'_id': missing_id, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.WITHDRAW},
+    ]
+    results = mqry.apply_actions(items, ['editor'], actor='ed@nyu.edu')
+    assert [res[mqry.RESULT] for res in results] == [
+        mqry.APPLIED, mqry.CONFLICT, mqry.NOT_FOUND, mqry.INVALID, mqry.INVALID, mqry.FORBIDDEN,
+    ]
+    assert results[0][flds.STATE] == mqry.REJECTED
+    mock_write.assert_called_once()
+    assert len(mock_write.call_args.args[1]) == 3
+    mock_read.assert_called_once()
+    [event] = mock_events.call_args.args[0]
+    assert event[events.ACTOR] == 'ed@nyu.edu'
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.apply', autospec=True)
+@patch('data.db_connect.read', autospec=True)
+@patch('data.db_connect.bulk_write', autospec=True, return_value={dbc.ERRORS: []})
+def test_apply_actions_applied_despite_later_writer(mock_write, mock_read, mock_stats, mock_events):
+    # Another writer has already moved the manuscript on by the time we
+    # re-read it: the action still counts as applied, with what it left.
+    def read(*args, **kwargs):
+        applied_op = mock_write.call_args.args[1][0]
+        later = {mqry.ACTION_TOKEN: ObjectId(), flds.STATE: mqry.WITHDRAWN}
+        return [{'_id': TEST_MANU_ID, flds.STATE: mqry.WITHDRAWN,
+                 flds.RECENT_ACTIONS: [applied_entry(applied_op, mqry.REJECTED), later]}]
+    mock_read.side_effect = read
+    [result] = mqry.apply_actions(
+        [{'_id': TEST_MANU_ID, flds.STATE: mqry.SUBMITTED, flds.ACTION: mqry.REJECT}], ['editor'])
+    assert result[mqry.RESULT] == mqry.APPLIED
+    assert result[flds.STATE] == mqry.REJECTED
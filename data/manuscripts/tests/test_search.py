@@ -0,0 +1,76 @@
+import pytest
+
+import data.manuscripts.fields as flds
+import data.manuscripts.search as search
+
+
+def make_index():
+    index = search.InvertedIndex()
+    index.add('1', {flds.TITLE: 'Graph algorithms', flds.CONTENT: 'shortest paths'})
+    index.add('2', {flds.TITLE: 'Cooking', flds.ABSTRACT: 'graph of recipes'})
+    index.add('3', {flds.TITLE: 'Poetry', flds.CONTENT: 'no match here'})
+    return index
+
+
+def test_tokenize():
+    assert search.tokenize('The Graph, of GRAPHS!') == ['graph', 'graphs']
+    assert search.tokenize(None) == []
+
+
+def test_search_ranks_title_matches_first():
+    hits = make_index().search('graph')
+    assert [doc_id for doc_id, _ in hits] == ['1', '2']
+    assert hits[0][1] > hits[1][1]
+
+
+def test_search_no_match():
+    index = make_index()
+    assert index.search('chemistry') == []
+    assert index.search('the') == []
+
+
+def test_search_limit():
+    assert len(make_index().search('graph', limit=1)) == 1
+
+
+def test_add_replaces():
+    index = make_index()
+    index.add('1', {flds.TITLE: 'Chemistry'})
+    assert [doc_id for doc_id, _ in index.search('graph')] == ['2']
+    assert index.search('chemistry')[0][0] == '1'
+    assert len(index) == 3
+
+
+def test_remove():
+    index = make_index()
+    index.remove('2')
+    index.remove('no such doc')
+    assert 'recipes' not in index.postings
+    assert [doc_id for doc_id, _ in index.search('graph')] == ['1']
+
+
+def test_search_keeps_common_term_only_matches():
+    index = search.InvertedIndex()
+    for i in range(20):
+        index.add(str(i), {flds.TITLE: 'graph' if i < 10 else 'poetry'})
+    index.add('rare', {flds.TITLE: 'graph colouring'})
+    hits = index.search('graph colouring', limit=5)
+    assert hits[0][0] == 'rare'
+    assert len(hits) == 5
+
+
+def test_search_pruning_does_not_change_results(monkeypatch):
+    index = search.InvertedIndex()
+    for doc_id, doc in search.synthetic_manuscripts(300, vocab_size=500):
+        index.add(doc_id, doc)
+    queries = ['w0 w400', 'w1 w2 w450', 'w3 w499', 'w0 w1']
+    pruned = [index.search(query, limit=10) for query in queries]
+    monkeypatch.setattr(search, 'COMMON_TERM_SHARE', 1.0)
+    for query, hits in zip(queries, pruned):
+        expected = index.search(query, limit=10)
+        assert [doc_id for doc_id, _ in hits] == [doc_id for doc_id, _ in expected]
+        assert [score for _, score in hits] == pytest.approx([score for _, score in expected])
+
+
+def test_benchmark_runs():
+    search.benchmark(num_docs=200, num_queries=5)
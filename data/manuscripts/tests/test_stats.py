@@ -0,0 +1,75 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import data.manuscripts.stats as stats
+
+ENTERED = datetime(2024, 1, 1)
+LEFT = datetime(2024, 1, 2)
+
+
+def test_entered():
+    assert stats.entered(ENTERED) == {
+        stats.COUNT: 1,
+        stats.TIMED: 1,
+        stats.SINCE_TOTAL: stats.to_seconds(ENTERED),
+    }
+    assert stats.entered('not a date', count=3) == {stats.COUNT: 3}
+
+
+def test_left():
+    assert stats.left(ENTERED, LEFT) == {
+        stats.COUNT: -1,
+        stats.TIMED: -1,
+        stats.SINCE_TOTAL: -stats.to_seconds(ENTERED),
+        stats.EXITS: 1,
+        stats.EXIT_SECONDS: 24 * 60 * 60,
+    }
+    assert stats.left(None, LEFT) == {stats.COUNT: -1}
+    assert stats.EXITS not in stats.left(ENTERED)
+
+
+def test_merge():
+    incs = {}
+    stats.merge(incs, 'SUB', stats.entered(ENTERED))
+    stats.merge(incs, 'SUB', stats.entered(LEFT))
+    assert incs['SUB'][stats.COUNT] == 2
+    assert incs['SUB'][stats.SINCE_TOTAL] == stats.to_seconds(ENTERED) + stats.to_seconds(LEFT)
+
+
+@patch('data.db_connect.bulk_write', autospec=True)
+def test_record_transition(mock_write):
+    stats.record_transition('SUB', ENTERED, 'REV', LEFT)
+    ops = mock_write.call_args.args[1]
+    assert [op._filter for op in ops] == [{'_id': 'SUB'}, {'_id': 'REV'}]
+    assert ops[0]._doc['$inc'][stats.EXIT_SECONDS] == 24 * 60 * 60
+
+
+@patch('data.db_connect.bulk_write', autospec=True)
+def test_record_transition_same_state(mock_write):
+    stats.record_transition('REV', ENTERED, 'REV', LEFT)
+    mock_write.assert_not_called()
+
+
+def test_summarize():
+    doc = {
+        stats.COUNT: 2,
+        stats.TIMED: 2,
+        stats.SINCE_TOTAL: 100 + 200,
+        stats.EXITS: 4,
+        stats.EXIT_SECONDS: 40,
+    }
+    summary = stats.summarize(doc, now=1000)
+    assert summary[stats.AVG_SECONDS_IN_STATE] == 850
+    assert summary[stats.AVG_SECONDS_PER_EXIT] == 10
+    empty = stats.summarize({}, now=1000)
+    assert empty[stats.COUNT] == 0
+    assert empty[stats.AVG_SECONDS_IN_STATE] is None
+
+
+@patch('data.db_connect.bulk_write', autospec=True)
+@patch('data.db_connect.aggregate', autospec=True,
+       return_value=[{'_id': 'SUB', stats.COUNT: 3, stats.TIMED: 1, stats.SINCE_TOTAL: 5}])
+def test_rebuild(mock_agg, mock_write):
+    counts = stats.rebuild('manuscripts', ['SUB', 'REV'])
+    assert counts == {'SUB': 3, 'REV': 0}
+    assert len(mock_write.call_args.args[1]) == 2
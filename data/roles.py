@@ -14,6 +14,21 @@ class Role(Enum):
 
 MH_ROLES = [Role.EDITOR, Role.CONSULTING_EDITOR, Role.MANAGING_EDITOR]
 
+# Each role is one bit, so a set of roles is an int and "does any of the
+# user's roles allow this" is one bitwise and.
+ROLE_BITS = {role.value: 1 << i for i, role in enumerate(Role)}
+ALL_ROLES_MASK = (1 << len(Role)) - 1
+
+
+def role_mask(roles) -> int:
+    """
+    The bitmask of a list of role values; unknown roles are ignored.
+    """
+    mask = 0
+    for role in roles or ():
+        mask |= ROLE_BITS.get(role, 0)
+    return mask
+
 
 def read() -> dict:
     return {role.name: role.value for role in Role}
@@ -26,8 +41,9 @@ def get_roles() -> dict:
 def get_masthead_roles() -> dict:
     mh_roles = get_roles()
     del_mh_roles = []
+    mh_role_names = {role.name for role in MH_ROLES}
     for role in mh_roles:
-        if role not in MH_ROLES:
+        if role not in mh_role_names:
             del_mh_roles.append(role)
     for del_role in del_mh_roles:
         del mh_roles[del_role]
@@ -0,0 +1,65 @@
+from unittest.mock import patch
+
+import data.cache as cache
+
+TEST_TTL = 60
+
+
+def test_get_missing():
+    test_cache = cache.TTLCache()
+    assert test_cache.get('key') is cache.MISSING
+    assert test_cache.get('key', None) is None
+    assert test_cache.stats()[cache.MISSES] == 2
+
+
+def test_set_and_get():
+    test_cache = cache.TTLCache()
+    test_cache.set('key', 'value', TEST_TTL)
+    assert test_cache.get('key') == 'value'
+    assert test_cache.stats()[cache.HITS] == 1
+
+
+def test_expiry():
+    test_cache = cache.TTLCache()
+    with patch('time.monotonic', return_value=100):
+        test_cache.set('key', 'value', TEST_TTL)
+    with patch('time.monotonic', return_value=100 + TEST_TTL):
+        assert test_cache.get('key') is cache.MISSING
+    assert test_cache.stats()[cache.SIZE] == 0
+
+
+def test_lru_eviction():
+    test_cache = cache.TTLCache(max_size=2)
+    test_cache.set('a', 1, TEST_TTL)
+    test_cache.set('b', 2, TEST_TTL)
+    test_cache.get('a')  # 'b' is now the least recently used
+    test_cache.set('c', 3, TEST_TTL)
+    assert test_cache.get('b') is cache.MISSING
+    assert test_cache.get('a') == 1
+    assert test_cache.get('c') == 3
+    assert test_cache.stats()[cache.EVICTIONS] == 1
+
+
+def test_invalidate_group():
+    test_cache = cache.TTLCache()
+    test_cache.set('a', 1, TEST_TTL, group='users')
+    test_cache.set('b', 2, TEST_TTL, group='texts')
+    test_cache.invalidate('users')
+    assert test_cache.get('a') is cache.MISSING
+    assert test_cache.get('b') == 2
+
+
+def test_set_after_invalidation_is_skipped():
+    test_cache = cache.TTLCache()
+    generation = test_cache.generation
+    test_cache.invalidate('users')  # e.g. a write while we were fetching
+    test_cache.set('a', 'stale', TEST_TTL, group='users', generation=generation)
+    assert test_cache.get('a') is cache.MISSING
+    test_cache.set('a', 'fresh', TEST_TTL, group='users', generation=test_cache.generation)
+    assert test_cache.get('a') == 'fresh'
+
+
+def test_disabled():
+    test_cache = cache.TTLCache(max_size=0)
+    test_cache.set('a', 1, TEST_TTL)
+    assert test_cache.get('a') is cache.MISSING
@@ -0,0 +1,293 @@
+import hashlib
+import io
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from bson import ObjectId
+
+import data.db_connect as dbc
+from data.cache import SIZE
+
+TEST_COLLECT = 'test_collection'
+
+
+@pytest.fixture
+def mock_client():
+    """
+    Replace the module's client with a mock whose find() returns `docs`.
+    """
+    client = MagicMock()
+    with patch('data.db_connect.client', client):
+        yield client
+
+
+def set_find_result(client, docs):
+    cursor = client[dbc.WEMA_DB][TEST_COLLECT].find.return_value
+    cursor.sort.return_value.limit.return_value = iter(docs)
+    return client[dbc.WEMA_DB][TEST_COLLECT].find
+
+
+def test_page_token_round_trip():
+    last_id = ObjectId()
+    last_key = datetime(2024, 9, 24, 12, 30)
+    token = dbc.encode_page_token(last_key, last_id)
+    assert isinstance(token, str)
+    assert dbc.decode_page_token(token) == (last_key, last_id)
+
+
+def test_bad_page_token():
+    with pytest.raises(ValueError):
+        dbc.decode_page_token('not a token')
+
+
+def test_after_filter_on_id():
+    last_id = ObjectId()
+    assert dbc._after_filter(dbc.MONGO_ID, last_id, last_id, False) == \
+        {dbc.MONGO_ID: {'$gt': last_id}}
+    assert dbc._after_filter(dbc.MONGO_ID, last_id, last_id, True) == \
+        {dbc.MONGO_ID: {'$lt': last_id}}
+
+
+def test_after_filter_on_key_breaks_ties_on_id():
+    last_id = ObjectId()
+    filt = dbc._after_filter('date', 'd', last_id, False)
+    assert filt == {'$or': [{'date': {'$gt': 'd'}},
+                            {'date': 'd', dbc.MONGO_ID: {'$gt': last_id}}]}
+
+
+def test_read_page_last_page(mock_client):
+    docs = [{dbc.MONGO_ID: ObjectId(), 'n': i} for i in range(3)]
+    find = set_find_result(mock_client, docs)
+    page, next_token = dbc.read_page(TEST_COLLECT, limit=5)
+    assert next_token is None
+    assert [doc['n'] for doc in page] == [0, 1, 2]
+    assert dbc.MONGO_ID not in page[0]
+    find.assert_called_once_with({}, None)
+
+
+def test_read_page_has_next(mock_client):
+    ids = [ObjectId() for i in range(3)]
+    set_find_result(mock_client, [{dbc.MONGO_ID: _id} for _id in ids])
+    page, next_token = dbc.read_page(TEST_COLLECT, limit=2, no_id=False)
+    assert len(page) == 2
+    assert page[1][dbc.MONGO_ID] == str(ids[1])
+    assert dbc.decode_page_token(next_token) == (ids[1], ids[1])
+
+    # asking for the next page filters on the last _id seen
+    find = set_find_result(mock_client, [])
+    dbc.read_page(TEST_COLLECT, limit=2, after=next_token)
+    find.assert_called_with({dbc.MONGO_ID: {'$gt': ids[1]}}, None)
+
+
+def test_read_page_keeps_sort_key_in_projection(mock_client):
+    find = set_find_result(mock_client, [])
+    dbc.read_page(TEST_COLLECT, sort_key='date', projection={'title': 1})
+    find.assert_called_once_with({}, {'title': 1, 'date': 1})
+
+
+def prepare_even(item):
+    if item % 2:
+        raise ValueError(f'{item} is odd')
+    return {'n': item}
+
+
+def test_prepare_bulk_unordered():
+    docs, positions, errors = dbc.prepare_bulk([0, 1, 2, 3], prepare_even, ordered=False)
+    assert docs == [{'n': 0}, {'n': 2}]
+    assert positions == [0, 2]
+    assert [err[dbc.INDEX] for err in errors] == [1, 3]
+
+
+def test_prepare_bulk_ordered_stops_at_first_error():
+    docs, positions, errors = dbc.prepare_bulk([0, 1, 2], prepare_even, ordered=True)
+    assert docs == [{'n': 0}]
+    assert [err[dbc.INDEX] for err in errors] == [1]
+
+
+def test_merge_bulk_errors_maps_indices():
+    result = {dbc.INSERTED: 1, dbc.ERRORS: [{dbc.INDEX: 1, dbc.CODE: 11000, dbc.MESSAGE: 'dup'}]}
+    validation_errors = [{dbc.INDEX: 1, dbc.CODE: None, dbc.MESSAGE: 'bad'}]
+    merged = dbc.merge_bulk_errors(result, [0, 2, 3], validation_errors)
+    assert [err[dbc.INDEX] for err in merged[dbc.ERRORS]] == [1, 2]
+
+
+def test_succeeded():
+    errors = [{dbc.INDEX: 2}]
+    assert dbc.succeeded(4, errors, ordered=True) == [0, 1]
+    assert dbc.succeeded(4, errors, ordered=False) == [0, 1, 3]
+    assert dbc.succeeded(2, [], ordered=True) == [0, 1]
+
+
+def test_bulk_create_reports_write_errors(mock_client):
+    insert_many = mock_client[dbc.WEMA_DB][TEST_COLLECT].insert_many
+    insert_many.side_effect = dbc.BulkWriteError({
+        'nInserted': 1,
+        'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key'}],
+    })
+    result = dbc.bulk_create(TEST_COLLECT, [{'n': 0}, {'n': 0}], ordered=False)
+    assert result[dbc.INSERTED] == 1
+    assert result[dbc.ERRORS] == [{dbc.INDEX: 1, dbc.CODE: 11000, dbc.MESSAGE: 'E11000 duplicate key'}]
+    insert_many.assert_called_once_with([{'n': 0}, {'n': 0}], ordered=False)
+
+
+def test_bulk_create_nothing_to_do(mock_client):
+    assert dbc.bulk_create(TEST_COLLECT, []) == {dbc.INSERTED: 0, dbc.ERRORS: []}
+    mock_client[dbc.WEMA_DB][TEST_COLLECT].insert_many.assert_not_called()
+
+
+def test_bulk_upsert_insert_only(mock_client):
+    bulk_write = mock_client[dbc.WEMA_DB][TEST_COLLECT].bulk_write
+    bulk_write.return_value.bulk_api_result = {'nUpserted': 1}
+    dbc.bulk_upsert(TEST_COLLECT, [{'k': 1, 'name': 'a', 'secret': 's'}], 'k',
+                    insert_only=('secret',))
+    [op], = bulk_write.call_args.args
+    assert op._filter == {'k': 1}
+    assert op._doc == {'$set': {'k': 1, 'name': 'a'}, '$setOnInsert': {'secret': 's'}}
+    assert op._upsert
+
+
+@pytest.fixture
+def cached_collection():
+    dbc.read_cache.clear()
+    dbc.cache_collection(TEST_COLLECT, 60)
+    yield TEST_COLLECT
+    del dbc.cache_ttls[(dbc.WEMA_DB, TEST_COLLECT)]
+    del dbc.cache_private[(dbc.WEMA_DB, TEST_COLLECT)]
+    dbc.read_cache.clear()
+
+
+def test_fetch_one_is_cached(mock_client, cached_collection):
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+    find_one.return_value = {'key': 'a', 'title': 'A'}
+    first = dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    first['title'] = 'changed by caller'
+    assert dbc.fetch_one(TEST_COLLECT, {'key': 'a'}) == {'key': 'a', 'title': 'A'}
+    find_one.assert_called_once()
+
+    # a different filter is a different entry
+    dbc.fetch_one(TEST_COLLECT, {'key': 'b'})
+    assert find_one.call_count == 2
+
+
+def test_fetch_one_uncached(mock_client, cached_collection):
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+    find_one.return_value = {'key': 'a'}
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'}, cached=False)
+    assert find_one.call_count == 2
+
+
+def test_write_invalidates_cache(mock_client, cached_collection):
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+    find_one.return_value = {'key': 'a'}
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    dbc.update_doc(TEST_COLLECT, {'key': 'a'}, {'title': 'B'})
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    assert find_one.call_count == 2
+
+
+def test_read_racing_a_write_is_not_cached(mock_client, cached_collection):
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+
+    def stale_read(filt, projection):
+        dbc.invalidate_cache(TEST_COLLECT)  # another thread writes meanwhile
+        return {'key': 'a', 'title': 'old'}
+    find_one.side_effect = stale_read
+    assert dbc.fetch_one(TEST_COLLECT, {'key': 'a'}) == {'key': 'a', 'title': 'old'}
+    find_one.side_effect = None
+    find_one.return_value = {'key': 'a', 'title': 'new'}
+    assert dbc.fetch_one(TEST_COLLECT, {'key': 'a'}) == {'key': 'a', 'title': 'new'}
+
+
+def test_private_fields_are_not_cached(mock_client, cached_collection):
+    dbc.cache_collection(TEST_COLLECT, 60, private=['secret'])
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+    find_one.return_value = {'key': 'a', 'secret': 's'}
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    assert find_one.call_count == 2
+    assert dbc.read_cache.stats()[SIZE] == 0
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'}, projection={'secret': 0})
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'}, projection={'secret': 0})
+    assert find_one.call_count == 3
+
+
+def test_may_return():
+    assert dbc.may_return(None, {'secret'})
+    assert dbc.may_return({'_id': 0}, {'secret'})
+    assert not dbc.may_return({'secret': 0}, {'secret'})
+    assert dbc.may_return({'secret': 1}, {'secret'})
+    assert not dbc.may_return({'name': 1, '_id': 1}, {'secret'})
+    assert not dbc.may_return(None, frozenset())
+
+
+def test_uncached_collection(mock_client):
+    find_one = mock_client[dbc.WEMA_DB][TEST_COLLECT].find_one
+    find_one.return_value = None
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    dbc.fetch_one(TEST_COLLECT, {'key': 'a'})
+    assert find_one.call_count == 2
+
+
+def test_hashing_reader():
+    reader = dbc._HashingReader(io.BytesIO(b'some file'))
+    while reader.read(4):
+        pass
+    assert reader.length == len(b'some file')
+    assert reader.hash.hexdigest() == hashlib.sha256(b'some file').hexdigest()
+
+
+@patch('data.db_connect.get_bucket', autospec=True)
+def test_put_file_dedups_by_hash(mock_bucket):
+    new_id, old_id = ObjectId(), ObjectId()
+    grid = mock_bucket.return_value
+    grid.upload_from_stream.side_effect = lambda name, reader, **kw: (reader.read(), new_id)[1]
+    client = MagicMock()
+    files = client[dbc.WEMA_DB][f'{dbc.FILES_BUCKET}.files']
+    files.find_one_and_update.return_value = {dbc.MONGO_ID: old_id}
+    with patch.object(dbc, 'client', client):
+        info = dbc.put_file(io.BytesIO(b'abc'), 'a.txt')
+    grid.delete.assert_called_once_with(new_id)
+    assert info[dbc.FILE_ID] == str(old_id)
+    assert info[dbc.LENGTH] == 3
+    # the old file is only reused if it still has references, and gets one more
+    filt, update = files.find_one_and_update.call_args.args[:2]
+    assert filt[dbc.FILE_REFS] == {'$gt': 0}
+    assert update == {'$inc': {dbc.FILE_REFS: 1}}
+
+
+@patch('data.db_connect.get_bucket', autospec=True)
+def test_put_file_new_file_has_one_reference(mock_bucket):
+    new_id = ObjectId()
+    mock_bucket.return_value.upload_from_stream.return_value = new_id
+    client = MagicMock()
+    files = client[dbc.WEMA_DB][f'{dbc.FILES_BUCKET}.files']
+    files.find_one_and_update.return_value = None
+    with patch.object(dbc, 'client', client):
+        dbc.put_file(io.BytesIO(b'abc'), 'a.txt')
+    update = files.update_one.call_args.args[1]
+    assert update['$set'][dbc.FILE_REFS] == 1
+
+
+@pytest.mark.parametrize('after, deleted', [
+    ({'metadata': {dbc.REFS: 1}}, False),
+    ({'metadata': {dbc.REFS: 0}}, True),
+    (None, None),  # stored before references were counted
+])
+@patch('data.db_connect.delete_file', autospec=True, return_value=True)
+def test_release_file(mock_delete, after, deleted, mock_client):
+    file_id = str(ObjectId())
+    files = mock_client[dbc.WEMA_DB][f'{dbc.FILES_BUCKET}.files']
+    files.find_one_and_update.return_value = after
+    assert dbc.release_file(file_id) is deleted
+    assert mock_delete.called == bool(deleted)
+
+
+def test_parse_date():
+    assert dbc.parse_date('2024-09-24 10:30:00') == datetime(2024, 9, 24, 10, 30)
+    assert dbc.parse_date('2024-09-24') == datetime(2024, 9, 24)
+    est = timezone(timedelta(hours=-5))
+    assert dbc.parse_date(datetime(2024, 9, 24, 10, tzinfo=est)) == datetime(2024, 9, 24, 15)
+    with pytest.raises(ValueError):
+        dbc.parse_date('today')
@@ -10,4 +10,20 @@ def test_get_roles():
     # assert all dictionary keys and items are strings
     for code, role in all_roles.items():
         assert isinstance(code, str)
-        assert isinstance(role, str)
\ No newline at end of file
+        assert isinstance(role, str)
+
+
+def test_get_masthead_roles():
+    mh_roles = roles.get_masthead_roles()
+    assert set(mh_roles.values()) == {role.value for role in roles.MH_ROLES}
+
+
+def test_role_mask():
+    assert roles.role_mask([]) == 0
+    assert roles.role_mask(None) == 0
+    assert roles.role_mask(['no such role']) == 0
+    editor = roles.role_mask([roles.Role.EDITOR.value])
+    author = roles.role_mask([roles.Role.AUTHOR.value])
+    assert editor & author == 0
+    assert roles.role_mask([roles.Role.EDITOR.value, roles.Role.AUTHOR.value]) == editor | author
+    assert roles.role_mask([role.value for role in roles.Role]) == roles.ALL_ROLES_MASK
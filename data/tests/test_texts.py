@@ -200,3 +200,22 @@ def test_update_both_fields(mock_update_doc, mock_read_one, mock_db, test_data):
         {texts.KEY: test_data["key"]}, 
         {texts.TITLE: "Updated Title", texts.TEXT: "Updated text content."}
     )
+
+
+@patch('data.db_connect.bulk_create')
+def test_bulk_create_skips_invalid_records(mock_bulk_create, mock_db, test_data):
+    """Test that invalid records are reported by index and not written."""
+    mock_bulk_create.return_value = {'inserted': 1, 'errors': []}
+    records = [{texts.KEY: "no title"}, test_data["entry"]]
+    result = texts.bulk_create(records, ordered=False)
+    mock_bulk_create.assert_called_once_with(texts.COLLECTION, [test_data["entry"]], ordered=False)
+    assert [err['index'] for err in result['errors']] == [0]
+
+
+@patch('data.db_connect.bulk_create')
+def test_bulk_create_skips_non_object_records(mock_bulk_create, mock_db, test_data):
+    """Test that a record that isn't an object fails by itself."""
+    mock_bulk_create.return_value = {'inserted': 1, 'errors': []}
+    result = texts.bulk_create([["x"], test_data["entry"]], ordered=False)
+    mock_bulk_create.assert_called_once_with(texts.COLLECTION, [test_data["entry"]], ordered=False)
+    assert [err['index'] for err in result['errors']] == [0]
@@ -1,5 +1,8 @@
+from unittest.mock import patch
+
 import pytest
 
+import data.db_connect as dbc
 import data.users as users
 from data.users import get_user
 
@@ -39,7 +42,59 @@ def test_add_new_user():
     result = users.create_user(
         name="Bill", email="bill@nyu.edu", password="password12", role="Author", affiliation="NYU"
     )
-    assert "bill@nyu.edu" in result, "The new user 'bill@nyu.edu' should be added."
+    assert result[users.EMAIL] == "bill@nyu.edu", "The new user 'bill@nyu.edu' should be added."
+    assert users.PASSWORD not in result
+    assert "bill@nyu.edu" in users.get_users_as_dict()
+
+
+def test_add_duplicate_user_raises_error():
+    users.create_user(
+        name="Bill", email="bill@nyu.edu", password="password12", role="Author", affiliation="NYU"
+    )
+    with pytest.raises(users.DuplicateUserError, match="Duplicate email"):
+        users.create_user(
+            name="Bill", email="bill@nyu.edu", password="password12", role="Author", affiliation="NYU"
+        )
+
+
+@patch('data.db_connect.fetch_one')
+@patch('data.db_connect.read')
+@patch('data.db_connect.create')
+def test_create_user_single_round_trip(mock_create, mock_read, mock_fetch_one):
+    result = users.create_user(
+        name="Bill", email="bill@nyu.edu", password="password12", role="author", affiliation="NYU"
+    )
+    mock_create.assert_called_once()
+    mock_read.assert_not_called()
+    mock_fetch_one.assert_not_called()
+    assert result == {
+        users.NAME: "Bill",
+        users.EMAIL: "bill@nyu.edu",
+        users.ROLES: ["author"],
+        users.AFFILIATION: "NYU",
+    }
+
+
+@patch('data.db_connect.create', side_effect=dbc.DuplicateKeyError("E11000"))
+def test_create_user_duplicate_key_is_reported(mock_create):
+    with pytest.raises(users.DuplicateUserError, match="Duplicate email") as err:
+        users.create_user(
+            name="Bill", email="bill@nyu.edu", password="password12", role="author", affiliation="NYU"
+        )
+    assert isinstance(err.value.__cause__, dbc.DuplicateKeyError)
+
+
+@patch('security.passwords.hash_passwords', autospec=True, side_effect=lambda pws: ['h'] * len(pws))
+@patch('data.db_connect.bulk_create', autospec=True,
+       return_value={dbc.INSERTED: 1, dbc.ERRORS: []})
+def test_bulk_create_users_bad_types_fail_their_record(mock_bulk, mock_hash):
+    good = {"name": "Bill", "email": "bill@nyu.edu", "password": "password12", "affiliation": "NYU"}
+    records = [{**good, "email": "ann@nyu.edu", "password": 12345678}, good, "not a record"]
+    result = users.bulk_create_users(records, ordered=False)
+    assert [err[dbc.INDEX] for err in result[dbc.ERRORS]] == [0, 2]
+    mock_hash.assert_called_once_with(["password12"])
+    docs = mock_bulk.call_args.args[1]
+    assert [doc[users.EMAIL] for doc in docs] == ["bill@nyu.edu"]
 
 
 def test_valid_email_adds_new_user():
@@ -157,3 +212,112 @@ def clean_test_database():
 #         assert result['email'] == 'alice@nyu.edu'
 #         # Check if the mocked function was called with the correct arguments
 #         mock_get_user.assert_called_once_with('alice@nyu.edu')
+
+
+@patch('data.db_connect.aggregate', autospec=True, return_value=[
+    {'_id': 'editor', 'people': [{'name': 'Ed', 'affiliation': 'NYU'}]},
+])
+def test_get_masthead_is_memoized(mock_aggregate):
+    users.invalidate_masthead()
+    masthead = users.get_masthead()
+    assert masthead['editor'] == [{'name': 'Ed', 'affiliation': 'NYU'}]
+    assert masthead['managing editor'] == []
+    users.get_masthead()
+    mock_aggregate.assert_called_once()
+
+    # a user write rebuilds the masthead
+    users.invalidate_masthead()
+    users.get_masthead()
+    assert mock_aggregate.call_count == 2
+
+
+@patch('data.db_connect.read', autospec=True, return_value=[
+    {'name': 'Ref', 'email': 'ref@nyu.edu', 'roles': ['referee'], 'affiliation': 'NYU'},
+])
+def test_get_users_by_role_filters_in_db(mock_read):
+    matched = users.get_users_by_role(['referee', 'editor'])
+    assert [user.email for user in matched] == ['ref@nyu.edu']
+    mock_read.assert_called_once_with(users.USER_COLLECT, projection=users.PUBLIC_PROJECTION,
+                                      filt={users.ROLES: {'$in': ['referee', 'editor']}})
+
+
+@patch('data.db_connect.read', autospec=True, return_value=[])
+def test_get_users_by_role_ignores_case(mock_read):
+    users.get_users_by_role('Referee')
+    assert mock_read.call_args.kwargs['filt'] == {users.ROLES: {'$in': ['referee']}}
+
+
+def test_get_users_by_bad_role():
+    with pytest.raises(ValueError, match="Invalid role"):
+        users.get_users_by_role("not a role")
+
+
+@patch('data.db_connect.aggregate', autospec=True, return_value=[{'_id': 'referee', 'count': 2}])
+def test_count_users_by_role(mock_aggregate):
+    assert users.count_users_by_role(['referee', 'author']) == {'referee': 2, 'author': 0}
+
+
+@patch('data.users.get_user', autospec=True,
+       return_value=users.User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_get_principal_is_cached(mock_get_user):
+    users.principal_cache.clear()
+    principal = users.get_principal('ed@nyu.edu', 1000)
+    assert principal == {users.EMAIL: 'ed@nyu.edu', users.ROLES: ['editor']}
+    assert users.get_principal('ed@nyu.edu', 1000) == principal
+    assert mock_get_user.call_count == 1
+    # A token issued at another time is resolved afresh.
+    users.get_principal('ed@nyu.edu', 2000)
+    assert mock_get_user.call_count == 2
+    users.invalidate_principal('ed@nyu.edu')
+    users.get_principal('ed@nyu.edu', 1000)
+    assert mock_get_user.call_count == 3
+    # other processes' role changes can't hide behind the read cache
+    mock_get_user.assert_called_with('ed@nyu.edu', cached=False)
+    users.principal_cache.clear()
+
+
+@patch('data.users.get_user', autospec=True,
+       return_value=users.User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_get_principal_expires(mock_get_user):
+    users.principal_cache.clear()
+    with patch('data.cache.time.monotonic', return_value=0):
+        users.get_principal('ed@nyu.edu', 1000)
+    with patch('data.cache.time.monotonic', return_value=users.PRINCIPAL_TTL):
+        users.get_principal('ed@nyu.edu', 1000)
+    assert mock_get_user.call_count == 2
+    users.principal_cache.clear()
+
+
+@patch('data.users.get_user', autospec=True, return_value=None)
+def test_get_principal_no_such_user(mock_get_user):
+    users.principal_cache.clear()
+    assert users.get_principal('nobody@nyu.edu') is None
+    assert users.get_principal('nobody@nyu.edu') is None
+    assert mock_get_user.call_count == 2
+
+
+@patch('data.db_connect.delete', autospec=True)
+@patch('data.users.get_user', autospec=True,
+       return_value=users.User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_delete_user_drops_principal(mock_get_user, mock_delete):
+    users.principal_cache.clear()
+    users.get_principal('ed@nyu.edu')
+    users.delete_user('ed@nyu.edu')
+    users.get_principal('ed@nyu.edu')
+    assert mock_get_user.call_count == 3  # get_principal, delete_user, get_principal
+    users.principal_cache.clear()
+
+
+@patch('data.db_connect.update_doc', autospec=True)
+@patch('security.passwords.check_password', autospec=True, return_value=(True, 'new hash'))
+def test_check_password_stores_rehash(mock_check, mock_update):
+    assert users.check_password('ed@nyu.edu', 'old hash', 'password12')
+    mock_update.assert_called_once_with(users.USER_COLLECT, {users.EMAIL: 'ed@nyu.edu'},
+                                        {users.PASSWORD: 'new hash'})
+
+
+@patch('data.db_connect.update_doc', autospec=True)
+@patch('security.passwords.check_password', autospec=True, return_value=(False, None))
+def test_check_password_wrong(mock_check, mock_update):
+    assert not users.check_password('ed@nyu.edu', 'old hash', 'wrong')
+    mock_update.assert_not_called()
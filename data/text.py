@@ -7,8 +7,26 @@ EMAIL = 'email'
 
 COLLECTION = 'texts'
 
+# Texts rarely change, so cache reads of them (in seconds):
+CACHE_TTL = 300
+
 client = dbc.connect_db()
 print(f'{client=}')
+dbc.cache_collection(COLLECTION, CACHE_TTL)
+
+
+def ensure_indexes():
+    """
+    Create (or verify) the unique index on text keys.
+    """
+    try:
+        dbc.create_index(COLLECTION, KEY, unique=True)
+    except Exception as e:
+        print(f"Error creating text indexes: {e}")
+
+
+if client:
+    ensure_indexes()
 
 
 def read_texts():
@@ -21,6 +39,21 @@ def read_texts():
     return dbc.read(COLLECTION)
 
 
+def stream_texts(batch_size: int = dbc.DEFAULT_BATCH_SIZE):
+    """
+    Lazily yield every text entry, one cursor batch at a time.
+    """
+    return dbc.read_iter(COLLECTION, batch_size=batch_size)
+
+
+def read_texts_page(limit: int = dbc.DEFAULT_PAGE_SIZE, after: str = None) -> tuple:
+    """
+    Read one page of text entries, in insertion order.
+    Returns (texts, next_token); pass next_token back as `after`.
+    """
+    return dbc.read_page(COLLECTION, limit=limit, after=after)
+
+
 def read_one(key: str) -> dict:
     """
     Read a single text entry by key.
@@ -56,6 +89,36 @@ def create(key: str, title: str, text: str):
         raise
 
 
+def prepare_text(record: dict) -> dict:
+    """
+    Build the document to store for one record of a bulk import.
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"Not a text record: {record!r}")
+    if not record.get(KEY) or not record.get(TITLE) or TEXT not in record:
+        raise ValueError("Missing required fields")
+    return {
+        KEY: str(record[KEY]),
+        TITLE: str(record[TITLE]),
+        TEXT: str(record[TEXT]),
+    }
+
+
+def bulk_create(records: list, ordered: bool = True, upsert: bool = False) -> dict:
+    """
+    Create (or, with upsert, create or update by key) many text entries in
+    one round trip.
+    Returns the write counts and per-record errors, indexed by position
+    in records.
+    """
+    docs, positions, errors = dbc.prepare_bulk(records, prepare_text, ordered)
+    if upsert:
+        result = dbc.bulk_upsert(COLLECTION, docs, KEY, ordered=ordered)
+    else:
+        result = dbc.bulk_create(COLLECTION, docs, ordered=ordered)
+    return dbc.merge_bulk_errors(result, positions, errors)
+
+
 def delete(key):
     """
     Delete a text entry from the database.
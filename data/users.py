@@ -2,13 +2,14 @@
 This module interfaces to our user data.
 """
 
+import copy
 import re
 from typing import Optional
 
-from werkzeug.security import generate_password_hash
-
 import data.db_connect as dbc
 import data.roles as rls
+import security.passwords as passwords
+from data.cache import MISSING, TTLCache
 from data.roles import is_valid_role, get_roles
 
 LEVEL = "level"
@@ -22,8 +23,41 @@ ROLE = 'role'
 ROLES = 'roles'
 PASSWORD = 'password'
 
+# Everything but the password hash, for reads that only display users.
+PUBLIC_PROJECTION = {PASSWORD: 0}
+
+# How long (in seconds) user reads are cached; our own writes invalidate
+# the cache immediately. Reads that include the password hash (logins)
+# always go to the db.
+CACHE_TTL = 30
+
+# Who a bearer token belongs to is resolved once per token and kept for
+# PRINCIPAL_TTL seconds. Role updates and deletions drop it at once in
+# the process that makes them; other processes see them within
+# PRINCIPAL_TTL, since principals are looked up past the read cache.
+PRINCIPAL_TTL = 10
+PRINCIPAL_CACHE_SIZE = 4096
+principal_cache = TTLCache(max_size=PRINCIPAL_CACHE_SIZE)
+
 client = dbc.connect_db()
 print(f'{client=}')
+dbc.cache_collection(USER_COLLECT, CACHE_TTL, private=[PASSWORD])
+
+
+def ensure_indexes():
+    """
+    Create (or verify) the indexes the user queries rely on.
+    Email is our unique identifier, so single-user lookups are point reads.
+    """
+    try:
+        dbc.create_index(USER_COLLECT, EMAIL, unique=True)
+        dbc.create_index(USER_COLLECT, ROLES)  # multikey: one entry per role
+    except Exception as e:
+        print(f"Error creating user indexes: {e}")
+
+
+if client:
+    ensure_indexes()
 
 
 class User:
@@ -60,20 +94,24 @@ class User:
         }
 
 
+def to_user(user: dict) -> User:
+    """
+    Build a User object from a raw user document.
+    """
+    return User(
+        name=user.get(NAME, ""),
+        email=user[EMAIL],
+        affiliation=user.get(AFFILIATION, ""),
+        roles=user.get(ROLES, []),
+    )
+
+
 def get_users() -> list[User]:
     """
     Retrieve all users from the database and return them as User objects.
     """
-    db_users = dbc.read(USER_COLLECT)  # Fetch all user docs from the DB.
-    return [
-        User(
-            name=user.get(NAME, ""),
-            email=user[EMAIL],
-            affiliation=user.get(AFFILIATION, ""),
-            roles=user.get(ROLES, []),
-        )
-        for user in db_users
-    ]
+    db_users = dbc.read(USER_COLLECT, projection=PUBLIC_PROJECTION)
+    return [to_user(user) for user in db_users]
 
 
 def get_users_raw():
@@ -89,7 +127,7 @@ def get_users_as_dict() -> dict:
     keyed by user email for JSON parsing.
     """
     try:
-        db_users = dbc.read(USER_COLLECT)  # Fetch all user docs from the db.
+        db_users = dbc.read(USER_COLLECT, projection=PUBLIC_PROJECTION)
         return {
             user[EMAIL]: {
                 NAME: user.get(NAME, ""),
@@ -104,52 +142,221 @@ def get_users_as_dict() -> dict:
         return {}
 
 
-def create_user(
-    name: str, email: str, password: str, affiliation: str, role: str = None
-) -> dict:
-    users = get_users()
+def stream_users(batch_size: int = dbc.DEFAULT_BATCH_SIZE):
+    """
+    Lazily yield every user as a dict, without password hashes.
+    Only one batch of users is held in memory at a time.
+    """
+    for user in dbc.read_iter(USER_COLLECT, projection=PUBLIC_PROJECTION,
+                              batch_size=batch_size):
+        yield to_user(user).to_dict()
+
+
+def get_users_page(limit: int = dbc.DEFAULT_PAGE_SIZE, after: str = None) -> tuple:
+    """
+    Retrieve one page of users (without password hashes), in insertion order.
+    Returns (users, next_token); pass next_token back as `after`.
+    """
+    db_users, next_token = dbc.read_page(USER_COLLECT, limit=limit, after=after,
+                                         projection=PUBLIC_PROJECTION)
+    return [to_user(user).to_dict() for user in db_users], next_token
 
-    hashed_password = generate_password_hash(password)
 
+class DuplicateUserError(ValueError):
+    """
+    Raised when creating a user whose email is already taken.
+    """
+
+
+def build_user_doc(
+    name: str, email: str, password: str, affiliation: str, role: str = None,
+    hash_password: bool = True,
+) -> dict:
+    """
+    Validate a new user and build the document to store for it,
+    including the password hash (or the password itself, to be hashed
+    by the caller, if not hash_password).
+    """
     if role:
         new_user = User(name=name, email=email, affiliation=affiliation, roles=[role])
     else:
         new_user = User(name=name, email=email, affiliation=affiliation, roles=[])
 
-    if check_valid_user(new_user):
-        users.append(new_user)
+    check_valid_user(new_user, check_duplicate=False)
+
+    user_doc = new_user.to_dict()
+    user_doc[PASSWORD] = passwords.hash_password(password) if hash_password else password
+    return user_doc
+
+
+def create_user(
+    name: str, email: str, password: str, affiliation: str, role: str = None
+) -> dict:
+    """
+    Create a new user and return the created record (without the password).
+    Duplicates are detected by the unique email index, so this is a single
+    insert regardless of how many users there are.
+    """
+    user_doc = build_user_doc(name, email, password, affiliation, role)
+    created = {fld: val for fld, val in user_doc.items() if fld != PASSWORD}
+
+    try:
+        dbc.create(USER_COLLECT, user_doc)
+    except dbc.DuplicateKeyError as e:
+        raise DuplicateUserError(f"Duplicate email: {created[EMAIL]}") from e
+    invalidate_masthead()
+
+    return created
+
+
+REQUIRED_FIELDS = [NAME, EMAIL, AFFILIATION, PASSWORD]
+
+
+def prepare_user(record: dict) -> dict:
+    """
+    Build the document to store for one record of a bulk import; its
+    password is hashed later, together with the others.
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"Not a user record: {record!r}")
+    missing = [fld for fld in REQUIRED_FIELDS if fld not in record]
+    if missing:
+        raise ValueError(f"Missing required fields: {missing}")
+    # Checked here, not when hashing: a bad password must fail its own
+    # record rather than the whole batch of hashes.
+    not_text = [fld for fld in [*REQUIRED_FIELDS, ROLE]
+                if record.get(fld) is not None and not isinstance(record[fld], str)]
+    if not_text:
+        raise ValueError(f"Fields must be strings: {not_text}")
+    return build_user_doc(
+        name=record[NAME],
+        email=record[EMAIL],
+        password=record[PASSWORD],
+        affiliation=record[AFFILIATION],
+        role=record.get(ROLE),
+        hash_password=False,
+    )
+
+
+def bulk_create_users(records: list, ordered: bool = True, upsert: bool = False) -> dict:
+    """
+    Create (or, with upsert, create or update by email) many users in one
+    round trip. Upserts never change an existing user's password or roles.
+    Returns the write counts and per-record errors, indexed by position
+    in records.
+    """
+    docs, positions, errors = dbc.prepare_bulk(records, prepare_user, ordered)
+    hashes = passwords.hash_passwords([doc[PASSWORD] for doc in docs])
+    for doc, pw_hash in zip(docs, hashes):
+        doc[PASSWORD] = pw_hash
+    if upsert:
+        result = dbc.bulk_upsert(USER_COLLECT, docs, EMAIL, ordered=ordered,
+                                 insert_only=(PASSWORD, ROLES))
+    else:
+        result = dbc.bulk_create(USER_COLLECT, docs, ordered=ordered)
+    invalidate_masthead()
+    return dbc.merge_bulk_errors(result, positions, errors)
+
+
+def get_user(email: str, cached: bool = True) -> Optional[User]:
+    """
+    Retrieve a user by their email address; with cached=False, straight
+    from the db.
+    """
+    user = get_user_raw(email, projection=PUBLIC_PROJECTION, cached=cached)
+    if not user:
+        return None
+    return to_user(user)
+
+
+def get_user_raw(email: str, projection: dict = None, cached: bool = True):
+    """
+    Receives the entire user data from the database instead of converting to User.
+    This is a single indexed lookup on email.
+    """
+    user = dbc.fetch_one(USER_COLLECT, {EMAIL: email}, projection=projection, cached=cached)
+    if user:
+        user.pop(dbc.MONGO_ID, None)
+    return user
+
 
-        # save user to database
-        new_user = new_user.to_dict()
-        new_user[PASSWORD] = hashed_password
+def get_principal(email: str, issued_at=None) -> Optional[dict]:
+    """
+    The email and roles of the user a token was issued to, or None if
+    there is no such user. Cached by (email, issued_at), so a new login
+    gets a fresh lookup; callers must not modify what is returned.
+    """
+    key = (email, issued_at)
+    principal = principal_cache.get(key)
+    if principal is MISSING:
+        generation = principal_cache.generation
+        user = get_user(email, cached=False)
+        if not user:
+            return None
+        principal = {EMAIL: user.email, ROLES: list(user.roles)}
+        principal_cache.set(key, principal, PRINCIPAL_TTL, group=email,
+                            generation=generation)
+    return principal
 
-        dbc.create(USER_COLLECT, new_user)
 
-    return get_users_as_dict()
+def invalidate_principal(email: str):
+    principal_cache.invalidate(email)
 
 
-def get_user(email: str) -> Optional[User]:
+def check_password(email: str, pw_hash: str, password: str) -> bool:
     """
-    Retrieve a user by their email address.
+    Check a user's password. If their hash was made with older
+    parameters, store it rehashed with the current ones.
     """
-    users = get_users()
-    return next((user for user in users if user.email == email), None)
+    matches, new_hash = passwords.check_password(pw_hash, password)
+    if new_hash:
+        try:
+            dbc.update_doc(USER_COLLECT, {EMAIL: email}, {PASSWORD: new_hash})
+        except Exception as e:
+            print(f"Error rehashing the password of {email}: {e}")
+    return matches
 
 
-def get_user_raw(email: str):
+def check_roles(roles) -> list:
     """
-    Receives the entire user data from the database instead of converting to User
+    Normalize one role or a list of roles to a list of lower-case roles
+    (as they are stored), checking each is valid.
     """
-    users = get_users_raw()
-    return next((user for user in users if user.get("email") == email), None)
+    roles = [roles] if isinstance(roles, str) else list(roles)
+    for role in roles:
+        if not isinstance(role, str) or not is_valid_role(role):
+            raise ValueError(f"Invalid role: {role}")
+    return [role.lower() for role in roles]
 
 
-def get_users_by_role(role: str) -> list[User]:
+def get_users_by_role(role) -> list[User]:
     """
     Retrieve users who have the specified role in their roles list.
+    `role` may also be a list of roles: users with any of them are returned.
+    The filtering is done by the database, using the index on roles.
     """
-    users = get_users()
-    return [user for user in users if role in user.roles]
+    roles = check_roles(role)
+    db_users = dbc.read(USER_COLLECT, projection=PUBLIC_PROJECTION,
+                        filt={ROLES: {'$in': roles}})
+    return [to_user(user) for user in db_users]
+
+
+def count_users_by_role(roles=None) -> dict:
+    """
+    Count the users holding each role (all roles if none are given),
+    in one aggregation.
+    """
+    roles = check_roles(roles) if roles else list(get_roles().values())
+    pipeline = [
+        {'$match': {ROLES: {'$in': roles}}},
+        {'$unwind': f'${ROLES}'},
+        {'$match': {ROLES: {'$in': roles}}},
+        {'$group': {dbc.MONGO_ID: f'${ROLES}', 'count': {'$sum': 1}}},
+    ]
+    counts = {role: 0 for role in roles}
+    for group in dbc.aggregate(USER_COLLECT, pipeline):
+        counts[group[dbc.MONGO_ID]] = group['count']
+    return counts
 
 
 def update_user(
@@ -188,6 +395,8 @@ def update_user(
 
     # Update only the fields that changed
     dbc.update_doc(USER_COLLECT, {EMAIL: email}, updates)
+    invalidate_masthead()
+    invalidate_principal(email)
     updated_user = get_user(email)
     return updated_user.to_dict()
 
@@ -196,15 +405,15 @@ def delete_user(email: str) -> Optional[User]:
     user = get_user(email)  # Get user before deleting
     if user:
         dbc.delete(USER_COLLECT, {EMAIL: email})
+        invalidate_masthead()
+        invalidate_principal(email)
         return user
     return None
 
 
-def check_valid_user(user: User, updating: bool = False) -> bool:
-    users = get_users()
-
-    if user in users and not updating:
-        raise ValueError(f"Duplicate email: {user}")
+def check_valid_user(user: User, updating: bool = False, check_duplicate: bool = True) -> bool:
+    if check_duplicate and not updating and get_user(user.email):
+        raise DuplicateUserError(f"Duplicate email: {user}")
 
     if user.roles and not is_valid_role(user.roles[0]):
         raise ValueError(f"Invalid role: {user}")
@@ -227,9 +436,7 @@ MH_FIELDS = [name, affiliation]
 
 
 def read() -> dict:
-    people = dbc.read_dict(USER_COLLECT, EMAIL)
-    print(f'{people=}')
-    return people
+    return dbc.read_dict(USER_COLLECT, EMAIL, projection=PUBLIC_PROJECTION)
 
 
 def get_mh_fields(journal_code=None) -> list:
@@ -243,20 +450,47 @@ def create_mh_rec(person: dict) -> dict:
     return mh_rec
 
 
-def get_masthead() -> dict:
-    masthead = {}
-    mh_roles = rls.get_masthead_roles()
-    for mh_role, text in mh_roles.items():
-        people_role = []
-        people = read()
-        for _id, person in people.items():
-            if has_role(person, mh_role):
-                rec = create_mh_rec(person)
-                people_role.append(rec)
-        masthead[text] = people_role
+MASTHEAD_KEY = 'masthead'
+# Our own user writes clear the memoized masthead; the TTL bounds how
+# long we miss writes made by other processes.
+masthead_cache = TTLCache(max_size=1)
+
+
+def invalidate_masthead():
+    masthead_cache.invalidate(MASTHEAD_KEY)
+
+
+def build_masthead() -> dict:
+    """
+    Build the masthead with one aggregation: the people holding each
+    masthead role, using the multikey index on roles.
+    """
+    mh_roles = [role.value for role in rls.MH_ROLES]
+    pipeline = [
+        {'$match': {ROLES: {'$in': mh_roles}}},
+        {'$unwind': f'${ROLES}'},
+        {'$match': {ROLES: {'$in': mh_roles}}},
+        {'$group': {
+            dbc.MONGO_ID: f'${ROLES}',
+            'people': {'$push': {
+                field: {'$ifNull': [f'${field}', '']} for field in get_mh_fields()
+            }},
+        }},
+    ]
+    masthead = {text: [] for text in rls.get_masthead_roles().values()}
+    for group in dbc.aggregate(USER_COLLECT, pipeline):
+        masthead[group[dbc.MONGO_ID]] = group['people']
     return masthead
 
 
+def get_masthead() -> dict:
+    masthead = masthead_cache.get(MASTHEAD_KEY)
+    if masthead is MISSING:
+        masthead = build_masthead()
+        masthead_cache.set(MASTHEAD_KEY, masthead, CACHE_TTL, group=MASTHEAD_KEY)
+    return copy.deepcopy(masthead)
+
+
 def has_role(person: dict, role: str) -> bool:
     if role in person.get(ROLES):
         return True
@@ -269,7 +503,10 @@ def clear_users():
     Clear all users from the database.
     Used primarily for testing purposes.
     """
-    return dbc.delete_many(USER_COLLECT, {})  # delete all documents
+    deleted = dbc.delete_many(USER_COLLECT, {})  # delete all documents
+    invalidate_masthead()
+    principal_cache.clear()
+    return deleted
 
 
 def main():
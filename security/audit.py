@@ -0,0 +1,215 @@
+"""
+The audit log: who did what, when, and whether they were allowed to.
+Callers only put entries on a bounded in-memory queue; a background
+thread writes them to the db in batches, so auditing a request costs
+microseconds rather than a db round trip. If the queue is full (the db
+is down or slow), new entries are dropped and counted rather than
+holding up requests.
+"""
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import data.db_connect as dbc
+
+AUDIT_COLLECT = 'audit'
+
+USER = 'user'
+FEATURE = 'feature'
+ACTION = 'action'
+ALLOWED = 'allowed'
+AT = 'at'
+
+# Counters reported by stats().
+QUEUED = 'queued'  # entries waiting to be written
+WRITTEN = 'written'
+DROPPED = 'dropped'  # entries not queued because the queue was full
+FAILED = 'failed'  # entries lost because writing them failed
+
+MAX_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+# A batch is written once it has FLUSH_SIZE entries, or FLUSH_SECS after
+# its first entry was queued, whichever comes first.
+FLUSH_SIZE = int(os.environ.get('AUDIT_FLUSH_SIZE', 500))
+FLUSH_SECS = float(os.environ.get('AUDIT_FLUSH_SECS', 1))
+# How long a caller may wait for room on a full queue before dropping its
+# entry; 0 means never wait.
+PUT_TIMEOUT = float(os.environ.get('AUDIT_PUT_TIMEOUT', 0))
+
+
+def ensure_indexes():
+    """
+    The log is read by user and time, or by time alone; _id breaks ties
+    between entries in the same instant.
+    """
+    dbc.create_index(AUDIT_COLLECT, [(USER, 1), (AT, 1), (dbc.MONGO_ID, 1)])
+    dbc.create_index(AUDIT_COLLECT, [(AT, 1), (dbc.MONGO_ID, 1)])
+
+
+def write_batch(entries: list):
+    dbc.bulk_create(AUDIT_COLLECT, entries, ordered=False)
+
+
+class AuditWriter:
+    """
+    A bounded queue of audit entries and the thread that writes them.
+    The thread is started by the first entry.
+    """
+
+    def __init__(self, max_size: int = MAX_QUEUE_SIZE, flush_size: int = FLUSH_SIZE,
+                 flush_secs: float = FLUSH_SECS, put_timeout: float = PUT_TIMEOUT,
+                 write=write_batch):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.flush_size = flush_size
+        self.flush_secs = flush_secs
+        self.put_timeout = put_timeout
+        self.write = write
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()  # guards the counters and the thread
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def put(self, entry: dict) -> bool:
+        """
+        Queue entry for writing; False if the queue is full and it was
+        dropped.
+        """
+        if self.thread is None:
+            self.start()
+        try:
+            if self.put_timeout > 0:
+                self.queue.put(entry, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='audit-writer',
+                                               daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Write what is queued, then stop the thread.
+        """
+        self.stopping.set()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def run(self):
+        if dbc.client is not None:
+            try:
+                ensure_indexes()
+            except Exception as e:
+                print(f'Error creating audit indexes: {e}')
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.next_batch()
+            if batch:
+                self.flush(batch)
+
+    def next_batch(self) -> list:
+        """
+        Wait for entries, and return them once there are flush_size of
+        them or flush_secs have passed since the first one.
+        """
+        try:
+            batch = [self.queue.get(timeout=self.flush_secs)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_secs
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch: list):
+        try:
+            self.write(batch)
+        except Exception as e:
+            print(f'Error writing {len(batch)} audit entries: {e}')
+            with self.lock:
+                self.failed += len(batch)
+            return
+        with self.lock:
+            self.written += len(batch)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                QUEUED: self.queue.qsize(),
+                WRITTEN: self.written,
+                DROPPED: self.dropped,
+                FAILED: self.failed,
+            }
+
+
+writer = AuditWriter()
+
+
+def build_entry(user: str, feature: str, action: str, allowed: bool = True,
+                at: datetime = None, **extra) -> dict:
+    return {
+        USER: user,
+        FEATURE: feature,
+        ACTION: action,
+        ALLOWED: allowed,
+        AT: at or datetime.now(timezone.utc),
+        **extra,
+    }
+
+
+def log(user: str, feature: str, action: str, allowed: bool = True, **extra) -> bool:
+    """
+    Queue an audit entry; extra fields are stored with it.
+    Returns False if it was dropped, or there is no db to write it to.
+    """
+    if dbc.client is None:
+        return False
+    return writer.put(build_entry(user, feature, action, allowed, **extra))
+
+
+def stats() -> dict:
+    return writer.stats()
+
+
+def format_entry(entry: dict) -> dict:
+    entry[AT] = entry[AT].replace(tzinfo=timezone.utc).isoformat()
+    return entry
+
+
+def read_page(user: str = None, since: str = None, limit: int = dbc.DEFAULT_PAGE_SIZE,
+              after: str = None) -> tuple:
+    """
+    A page of audit entries, oldest first, optionally only those of user
+    and those at or after since: (entries, next_token).
+    """
+    filt = {}
+    if user:
+        filt[USER] = user
+    if since:
+        filt[AT] = {'$gte': dbc.parse_date(since)}
+    page, next_token = dbc.read_page(AUDIT_COLLECT, limit=limit, after=after, sort_key=AT,
+                                     no_id=False, filt=filt)
+    return [format_entry(entry) for entry in page], next_token
@@ -0,0 +1,243 @@
+"""
+Password hashing and checking, off the request threads.
+Password hashes are deliberately slow to compute, so a burst of logins
+would otherwise keep every server thread busy hashing. Instead the work
+goes to a pool of worker processes, and at most MAX_PENDING hashes may
+be waiting for it at once: beyond that callers get HashPoolBusy (a 503)
+rather than queueing without bound. Bulk imports hash in a pool of their
+own, so a big import never holds up logins.
+The hash method (werkzeug's "method:params" string) is configurable;
+hashes made with other parameters are upgraded when their user next
+logs in.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS, check_password_hash,
+                               generate_password_hash)
+
+# e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'
+METHOD = os.environ.get('PASSWORD_METHOD', 'scrypt:32768:8:1')
+SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+# 0 workers hashes on the calling thread.
+WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+MAX_PENDING = int(os.environ.get('PASSWORD_MAX_PENDING', 4 * max(WORKERS, 1)))
+# How long (in seconds) a caller waits for a free slot before giving up.
+WAIT_SECS = float(os.environ.get('PASSWORD_WAIT_SECS', 5))
+# Bulk imports: how many workers they get, and how many may be hashing
+# at once. Their passwords go to the workers BULK_CHUNK_SIZE at a time.
+BULK_WORKERS = int(os.environ.get('PASSWORD_BULK_WORKERS', max(1, WORKERS // 2)))
+BULK_MAX_PENDING = int(os.environ.get('PASSWORD_BULK_MAX_PENDING', 2))
+BULK_CHUNK_SIZE = 16
+
+pool = None
+bulk_pool = None
+pool_lock = threading.Lock()
+pending = threading.BoundedSemaphore(MAX_PENDING)
+bulk_pending = threading.BoundedSemaphore(BULK_MAX_PENDING)
+
+
+class HashPoolBusy(RuntimeError):
+    """
+    Raised when too many passwords are already waiting to be hashed.
+    """
+
+
+def configure(workers: int = None, max_pending: int = None, method: str = None,
+              bulk_workers: int = None, bulk_max_pending: int = None):
+    """
+    Change the pool sizes, queue bounds or hash method; the pools are
+    restarted on next use.
+    """
+    global WORKERS, MAX_PENDING, METHOD, BULK_WORKERS, BULK_MAX_PENDING
+    global pending, bulk_pending
+    shutdown()
+    if workers is not None:
+        WORKERS = workers
+    if max_pending is not None:
+        MAX_PENDING = max_pending
+        pending = threading.BoundedSemaphore(MAX_PENDING)
+    if method is not None:
+        METHOD = method
+    if bulk_workers is not None:
+        BULK_WORKERS = bulk_workers
+    if bulk_max_pending is not None:
+        BULK_MAX_PENDING = bulk_max_pending
+        bulk_pending = threading.BoundedSemaphore(BULK_MAX_PENDING)
+
+
+def new_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned, not forked: the server has db and background threads that
+    # must not be copied into the workers.
+    return ProcessPoolExecutor(max(workers, 1), mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = new_pool(WORKERS)
+        return pool
+
+
+def get_bulk_pool() -> ProcessPoolExecutor:
+    global bulk_pool
+    with pool_lock:
+        if bulk_pool is None:
+            bulk_pool = new_pool(BULK_WORKERS)
+        return bulk_pool
+
+
+def shutdown():
+    global pool, bulk_pool
+    with pool_lock:
+        for executor in (pool, bulk_pool):
+            if executor is not None:
+                executor.shutdown()
+        pool = bulk_pool = None
+
+
+def run(fn, *args):
+    """
+    Run fn(*args) in the pool and wait for its result.
+    """
+    if WORKERS <= 0:
+        return fn(*args)
+    sem = pending
+    if not sem.acquire(timeout=WAIT_SECS):
+        raise HashPoolBusy('Too many password checks in progress; try again shortly')
+    try:
+        return get_pool().submit(fn, *args).result()
+    finally:
+        sem.release()
+
+
+def parse_method(method: str) -> tuple:
+    """
+    A werkzeug hash method as a tuple, with the parameters it leaves out
+    filled in as werkzeug does: 'pbkdf2:sha256' is the same as
+    'pbkdf2:sha256:<default iterations>'.
+    """
+    name, *args = method.split(':')
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return name, hash_name, int(iterations)
+    if name == 'scrypt':
+        return (name, *map(int, args or (2 ** 15, 8, 1)))
+    return (name, *args)
+
+
+def needs_rehash(pw_hash: str, method: str = None) -> bool:
+    """
+    Whether pw_hash was made with other parameters than method.
+    """
+    try:
+        return parse_method(pw_hash.split('$', 1)[0]) != parse_method(method or METHOD)
+    except ValueError:
+        return True
+
+
+# These run in the worker processes.
+def _hash(password: str, method: str, salt_length: int) -> str:
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+def _hash_many(passwords: list, method: str, salt_length: int) -> list:
+    return [_hash(password, method, salt_length) for password in passwords]
+
+
+def _check(pw_hash: str, password: str, method: str, salt_length: int) -> tuple:
+    if not check_password_hash(pw_hash, password):
+        return False, None
+    if needs_rehash(pw_hash, method):
+        return True, _hash(password, method, salt_length)
+    return True, None
+
+
+def hash_password(password: str) -> str:
+    return run(_hash, password, METHOD, SALT_LENGTH)
+
+
+def hash_passwords(passwords: list) -> list:
+    """
+    Hash many passwords (for bulk imports) in the bulk pool.
+    """
+    if not passwords:
+        return []
+    if WORKERS <= 0:
+        return _hash_many(passwords, METHOD, SALT_LENGTH)
+    sem = bulk_pending
+    if not sem.acquire(timeout=WAIT_SECS):
+        raise HashPoolBusy('Too many imports hashing passwords; try again shortly')
+    try:
+        chunks = [passwords[i:i + BULK_CHUNK_SIZE]
+                  for i in range(0, len(passwords), BULK_CHUNK_SIZE)]
+        hashed = get_bulk_pool().map(_hash_many, chunks, repeat(METHOD), repeat(SALT_LENGTH))
+        return [pw_hash for chunk in hashed for pw_hash in chunk]
+    finally:
+        sem.release()
+
+
+def check_password(pw_hash: str, password: str) -> tuple:
+    """
+    Check password against pw_hash: (matches, new_hash), where new_hash
+    is the password hashed with the current parameters if pw_hash was
+    made with others (and it matched), else None.
+    """
+    if not pw_hash:
+        return False, None
+    return run(_check, pw_hash, password, METHOD, SALT_LENGTH)
+
+
+def load_test(num_logins: int = 64, method: str = 'pbkdf2:sha256:200000'):
+    """
+    Time a burst of num_logins password checks with 0 (on the request
+    threads), 1, 2... cpu_count workers, and how long a cheap request
+    (GET /hello, through the app) takes while each burst is running.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from server.endpoints import HELLO_EP, app
+
+    client = app.test_client()
+    configure(workers=0, method=method)
+    pw_hash = hash_password('password12')
+
+    def cheap_request():
+        start = time.perf_counter()
+        assert client.get(HELLO_EP).status_code == 200
+        return time.perf_counter() - start
+
+    for workers in [0, *range(1, (os.cpu_count() or 1) + 1)]:
+        configure(workers=workers, max_pending=num_logins)
+        if workers:
+            run(_check, pw_hash, 'warm up', method, SALT_LENGTH)  # start the workers
+        done = threading.Event()
+        latencies = []
+
+        def probe():
+            while not done.is_set():
+                latencies.append(cheap_request())
+                time.sleep(0.005)
+        prober = threading.Thread(target=probe)
+        prober.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(num_logins) as threads:
+            assert all(ok for ok, _ in threads.map(
+                lambda _: check_password(pw_hash, 'password12'), range(num_logins)))
+        secs = time.perf_counter() - start
+        done.set()
+        prober.join()
+        latencies.sort()
+        print(f'{workers} workers: {num_logins / secs:.1f} logins/s, GET {HELLO_EP} '
+              f'p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, '
+              f'max {latencies[-1] * 1000:.2f}ms')
+    shutdown()
+
+
+if __name__ == '__main__':
+    load_test()
@@ -1,7 +1,10 @@
 from functools import wraps
 from logging import Logger
-import time
-from data.roles import Role
+import os
+import threading
+import data.db_connect as dbc
+import security.audit as audit
+from data.roles import Role, role_mask
 
 """
 Our record format to meet our requirements (see security.md) will be:
@@ -69,7 +72,25 @@ BAD_FEATURE = 'baaaad feature'
 PEOPLE_MISSING_ACTION = READ
 GOOD_USER_ID = 'ed2303@nyu.edu'
 
+# Records are stored one feature per doc, {FEATURE: name, ACTIONS: {...}},
+# next to a single version doc that every change bumps. Workers poll the
+# version and only re-read the records when it moves.
+FEATURE = 'feature'
+ACTIONS = 'actions'
+VERSION = 'version'
+VERSION_FILTER = {dbc.MONGO_ID: VERSION}
+FEATURE_FILTER = {FEATURE: {'$exists': True}}
+# How often (in seconds) workers check for policy changes.
+REFRESH_INTERVAL = float(os.environ.get('SECURITY_REFRESH_SECS', 5))
+
 security_recs = None
+loaded_version = None  # the version security_recs was read at
+refresher = None
+refresher_stop = threading.Event()
+# is_permitted() works from security_recs compiled into
+# {(feature, action): (role mask or None, required check funcs, bad check)}
+compiled_recs = {}
+compiled_from = None  # the security_recs that compiled_recs was built from
 
 PEOPLE = 'people'
 TEXTS = 'texts'
@@ -153,13 +174,105 @@ CHECK_FUNCS = {
  }
 
 
+def read_version():
+    """
+    The stored version of the security records; None if they were never
+    saved. This is what every worker polls, so it is kept to a lookup on
+    the _id index returning just the version.
+    """
+    doc = dbc.fetch_one(COLLECT_NAME, VERSION_FILTER, projection={dbc.MONGO_ID: 0, VERSION: 1},
+                        cached=False)
+    return doc[VERSION] if doc else None
+
+
+def bump_version() -> int:
+    doc = dbc.fetch_one_and_update(COLLECT_NAME, VERSION_FILTER,
+                                   {'$inc': {VERSION: 1}}, upsert=True)
+    return doc[VERSION]
+
+
+def save_features(recs: dict) -> int:
+    """
+    Store the records of each feature in recs and bump the version, so
+    every worker picks them up. Returns the new version.
+    """
+    dbc.bulk_upsert(COLLECT_NAME, [{FEATURE: feature_name, ACTIONS: feature_data}
+                                   for feature_name, feature_data in recs.items()],
+                    FEATURE)
+    return bump_version()
+
+
+def load() -> tuple:
+    """
+    Read all security records from the db, storing TEST_RECS first if
+    there are none yet. Returns (recs, version).
+    """
+    version = read_version()
+    if version is None:
+        dbc.create_index(COLLECT_NAME, FEATURE, unique=True)
+        version = save_features(TEST_RECS)
+    recs = {doc[FEATURE]: doc[ACTIONS]
+            for doc in dbc.read(COLLECT_NAME, filt=FEATURE_FILTER)}
+    return recs, version
+
+
 def read() -> dict:
-    global security_recs
-    # dbc.read()
-    security_recs = TEST_RECS
+    """
+    (Re)load the security records, and compile them so permission checks
+    never wait on the db. Without a db we use TEST_RECS.
+    """
+    global security_recs, loaded_version, compiled_recs, compiled_from
+    recs, version = TEST_RECS, None
+    if dbc.client is not None:
+        try:
+            recs, version = load()
+            start_refresher()
+        except Exception as e:
+            print(f'Error reading security records: {e}')
+            if security_recs:
+                return security_recs  # keep what we have
+    compiled_recs = compile_recs(recs)
+    compiled_from = recs
+    security_recs = recs
+    loaded_version = version
     return security_recs
 
 
+def refresh() -> bool:
+    """
+    Reload the security records if another worker changed them.
+    One small read when nothing changed. Returns whether we reloaded.
+    """
+    if dbc.client is None or read_version() == loaded_version:
+        return False
+    read()
+    return True
+
+
+def refresh_loop(interval: float):
+    while not refresher_stop.wait(interval):
+        try:
+            refresh()
+        except Exception as e:
+            print(f'Error refreshing security records: {e}')
+
+
+def start_refresher(interval: float = REFRESH_INTERVAL):
+    """
+    Start polling for policy changes in the background, once per process.
+    """
+    global refresher
+    if refresher is None or not refresher.is_alive():
+        refresher_stop.clear()
+        refresher = threading.Thread(target=refresh_loop, args=(interval,),
+                                     name='security-refresh', daemon=True)
+        refresher.start()
+
+
+def stop_refresher():
+    refresher_stop.set()
+
+
 def needs_recs(fn):
     """
     Should be used to decorate any function that directly accesses sec recs.
@@ -184,7 +297,8 @@ def read_feature(feature_name: str) -> dict:
 @needs_recs
 def check_permission(feature_name: str, operation: str, user_email: str, ip_address=None) -> bool:
     """
-    Check if a user has permission to perform an operation on a feature.
+    Check if a user has permission to perform an operation on a feature,
+    and audit the decision.
     Args:
         feature_name: The name of the feature
         operation: The operation (CREATE, READ, UPDATE, DELETE)
@@ -193,6 +307,12 @@ def check_permission(feature_name: str, operation: str, user_email: str, ip_addr
     Returns:
         bool: True if the user has permission, False otherwise
     """
+    allowed = _check_permission(feature_name, operation, user_email, ip_address)
+    _log_audit(user_email, feature_name, operation, allowed)
+    return allowed
+
+
+def _check_permission(feature_name: str, operation: str, user_email: str, ip_address=None) -> bool:
     if feature_name not in security_recs:
         Logger.warning(f"Feature '{feature_name}' not found in security records")
         return False
@@ -213,17 +333,16 @@ def check_permission(feature_name: str, operation: str, user_email: str, ip_addr
     return True
 
 
-def _log_audit(user_email: str, feature_name: str, operation: str) -> None:
+def _log_audit(user_email: str, feature_name: str, operation: str, allowed: bool = True) -> None:
     """
     Log an audit entry for a security-sensitive operation.
     Args:
         user_email: The email of the user
         feature_name: The name of the feature
         operation: The operation performed
+        allowed: Whether the user was allowed to perform it
     """
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    Logger.info(f"AUDIT: {timestamp} - User '{user_email}' performed '{operation}' on '{feature_name}'")
-    # In production, this would write to a secure audit log in the databased
+    audit.log(user_email, feature_name, operation, allowed)
 
 
 @needs_recs
@@ -238,6 +357,7 @@ def add_user_permission(feature_name: str, operation: str, user_email: str) -> b
     Returns:
         bool: True if successful, False otherwise
     """
+    global compiled_from
     if feature_name not in security_recs:
         security_recs[feature_name] = {}
     if operation not in security_recs[feature_name]:
@@ -249,7 +369,10 @@ def add_user_permission(feature_name: str, operation: str, user_email: str) -> b
         }
     if user_email not in security_recs[feature_name][operation][USER_LIST]:
         security_recs[feature_name][operation][USER_LIST].append(user_email)
-    return  # write to database (Needs to be Implemented)
+    compiled_from = None  # changed in place, so recompile
+    if dbc.client is not None:
+        save_features({feature_name: security_recs[feature_name]})
+    return
 
 
 """@needs_recs
@@ -272,29 +395,52 @@ def is_permitted(feature_name: str, action: str, user_id: str, **kwargs) -> bool
     return True"""
 
 
+def compile_recs(recs: dict) -> dict:
+    """
+    Compile security records for is_permitted(): each (feature, action)
+    gets the mask of the roles allowed (None if any role is), the check
+    functions it requires, and the first check name we have no function
+    for, if any.
+    """
+    compiled = {}
+    for feature_name, feature_data in recs.items():
+        for action, prot in feature_data.items():
+            if not isinstance(prot, dict):
+                prot = {}
+            mask = role_mask(prot[ROLE_LIST]) if ROLE_LIST in prot else None
+            checks = prot.get(CHECKS, {})
+            bad_check = next((name for name in checks if name not in CHECK_FUNCS), None)
+            funcs = tuple(CHECK_FUNCS[name] for name, is_required in checks.items()
+                          if is_required and name in CHECK_FUNCS)
+            compiled[(feature_name, action)] = (mask, funcs, bad_check)
+    return compiled
+
+
+def get_compiled_recs() -> dict:
+    """
+    compiled_recs, recompiled if security_recs has been replaced.
+    """
+    global compiled_recs, compiled_from
+    if compiled_from is not security_recs:
+        compiled_recs = compile_recs(security_recs)
+        compiled_from = security_recs
+    return compiled_recs
+
+
 @needs_recs
 def is_permitted(feature_name: str, action: str, user_roles: list, **kwargs) -> bool:
     """Check if operation on feature is permitted for roles."""
-    prot = read_feature(feature_name)
-    if prot is None or not user_roles:
+    if not user_roles:
         return False
-    if action not in prot:
+    prot = get_compiled_recs().get((feature_name, action))
+    if prot is None:
         return False
-    # Role check
-    if ROLE_LIST in prot[action]:
-        if not any(role in prot[action][ROLE_LIST] for role in user_roles):
-            return False
-    # Check for invalid check functions before executing any
-    if CHECKS in prot[action]:
-        for check_name in prot[action][CHECKS]:
-            if check_name not in CHECK_FUNCS:
-                # This should raise the ValueError
-                raise ValueError(f'Bad check passed to is_permitted: {check_name}')
-        # Now execute valid checks
-        for check_name, is_required in prot[action][CHECKS].items():
-            if is_required and not CHECK_FUNCS[check_name](user_roles, **kwargs):
-                return False
-    return True
+    mask, checks, bad_check = prot
+    if mask is not None and not mask & role_mask(user_roles):
+        return False
+    if bad_check is not None:
+        raise ValueError(f'Bad check passed to is_permitted: {bad_check}')
+    return all(check(user_roles, **kwargs) for check in checks)
 
 
 @needs_recs
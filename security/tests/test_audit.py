@@ -0,0 +1,94 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+import security.audit as audit
+
+
+class Recorder:
+    """
+    A write function that remembers the batches it was given.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.written = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append(list(batch))
+        self.written.set()
+
+
+def test_build_entry():
+    entry = audit.build_entry('ed@nyu.edu', 'people', 'delete', allowed=False, status=403)
+    assert entry[audit.USER] == 'ed@nyu.edu'
+    assert entry[audit.ALLOWED] is False
+    assert entry['status'] == 403
+    assert entry[audit.AT].tzinfo is not None
+
+
+def test_writer_batches_by_size():
+    write = Recorder()
+    writer = audit.AuditWriter(flush_size=3, flush_secs=10, write=write)
+    for i in range(3):
+        assert writer.put({'n': i})
+    assert write.written.wait(5)
+    writer.stop(5)
+    assert write.batches == [[{'n': 0}, {'n': 1}, {'n': 2}]]
+    assert writer.stats()[audit.WRITTEN] == 3
+
+
+def test_writer_flushes_on_time():
+    write = Recorder()
+    writer = audit.AuditWriter(flush_size=100, flush_secs=0.05, write=write)
+    writer.put({'n': 0})
+    assert write.written.wait(5)
+    writer.stop(5)
+    assert write.batches == [[{'n': 0}]]
+
+
+def test_writer_drops_when_full():
+    writer = audit.AuditWriter(max_size=2, write=Recorder())
+    writer.thread = object()  # pretend it is running, so nothing is taken off the queue
+    assert writer.put({'n': 0})
+    assert writer.put({'n': 1})
+    assert not writer.put({'n': 2})
+    stats = writer.stats()
+    assert stats[audit.DROPPED] == 1
+    assert stats[audit.QUEUED] == 2
+
+
+def test_writer_counts_failed_writes():
+    def write(batch):
+        raise ConnectionError('db down')
+    writer = audit.AuditWriter(flush_size=1, write=write)
+    writer.put({'n': 0})
+    writer.stop(5)
+    assert writer.stats()[audit.FAILED] == 1
+
+
+def test_stop_writes_what_is_queued():
+    write = Recorder()
+    writer = audit.AuditWriter(flush_size=100, flush_secs=10, write=write)
+    for i in range(5):
+        writer.put({'n': i})
+    writer.stop(5)
+    assert sum(len(batch) for batch in write.batches) == 5
+
+
+def test_log_without_db():
+    assert not audit.log('ed@nyu.edu', 'people', 'delete')
+
+
+@patch('data.db_connect.read_page', autospec=True, return_value=([], None))
+def test_read_page(mock_read_page):
+    audit.read_page(user='ed@nyu.edu', since='2024-01-01T05:00:00+05:00', limit=5)
+    filt = mock_read_page.call_args.kwargs['filt']
+    assert filt[audit.USER] == 'ed@nyu.edu'
+    assert filt[audit.AT]['$gte'].isoformat() == '2024-01-01T00:00:00'
+
+
+def test_read_page_bad_since():
+    with pytest.raises(ValueError):
+        audit.read_page(since='not a date')
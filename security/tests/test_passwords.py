@@ -0,0 +1,84 @@
+import pytest
+
+import security.passwords as passwords
+
+CHEAP = 'pbkdf2:sha256:1000'
+CHEAPER = 'pbkdf2:sha256:500'
+
+
+@pytest.fixture
+def config():
+    saved = (passwords.WORKERS, passwords.MAX_PENDING, passwords.METHOD, passwords.WAIT_SECS,
+             passwords.BULK_WORKERS, passwords.BULK_MAX_PENDING)
+    yield
+    workers, max_pending, method, passwords.WAIT_SECS, bulk_workers, bulk_max_pending = saved
+    passwords.configure(workers=workers, max_pending=max_pending, method=method,
+                        bulk_workers=bulk_workers, bulk_max_pending=bulk_max_pending)
+
+
+def test_hash_and_check_inline(config):
+    passwords.configure(workers=0, method=CHEAP)
+    pw_hash = passwords.hash_password('password12')
+    assert pw_hash.startswith(CHEAP + '$')
+    assert passwords.check_password(pw_hash, 'password12') == (True, None)
+    assert passwords.check_password(pw_hash, 'wrong') == (False, None)
+    assert passwords.check_password(None, 'password12') == (False, None)
+
+
+def test_check_rehashes_old_parameters(config):
+    passwords.configure(workers=0, method=CHEAPER)
+    old_hash = passwords.hash_password('password12')
+    passwords.configure(method=CHEAP)
+    assert passwords.needs_rehash(old_hash)
+    matches, new_hash = passwords.check_password(old_hash, 'password12')
+    assert matches
+    assert not passwords.needs_rehash(new_hash)
+    assert passwords.check_password(new_hash, 'password12') == (True, None)
+    # A wrong password is never rehashed.
+    assert passwords.check_password(old_hash, 'wrong') == (False, None)
+
+
+def test_default_parameters_are_not_rehashed(config):
+    passwords.configure(workers=0, method='pbkdf2:sha256')
+    pw_hash = passwords.hash_password('password12')
+    assert not passwords.needs_rehash(pw_hash)
+    assert passwords.check_password(pw_hash, 'password12') == (True, None)
+    assert not passwords.needs_rehash(pw_hash, f'pbkdf2:sha256:{passwords.DEFAULT_PBKDF2_ITERATIONS}')
+    assert not passwords.needs_rehash('scrypt:32768:8:1$salt$hash', 'scrypt')
+    assert passwords.needs_rehash('scrypt:16384:8:1$salt$hash', 'scrypt')
+    assert passwords.needs_rehash('pbkdf2:sha256:junk$salt$hash', 'pbkdf2')
+
+
+def test_pool(config):
+    passwords.configure(workers=2, max_pending=4, method=CHEAP)
+    pw_hash = passwords.hash_password('password12')
+    assert passwords.check_password(pw_hash, 'password12') == (True, None)
+    hashes = passwords.hash_passwords(['a', 'b', 'c'])
+    assert [passwords.check_password(pw_hash, pw)[0]
+            for pw_hash, pw in zip(hashes, ['a', 'b', 'c'])] == [True] * 3
+    assert passwords.hash_passwords([]) == []
+
+
+def test_busy_pool(config):
+    passwords.configure(workers=1, max_pending=1, method=CHEAP)
+    passwords.WAIT_SECS = 0.01
+    assert passwords.pending.acquire()  # someone else is hashing
+    try:
+        with pytest.raises(passwords.HashPoolBusy):
+            passwords.hash_password('password12')
+    finally:
+        passwords.pending.release()
+
+
+def test_bulk_imports_do_not_hold_up_logins(config):
+    passwords.configure(workers=1, max_pending=1, method=CHEAP, bulk_max_pending=1)
+    passwords.WAIT_SECS = 0.01
+    assert passwords.bulk_pending.acquire()  # an import is hashing
+    try:
+        with pytest.raises(passwords.HashPoolBusy):
+            passwords.hash_passwords(['password12'])
+        pw_hash = passwords.hash_password('password12')
+        assert passwords.check_password(pw_hash, 'password12') == (True, None)
+    finally:
+        passwords.bulk_pending.release()
+    assert passwords.bulk_pool is None  # logins have a pool of their own
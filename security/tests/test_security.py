@@ -1,4 +1,7 @@
+from unittest.mock import MagicMock, patch
+
 import pytest
+import data.db_connect as dbc
 import security.security as sec
 from data.roles import Role
 
@@ -9,6 +12,7 @@ REFEREE_ROLE = [Role.REFEREE.value]
 NON_EXISTENT_ROLE = ["non_existent_role"]
 CONSULTING_EDITOR_ROLE = [Role.CONSULTING_EDITOR.value]
 MANAGING_EDITOR_ROLE = [Role.MANAGING_EDITOR.value]
+GOOD_EMAIL = 'someone@nyu.edu'
 
 def test_check_login_good():
     assert sec.check_login(EDITOR_ROLE, login_key='any key will do for now')
@@ -108,3 +112,118 @@ def test_editor_permissions():
                            login_key='any key for now')
     assert sec.is_permitted(sec.TEXTS, sec.DELETE, EDITOR_ROLE,
                            login_key='any key for now')
+
+
+def test_compile_recs():
+    compiled = sec.compile_recs(sec.TEST_RECS)
+    mask, checks, bad_check = compiled[(sec.PEOPLE, sec.DELETE)]
+    assert mask & sec.role_mask(EDITOR_ROLE)
+    assert not mask & sec.role_mask(AUTHOR_ROLE)
+    assert checks == (sec.check_login,)
+    assert bad_check is None
+
+
+def test_compile_recs_bad_check():
+    recs = {sec.BAD_FEATURE: {sec.CREATE: {sec.CHECKS: {'Bad check': True}}}}
+    mask, checks, bad_check = sec.compile_recs(recs)[(sec.BAD_FEATURE, sec.CREATE)]
+    assert mask is None
+    assert checks == ()
+    assert bad_check == 'Bad check'
+
+
+def test_is_permitted_raises_on_bad_check():
+    sec.read()
+    sec.security_recs = {**sec.security_recs,
+                         sec.BAD_FEATURE: {sec.CREATE: {sec.CHECKS: {'Bad check': True}}}}
+    try:
+        with pytest.raises(ValueError):
+            sec.is_permitted(sec.BAD_FEATURE, sec.CREATE, EDITOR_ROLE)
+    finally:
+        sec.security_recs = None
+
+
+def test_is_permitted_sees_new_recs():
+    sec.read()
+    sec.security_recs = {sec.PEOPLE: {sec.DELETE: {sec.ROLE_LIST: [Role.AUTHOR.value],
+                                                   sec.CHECKS: {}}}}
+    try:
+        assert sec.is_permitted(sec.PEOPLE, sec.DELETE, AUTHOR_ROLE)
+        assert not sec.is_permitted(sec.PEOPLE, sec.DELETE, EDITOR_ROLE)
+    finally:
+        sec.security_recs = None
+
+
+def test_read_without_db_uses_test_recs():
+    assert sec.read() is sec.TEST_RECS
+    assert sec.loaded_version is None
+    assert not sec.refresh()
+
+
+STORED_RECS = {sec.PEOPLE: {sec.DELETE: {sec.ROLE_LIST: [Role.AUTHOR.value], sec.CHECKS: {}}}}
+
+
+@patch('security.security.start_refresher', autospec=True)
+@patch('data.db_connect.read', autospec=True,
+       return_value=[{sec.FEATURE: sec.PEOPLE, sec.ACTIONS: STORED_RECS[sec.PEOPLE]}])
+@patch('data.db_connect.fetch_one', autospec=True, return_value={sec.VERSION: 3})
+@patch('data.db_connect.client', new=object())
+def test_read_from_db(mock_fetch_one, mock_read, mock_start):
+    try:
+        assert sec.read() == STORED_RECS
+        assert sec.loaded_version == 3
+        mock_start.assert_called_once()
+        assert sec.is_permitted(sec.PEOPLE, sec.DELETE, AUTHOR_ROLE)
+        assert not sec.is_permitted(sec.PEOPLE, sec.DELETE, EDITOR_ROLE)
+        # Nothing changed: one version read, no reload.
+        assert not sec.refresh()
+        assert mock_read.call_count == 1
+        mock_fetch_one.return_value = {sec.VERSION: 4}
+        assert sec.refresh()
+        assert mock_read.call_count == 2
+        assert sec.loaded_version == 4
+    finally:
+        sec.security_recs = None
+
+
+def test_version_poll_is_quiet(capsys):
+    client = MagicMock()
+    collection = client[dbc.WEMA_DB][sec.COLLECT_NAME]
+    collection.find_one.return_value = {sec.VERSION: 7}
+    with patch.object(dbc, 'client', client):
+        assert sec.read_version() == 7
+    collection.find_one.assert_called_once_with(sec.VERSION_FILTER,
+                                                {dbc.MONGO_ID: 0, sec.VERSION: 1})
+    assert capsys.readouterr().out == ''
+
+
+@patch('security.security.start_refresher', autospec=True)
+@patch('data.db_connect.create_index', autospec=True)
+@patch('data.db_connect.read', autospec=True, return_value=[])
+@patch('data.db_connect.bulk_upsert', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value={sec.VERSION: 1})
+@patch('data.db_connect.fetch_one', autospec=True, return_value=None)
+@patch('data.db_connect.client', new=object())
+def test_read_seeds_empty_db(mock_fetch_one, mock_bump, mock_upsert, mock_read,
+                             mock_index, mock_start):
+    try:
+        sec.read()
+        stored = mock_upsert.call_args.args[1]
+        assert {doc[sec.FEATURE] for doc in stored} == set(sec.TEST_RECS)
+        assert sec.loaded_version == 1
+    finally:
+        sec.security_recs = None
+
+
+@patch('data.db_connect.bulk_upsert', autospec=True)
+@patch('data.db_connect.fetch_one_and_update', autospec=True, return_value={sec.VERSION: 2})
+def test_add_user_permission_is_saved(mock_bump, mock_upsert):
+    sec.security_recs = {sec.PEOPLE: {}}
+    try:
+        with patch('data.db_connect.client', new=object()):
+            sec.add_user_permission(sec.PEOPLE, sec.CREATE, GOOD_EMAIL)
+        stored = mock_upsert.call_args.args[1]
+        assert stored[0][sec.FEATURE] == sec.PEOPLE
+        assert GOOD_EMAIL in stored[0][sec.ACTIONS][sec.CREATE][sec.USER_LIST]
+        mock_bump.assert_called_once()
+    finally:
+        sec.security_recs = None
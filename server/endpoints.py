@@ -3,25 +3,28 @@ This is the file containing all the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
 
+import json
 import subprocess
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from http import HTTPStatus
+from urllib.parse import quote
 
 import jwt
 import werkzeug.exceptions as wz
-from flask import Flask, request  # , reques
+from flask import Flask, Response, g, request, stream_with_context
 from flask_cors import CORS
 from flask_restx import Resource, Api, fields  # Namespace, fields
-from werkzeug.security import check_password_hash
+import security.audit as audit
+import security.passwords as passwords
 import security.security as sec
 
+import data.db_connect as dbc
 import data.roles as rls
 import data.text as text
 import data.users as users
 from data.manuscripts import fields as manuscript_fields
 from data.manuscripts import query as manuscript_query
-from data.manuscripts import role_permissions as role_perms
-from data.manuscripts.query import update_manuscript, STATE_TABLE
+from data.manuscripts.query import STATE_TABLE
 # from data.manuscripts.role_permissions import can_perform_action, ROLE_PERMISSIONS
 from data.text import read_texts, read_one, create, update, delete, KEY, TITLE, TEXT
 from data.users import get_user, NAME, EMAIL, AFFILIATION, ROLE, ROLES, PASSWORD
@@ -51,6 +54,39 @@ USERS = users.get_users_as_dict()
 TEXT_EP = "/text"
 MANUSCRIPTS_EP = "/manuscripts"
 ROLES_EP = '/roles'
+AUDIT_EP = '/audit'
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BATCH_SIZE = 'batch_size'
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000
+SUMMARY = 'summary'
+LIMIT = 'limit'
+NEXT = 'next'
+ITEMS = 'items'
+SORT = 'sort'
+ORDER = 'order'
+DESC = 'desc'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+BULK = 'bulk'
+ORDERED = 'ordered'
+UPSERT = 'upsert'
+TRUE_VALUES = ('1', 'true', 'yes')
+FILENAME = 'filename'
+QUERY = 'q'
+SINCE = 'since'
+AFTER_EVENT = 'after_event'
+STATS = 'stats'
+EVENTS = 'events'
+HISTORY = 'history'
+ACTOR = 'actor'
+UNTIL = 'until'
+SEARCH = 'search'
+FILE_CHUNK_SIZE = 64 * 1024
+USER = 'user'
+# Requests made with these methods are written to the audit log.
+AUDITED_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
 
 USER_CREATE_FIELDS = api.model(
     'AddNewUserEntry',
@@ -125,6 +161,243 @@ MANUSCRIPT_UPDATE_FIELDS = api.model(
 )
 
 
+def wants_stream() -> bool:
+    """
+    True if the client asked for a newline-delimited JSON stream
+    (`Accept: application/x-ndjson`) instead of one JSON document.
+    """
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def get_batch_size() -> int:
+    """
+    Read the `batch_size` query parameter, clamped to a sane range.
+    """
+    batch_size = request.args.get(BATCH_SIZE, DEFAULT_BATCH_SIZE, type=int)
+    return max(1, min(batch_size, MAX_BATCH_SIZE))
+
+
+def get_flag(name: str) -> bool:
+    """
+    Read a boolean query parameter such as `?summary=true`.
+    """
+    return request.args.get(name, '').lower() in TRUE_VALUES
+
+
+def wants_page() -> bool:
+    """
+    True if the client asked for a single page (`?limit=` and/or `?next=`).
+    """
+    return LIMIT in request.args or NEXT in request.args
+
+
+def get_page_args() -> tuple:
+    """
+    Read the `limit` (clamped) and `next` token query parameters.
+    """
+    limit = request.args.get(LIMIT, DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE)), request.args.get(NEXT)
+
+
+def page_response(items: list, next_token: str) -> dict:
+    """
+    The envelope for a page: pass `next` back to get the following page.
+    It is null on the last page.
+    """
+    return {ITEMS: items, NEXT: next_token}
+
+
+def ndjson_response(docs) -> Response:
+    """
+    Stream an iterable of JSON-able docs, one per line, so the whole
+    result set never has to be held in memory.
+    """
+    def generate():
+        for doc in docs:
+            yield json.dumps(doc) + '\n'
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def file_response(stream, info: dict, filename: str = None) -> Response:
+    """
+    Stream a seekable file in chunks. A single `Range: bytes=...` header
+    gets a 206 with just those bytes; only they are read from the stream.
+    """
+    length = info[dbc.LENGTH]
+    start, stop = 0, length
+    status = HTTPStatus.OK
+    headers = {'Accept-Ranges': 'bytes'}
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            stream.close()
+            raise wz.RequestedRangeNotSatisfiable(length=length)
+        start, stop = byte_range
+        status = HTTPStatus.PARTIAL_CONTENT
+        headers['Content-Range'] = request.range.to_content_range_header(length)
+    headers['Content-Length'] = str(stop - start)
+    if filename:
+        headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+
+    def generate():
+        try:
+            stream.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = stream.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            stream.close()
+    return Response(stream_with_context(generate()), status=status, headers=headers,
+                    content_type=info.get(dbc.CONTENT_TYPE) or 'application/octet-stream')
+
+
+def get_manuscript_filter() -> dict:
+    """
+    Read the manuscript filters: `?state=`, `?author=`, `?ref=`, and an
+    ISO `?since=` (inclusive) / `?until=` (exclusive) submission date range.
+    """
+    return manuscript_query.build_filter(
+        state=request.args.get(manuscript_fields.STATE),
+        author=request.args.get(manuscript_fields.AUTHOR),
+        ref=request.args.get(manuscript_fields.REFEREES),
+        since=request.args.get(SINCE),
+        until=request.args.get(UNTIL),
+    )
+
+
+@app.before_request
+def authenticate():
+    """
+    Decode the request's bearer token once, for every endpoint that needs
+    to know who is calling. g.claims holds its claims, or None with the
+    reason in g.auth_error. The user it names is only looked up when an
+    endpoint asks, through get_principal().
+    """
+    g.token = None
+    g.claims = None
+    g.auth_error = None
+    g.principal = None
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        g.auth_error = 'Missing or invalid token'
+        return
+    g.token = auth_header.split(' ')[1]
+    try:
+        g.claims = jwt.decode(g.token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        g.auth_error = 'Token expired'
+    except jwt.InvalidTokenError:
+        g.auth_error = 'Invalid token'
+
+
+def get_actor() -> str:
+    """
+    The email of the user making the request, from their bearer token,
+    or None if there isn't a valid one.
+    """
+    return g.claims.get('sub') if g.claims else None
+
+
+def get_principal() -> dict:
+    """
+    The email and roles of the user making the request, or None if they
+    have no valid token or no longer exist.
+    """
+    if g.principal is None and g.claims:
+        g.principal = users.get_principal(g.claims.get('sub'), g.claims.get('iat'))
+    return g.principal
+
+
+def require_principal() -> dict:
+    """
+    get_principal(), raising Unauthorized if there is no such user.
+    """
+    if not g.claims:
+        raise wz.Unauthorized(g.auth_error)
+    principal = get_principal()
+    if not principal:
+        raise wz.Unauthorized('User not found')
+    return principal
+
+
+def require_editor() -> dict:
+    """
+    require_principal(), raising Forbidden unless they are an editor.
+    """
+    principal = require_principal()
+    if not any(role in sec.EDITORS for role in principal[ROLES]):
+        raise wz.Forbidden('Editor role required')
+    return principal
+
+
+@api.errorhandler(passwords.HashPoolBusy)
+def password_pool_busy(error):
+    """
+    Too many passwords are being hashed already: ask the client to retry.
+    """
+    return {'message': str(error)}, HTTPStatus.SERVICE_UNAVAILABLE, {'Retry-After': '1'}
+
+
+@app.after_request
+def audit_request(response):
+    """
+    Queue an audit entry for each request that may change something.
+    This doesn't wait on the db; see security/audit.py.
+    """
+    if request.method in AUDITED_METHODS:
+        status = response.status_code
+        audit.log(get_actor(), request.path, request.method,
+                  allowed=status not in (HTTPStatus.UNAUTHORIZED, HTTPStatus.FORBIDDEN),
+                  status=status)
+    return response
+
+
+def get_roles_arg() -> list:
+    """
+    Read the roles asked for: `?role=a&role=b` or `?role=a,b`.
+    """
+    return [role for arg in request.args.getlist(ROLE)
+            for role in arg.split(',') if role]
+
+
+def get_bulk_args() -> tuple:
+    """
+    Read the body of a bulk import request: (items, ordered, upsert).
+    """
+    data = request.json or {}
+    items = data.get(ITEMS)
+    if not isinstance(items, list):
+        raise wz.BadRequest(f'`{ITEMS}` must be a list of records')
+    return items, bool(data.get(ORDERED, True)), bool(data.get(UPSERT, False))
+
+
+def bulk_response(result: dict) -> tuple:
+    """
+    201 if every record was written, otherwise 207 with per-record errors.
+    """
+    if result[dbc.ERRORS]:
+        return result, HTTPStatus.MULTI_STATUS
+    return result, HTTPStatus.CREATED
+
+
+BULK_FIELDS = api.model(
+    'BulkImport',
+    {
+        ITEMS: fields.List(fields.Raw, required=True, description="Records to write"),
+        ORDERED: fields.Boolean(
+            default=True, description="Stop at the first failing record"
+        ),
+        UPSERT: fields.Boolean(
+            default=False, description="Update existing records with the same key"
+        ),
+    },
+)
+
+
 @api.route(HELLO_EP)
 class HelloWorld(Resource):
     """
@@ -211,25 +484,38 @@ class Users(Resource):
         Retrieve journal users.
         - If ?email= is provided, returns that specific user.
         - If ?role= is provided (and email is not), returns users with that role.
+          Several roles (?role=a&role=b or ?role=a,b) return users with any of them.
         - If neither is provided, returns all users.
+        Pass `?limit=` (and then the returned `next` token as `?next=`)
+        to page through users.
+        Send `Accept: application/x-ndjson` to stream all users one per line.
         """
         email = request.args.get(EMAIL)
-        role = request.args.get(ROLE)
+        roles = get_roles_arg()
 
         if email:
-            users_list = users.get_users()
-            for user in users_list:
-                if user.email == email:
-                    return {email: user.to_dict()}
+            user = users.get_user(email)
+            if user:
+                return {email: user.to_dict()}
             return {"message": f"User {email} not found"}, HTTPStatus.NOT_FOUND
 
-        if role:
+        if roles:
             try:
-                matched = users.get_users_by_role(role)
+                matched = users.get_users_by_role(roles)
                 return {user.email: user.to_dict() for user in matched}
             except ValueError as e:
                 return {"message": str(e)}, HTTPStatus.BAD_REQUEST
 
+        if wants_page():
+            limit, after = get_page_args()
+            try:
+                return page_response(*users.get_users_page(limit, after))
+            except ValueError as e:
+                return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+        if wants_stream():
+            return ndjson_response(users.stream_users(get_batch_size()))
+
         return users.get_users_as_dict()
 
     @api.expect(USER_CREATE_FIELDS)
@@ -265,6 +551,48 @@ class Users(Resource):
             return {"message": str(e)}, HTTPStatus.BAD_REQUEST
 
 
+@api.route(f'{USERS_EP}/role_counts')
+class UserRoleCounts(Resource):
+    """
+    This class reports how many users hold each role.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.BAD_REQUEST, "Invalid role")
+    def get(self):
+        """
+        Count the users per role. Pass ?role= (repeated or comma-separated)
+        to count only some roles.
+        """
+        try:
+            return users.count_users_by_role(get_roles_arg())
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+
+@api.route(f'{USERS_EP}/{BULK}')
+class BulkUsers(Resource):
+    """
+    This class handles importing many users at once.
+    """
+
+    @api.expect(BULK_FIELDS)
+    @api.response(HTTPStatus.CREATED, "All users written")
+    @api.response(HTTPStatus.MULTI_STATUS, "Some users could not be written")
+    @api.response(HTTPStatus.BAD_REQUEST, "Invalid data provided")
+    @api.response(HTTPStatus.UNAUTHORIZED, "Not logged in")
+    @api.response(HTTPStatus.FORBIDDEN, "Editors only")
+    def post(self):
+        """
+        Create (or with `upsert`, create or update by email) many users.
+        Editors only. Upserts never change an existing user's password
+        or roles. Each error names the index of the failing record.
+        """
+        require_editor()
+        items, ordered, upsert = get_bulk_args()
+        return bulk_response(users.bulk_create_users(items, ordered=ordered, upsert=upsert))
+
+
 @api.route(f"{USERS_EP}/<_email>")
 class User(Resource):
     """
@@ -300,17 +628,9 @@ class User(Resource):
         """
         Delete a user by email
         """
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            raise wz.Unauthorized('Authorization required')
-        token = auth_header.split(' ')[1]
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        curr_user = users.get_user(payload['sub'])
-        if not curr_user:
-            raise wz.Unauthorized('User not found')
-        user_roles = curr_user.roles
-        kwargs = {sec.LOGIN_KEY: token}
-        if not sec.is_permitted(sec.PEOPLE, sec.DELETE, user_roles, **kwargs):
+        principal = require_principal()
+        kwargs = {sec.LOGIN_KEY: g.token}
+        if not sec.is_permitted(sec.PEOPLE, sec.DELETE, principal[ROLES], **kwargs):
             raise wz.Forbidden('You do not have permission to delete users. Editor role required.')
         ret = users.delete_user(_email)
         if ret is not None:
@@ -356,7 +676,18 @@ class Texts(Resource):
     def get(self):
         """
         Retrieve all texts.
+        Pass `?limit=` (and then the returned `next` token as `?next=`)
+        to page through them.
+        Send `Accept: application/x-ndjson` to stream them one per line.
         """
+        if wants_page():
+            limit, after = get_page_args()
+            try:
+                return page_response(*text.read_texts_page(limit, after)), HTTPStatus.OK
+            except ValueError as e:
+                return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        if wants_stream():
+            return ndjson_response(text.stream_texts(get_batch_size()))
         return read_texts(), HTTPStatus.OK
 
     @api.expect(TEXT_CREATE_FIELDS)
@@ -388,6 +719,28 @@ class Texts(Resource):
             }, HTTPStatus.INTERNAL_SERVER_ERROR
 
 
+@api.route(f'{TEXT_EP}/{BULK}')
+class BulkTexts(Resource):
+    """
+    This class handles importing many texts at once.
+    """
+
+    @api.expect(BULK_FIELDS)
+    @api.response(HTTPStatus.CREATED, "All texts written")
+    @api.response(HTTPStatus.MULTI_STATUS, "Some texts could not be written")
+    @api.response(HTTPStatus.BAD_REQUEST, "Invalid data provided")
+    @api.response(HTTPStatus.UNAUTHORIZED, "Not logged in")
+    @api.response(HTTPStatus.FORBIDDEN, "Editors only")
+    def post(self):
+        """
+        Create (or with `upsert`, create or update by key) many texts.
+        Editors only. Each error names the index of the failing record.
+        """
+        require_editor()
+        items, ordered, upsert = get_bulk_args()
+        return bulk_response(text.bulk_create(items, ordered=ordered, upsert=upsert))
+
+
 @api.route(f"{TEXT_EP}/<string:key>")
 class SingleText(Resource):
     """
@@ -449,8 +802,40 @@ class Manuscripts(Resource):
         """
         Retrieve the list of manuscripts.
         If a id query parameter is provided, return specific manuscript.
+        Send `Accept: application/x-ndjson` to stream them one per line.
+        Pass `?summary=true` to get only the title, author, state,
+        submission date and referees of each manuscript.
+        Filter with `?state=`, `?author=`, `?ref=` and a `?since=` /
+        `?until=` submission date range, and sort with
+        `?sort=submission_date` and `?order=desc`.
+        Pass `?limit=` (and then the returned `next` token as `?next=`)
+        to page through them.
         """
-        return manuscript_query.get_all_manuscripts()
+        summary = get_flag(SUMMARY)
+        sort_key = request.args.get(SORT)
+        descending = request.args.get(ORDER) == DESC
+        try:
+            filt = get_manuscript_filter()
+            if wants_page():
+                limit, after = get_page_args()
+                return page_response(*manuscript_query.get_manuscripts_page(
+                    limit,
+                    after,
+                    sort_key=sort_key,
+                    descending=descending,
+                    summary=summary,
+                    filt=filt,
+                ))
+            if wants_stream():
+                return ndjson_response(manuscript_query.stream_manuscripts(
+                    get_batch_size(), summary=summary, filt=filt,
+                    sort_key=sort_key, descending=descending,
+                ))
+            return manuscript_query.get_all_manuscripts(
+                summary=summary, filt=filt, sort_key=sort_key, descending=descending,
+            )
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
 
     @api.expect(MANUSCRIPT_CREATE_FIELDS)
     @api.response(HTTPStatus.CREATED, "Manuscript created successfully")
@@ -471,13 +856,13 @@ class Manuscripts(Resource):
             return {"message": "Missing required fields"}, HTTPStatus.BAD_REQUEST
 
         try:
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             new_manuscript = manuscript_query.create_manuscript(
                 title=data[manuscript_fields.TITLE],
                 author=data[manuscript_fields.AUTHOR],
                 abstract=data[manuscript_fields.ABSTRACT],
                 content=data[manuscript_fields.CONTENT],
-                submission_date=current_time,
+                submission_date=datetime.now(timezone.utc),
+                actor=get_actor(),
             )
             return {
                 "message": "Manuscript added successfully!",
@@ -488,6 +873,114 @@ class Manuscripts(Resource):
             return {"message": str(e)}, HTTPStatus.BAD_REQUEST
 
 
+@api.route(f'{MANUSCRIPTS_EP}/{BULK}')
+class BulkManuscripts(Resource):
+    """
+    This class handles importing many manuscripts at once.
+    """
+
+    @api.expect(BULK_FIELDS)
+    @api.response(HTTPStatus.CREATED, "All manuscripts written")
+    @api.response(HTTPStatus.MULTI_STATUS, "Some manuscripts could not be written")
+    @api.response(HTTPStatus.BAD_REQUEST, "Invalid data provided")
+    @api.response(HTTPStatus.UNAUTHORIZED, "Not logged in")
+    @api.response(HTTPStatus.FORBIDDEN, "Editors only")
+    def post(self):
+        """
+        Create many manuscripts. Editors only, since records may carry
+        their own submission date and state. Each error names the index of the failing record,
+        and `ids` lists the new manuscript ids in record order.
+        Manuscripts have no key to upsert on, so `upsert` is refused.
+        """
+        require_editor()
+        items, ordered, upsert = get_bulk_args()
+        if upsert:
+            raise wz.BadRequest(f'`{UPSERT}` is not supported for manuscripts')
+        return bulk_response(manuscript_query.bulk_create_manuscripts(items, ordered=ordered))
+
+
+@api.route(f'{MANUSCRIPTS_EP}/{SEARCH}')
+class ManuscriptSearch(Resource):
+    """
+    This class handles full-text search over manuscripts.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.BAD_REQUEST, "No query given")
+    def get(self):
+        """
+        Search manuscript titles, abstracts and contents: `?q=words`.
+        Returns up to `?limit=` summaries, best match first, each with
+        its `score`.
+        """
+        query = request.args.get(QUERY, '').strip()
+        if not query:
+            return {"message": f"`{QUERY}` is required"}, HTTPStatus.BAD_REQUEST
+        limit, _ = get_page_args()
+        return {ITEMS: manuscript_query.search_manuscripts(query, limit)}, HTTPStatus.OK
+
+
+@api.route(f'{MANUSCRIPTS_EP}/{STATS}')
+class ManuscriptStats(Resource):
+    """
+    This class reports per-state manuscript statistics.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    def get(self):
+        """
+        For each state: how many manuscripts are in it, how long they have
+        been there on average, and how many have left it and how long
+        they stayed on average (in seconds).
+        """
+        return manuscript_query.get_stats(), HTTPStatus.OK
+
+
+@api.route(f'{MANUSCRIPTS_EP}/{EVENTS}')
+class ManuscriptEvents(Resource):
+    """
+    This class serves the log of manuscript state changes.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.BAD_REQUEST, "Bad date, event id or page token")
+    def get(self):
+        """
+        Events of all manuscripts recorded at or after `?since=` (an ISO
+        date or date-time), oldest first, a page (`?limit=`) at a time.
+        To keep in sync, pass back `next` until it is null, then ask
+        again with `?after_event=` set to the last event's `_id`. That
+        read starts a minute before that event, since events from other
+        servers can be inserted late, so it repeats some events: drop
+        the `_id`s you already have.
+        """
+        limit, after = get_page_args()
+        try:
+            return page_response(*manuscript_query.get_events(
+                request.args.get(SINCE), limit, after, request.args.get(AFTER_EVENT)))
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+
+@api.route(f"{MANUSCRIPTS_EP}/<string:manu_id>/{HISTORY}")
+class ManuscriptHistory(Resource):
+    """
+    This class serves one manuscript's state changes.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.BAD_REQUEST, "Bad id or page token")
+    def get(self, manu_id):
+        """
+        A manuscript's events, oldest first, a page (`?limit=`) at a time.
+        """
+        limit, after = get_page_args()
+        try:
+            return page_response(*manuscript_query.get_history(manu_id, limit, after))
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+
 @api.route(f"{MANUSCRIPTS_EP}/<string:manu_id>")
 class Manuscript(Resource):
     """
@@ -516,25 +1009,28 @@ class Manuscript(Resource):
         Update a manuscript. Only fields provided in the request are updated.
         """
         data = request.json
-        manuscript = manuscript_query.get_manuscript(manu_id)
-        if not manuscript:
+        updates = {
+            field: data[field]
+            for field in [
+                manuscript_fields.TITLE,
+                manuscript_fields.AUTHOR,
+                manuscript_fields.ABSTRACT,
+                manuscript_fields.CONTENT,
+                manuscript_fields.STATE,
+            ]
+            if field in data
+        }
+
+        try:
+            modified = manuscript_query.update_manuscript(manu_id, updates, actor=get_actor())
+            return {
+                "message": "Manuscript updated successfully",
+                "modified": modified,
+            }, HTTPStatus.OK
+        except manuscript_query.ManuscriptNotFound:
             return {
                 "message": f"Manuscript with id '{manu_id}' not found"
             }, HTTPStatus.NOT_FOUND
-
-        for field in [
-            manuscript_fields.TITLE,
-            manuscript_fields.AUTHOR,
-            manuscript_fields.ABSTRACT,
-            manuscript_fields.CONTENT,
-            manuscript_fields.STATE,
-        ]:
-            if field in data:
-                manuscript[field] = data[field]
-
-        try:
-            manuscript_query.update_manuscript(manu_id, manuscript)
-            return {"message": "Manuscript updated successfully"}, HTTPStatus.OK
         except ValueError as e:
             return {"message": str(e)}, HTTPStatus.BAD_REQUEST
 
@@ -552,6 +1048,122 @@ class Manuscript(Resource):
         return {"message": f"Manuscript '{manu_id}' not found"}, HTTPStatus.NOT_FOUND
 
 
+@api.route(f"{MANUSCRIPTS_EP}/<string:manu_id>/content")
+class ManuscriptContent(Resource):
+    """
+    This class streams a manuscript's body in and out of file storage.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.PARTIAL_CONTENT, "Part of the body, as asked for by Range")
+    @api.response(HTTPStatus.NOT_FOUND, "Manuscript not found")
+    def get(self, manu_id):
+        """
+        Download a manuscript's body. Supports `Range: bytes=start-end`.
+        """
+        try:
+            stream, info = manuscript_query.open_content(manu_id)
+        except (manuscript_query.ManuscriptNotFound,
+                manuscript_query.AttachmentNotFound) as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        return file_response(stream, info)
+
+    @api.response(HTTPStatus.OK, "Body stored")
+    @api.response(HTTPStatus.NOT_FOUND, "Manuscript not found")
+    def put(self, manu_id):
+        """
+        Upload a manuscript's body as the raw request body (any content
+        type). It is streamed into storage, never buffered whole.
+        """
+        try:
+            info = manuscript_query.put_content(manu_id, request.stream,
+                                                request.mimetype or None)
+        except manuscript_query.ManuscriptNotFound as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        return info, HTTPStatus.OK
+
+
+@api.route(f"{MANUSCRIPTS_EP}/<string:manu_id>/attachments")
+class ManuscriptAttachments(Resource):
+    """
+    This class lists and uploads a manuscript's attachments.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.NOT_FOUND, "Manuscript not found")
+    def get(self, manu_id):
+        """
+        List a manuscript's attachments.
+        """
+        try:
+            return manuscript_query.get_attachments(manu_id), HTTPStatus.OK
+        except manuscript_query.ManuscriptNotFound as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+    @api.response(HTTPStatus.CREATED, "Attachment stored")
+    @api.response(HTTPStatus.NOT_FOUND, "Manuscript not found")
+    @api.response(HTTPStatus.BAD_REQUEST, "No filename given")
+    def post(self, manu_id):
+        """
+        Upload an attachment (a PDF, a figure...) as the raw request body,
+        with its name in `?filename=`. It is streamed into storage.
+        """
+        filename = request.args.get(FILENAME)
+        if not filename:
+            return {"message": f"`{FILENAME}` is required"}, HTTPStatus.BAD_REQUEST
+        try:
+            info = manuscript_query.add_attachment(manu_id, request.stream, filename,
+                                                   request.mimetype or None)
+        except manuscript_query.ManuscriptNotFound as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        return info, HTTPStatus.CREATED
+
+
+@api.route(f"{MANUSCRIPTS_EP}/<string:manu_id>/attachments/<string:file_id>")
+class ManuscriptAttachment(Resource):
+    """
+    This class downloads and deletes a single attachment.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.PARTIAL_CONTENT, "Part of the file, as asked for by Range")
+    @api.response(HTTPStatus.NOT_FOUND, "Attachment not found")
+    def get(self, manu_id, file_id):
+        """
+        Download an attachment. Supports `Range: bytes=start-end`.
+        """
+        try:
+            stream, info = manuscript_query.open_attachment(manu_id, file_id)
+        except (manuscript_query.ManuscriptNotFound,
+                manuscript_query.AttachmentNotFound) as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        return file_response(stream, info, info.get(dbc.FILENAME))
+
+    @api.response(HTTPStatus.OK, "Attachment deleted")
+    @api.response(HTTPStatus.NOT_FOUND, "Attachment not found")
+    def delete(self, manu_id, file_id):
+        """
+        Remove an attachment from a manuscript.
+        """
+        try:
+            manuscript_query.delete_attachment(manu_id, file_id)
+        except manuscript_query.AttachmentNotFound as e:
+            return {"message": str(e)}, HTTPStatus.NOT_FOUND
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        return {"message": f"Attachment '{file_id}' deleted"}, HTTPStatus.OK
+
+
 # Finite State Machine
 MANU_ACTION_FLDS = api.model(
     'ManuscriptAction',
@@ -570,11 +1182,15 @@ class ReceiveAction(Resource):
     """
 
     @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Manuscript not found')
+    @api.response(HTTPStatus.CONFLICT, 'Manuscript is no longer in the given state')
     @api.response(HTTPStatus.NOT_ACCEPTABLE, 'Not acceptable')
     @api.expect(MANU_ACTION_FLDS)
     def put(self):
         """
         Receive an action for a manuscript.
+        The action only applies if the manuscript is still in the given
+        state; otherwise we answer 409 and nothing changes.
         """
         try:
             manu_id = request.json.get("_id")
@@ -588,24 +1204,110 @@ class ReceiveAction(Resource):
                     "_id",
                     manuscript_fields.STATE,
                     manuscript_fields.ACTION,
+                    ACTOR,
                 ]
             }
-            manu = manuscript_query.get_manuscript(manu_id)
-            if not manu:
-                return {
-                    "message": f"Manuscript with id '{manu_id}' not found"
-                }, HTTPStatus.NOT_FOUND
-
-            new_state = manuscript_query.handle_action(
-                curr_state, action, manu=manu, **kwargs
-            )
-
-            update_manuscript(manu_id, {manuscript_fields.STATE: new_state})
-
-            return {'message': 'Action processed successfully'}, HTTPStatus.OK
+            manu = manuscript_query.apply_action(manu_id, curr_state, action,
+                                                 actor=get_actor(), **kwargs)
+        except manuscript_query.ManuscriptNotFound:
+            return {
+                "message": f"Manuscript with id '{manu_id}' not found"
+            }, HTTPStatus.NOT_FOUND
+        except manuscript_query.StateConflict as err:
+            return {'message': str(err)}, HTTPStatus.CONFLICT
         except Exception as err:
             raise wz.NotAcceptable(f'Bad action: {err=}')
 
+        return {
+            'message': 'Action processed successfully',
+            'manuscript': manu,
+        }, HTTPStatus.OK
+
+
+MANU_ACTIONS_FLDS = api.model(
+    'ManuscriptActions',
+    {
+        ITEMS: fields.List(fields.Nested(MANU_ACTION_FLDS), required=True,
+                           description="Actions to apply"),
+    },
+)
+
+
+@api.route(f'{MANUSCRIPTS_EP}/receive_actions')
+class ReceiveActions(Resource):
+    """
+    Receive actions for many manuscripts at once.
+    """
+
+    @api.response(HTTPStatus.OK, 'All actions applied')
+    @api.response(HTTPStatus.MULTI_STATUS, 'Some actions were not applied')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid data provided')
+    @api.response(HTTPStatus.UNAUTHORIZED, 'Unauthorized')
+    @api.expect(MANU_ACTIONS_FLDS)
+    def put(self):
+        """
+        Apply a list of actions, each like the body of receive_action.
+        Each is checked against the state table and the caller's roles,
+        and applies only if the manuscript is still in the given state.
+        Returns a result per item, in order: `applied` (with the new
+        state), `invalid`, `forbidden`, `not_found` or `conflict`.
+        """
+        principal = require_principal()
+        items = (request.json or {}).get(ITEMS)
+        if not isinstance(items, list):
+            raise wz.BadRequest(f'`{ITEMS}` must be a list of actions')
+        try:
+            results = manuscript_query.apply_actions(items, principal[ROLES],
+                                                     actor=principal[EMAIL])
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        applied = all(res[manuscript_query.RESULT] == manuscript_query.APPLIED
+                      for res in results)
+        return {ITEMS: results}, HTTPStatus.OK if applied else HTTPStatus.MULTI_STATUS
+
+
+@api.route(AUDIT_EP)
+class Audit(Resource):
+    """
+    This class serves the audit log.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.BAD_REQUEST, "Bad date or page token")
+    @api.response(HTTPStatus.UNAUTHORIZED, "Unauthorized")
+    @api.response(HTTPStatus.FORBIDDEN, "Editors only")
+    def get(self):
+        """
+        Audit entries, oldest first, a page (`?limit=`) at a time.
+        `?user=` keeps one user's entries, `?since=` (an ISO date or
+        date-time) those at or after it. Editors only.
+        """
+        require_editor()
+        limit, after = get_page_args()
+        try:
+            return page_response(*audit.read_page(
+                request.args.get(USER), request.args.get(SINCE), limit, after))
+        except ValueError as e:
+            return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+
+
+@api.route(f'{AUDIT_EP}/{STATS}')
+class AuditStats(Resource):
+    """
+    This class reports on the audit log writer.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.UNAUTHORIZED, "Unauthorized")
+    @api.response(HTTPStatus.FORBIDDEN, "Editors only")
+    def get(self):
+        """
+        How many audit entries are queued, written, dropped because the
+        queue was full, and lost to failed writes.
+        """
+        require_editor()
+        return audit.stats()
+
 
 @api.route(ROLES_EP)
 class Roles(Resource):
@@ -682,8 +1384,8 @@ class Login(Resource):
             return {"message": "Invalid email or password!"}, HTTPStatus.UNAUTHORIZED
 
         # Get the stored password hash from the auth collection
-        auth_record = user[users.PASSWORD]
-        if not auth_record or not check_password_hash(auth_record, data['password']):
+        auth_record = user.get(users.PASSWORD)
+        if not users.check_password(user[EMAIL], auth_record, data['password']):
             return {"message": "Invalid email or password!"}, HTTPStatus.UNAUTHORIZED
 
         # Generate JWT token
@@ -752,14 +1454,9 @@ class Register(Resource):
         if not users.is_valid_email(data[users.EMAIL]):
             return {"message": "Invalid email format"}, HTTPStatus.BAD_REQUEST
 
-        # Check if user already exists
-        existing_user = users.get_user(data[users.EMAIL])
-        if existing_user:
-            return {"message": "Email already exists"}, HTTPStatus.CONFLICT
-
         try:
-            # Create the user
-            users.create_user(
+            # Create the user; the unique email index rejects duplicates
+            new_user = users.create_user(
                 name=data[NAME],
                 email=data[EMAIL],
                 password=data[PASSWORD],
@@ -775,17 +1472,18 @@ class Register(Resource):
             }
             token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
-            # Get the created user
-            new_user = users.get_user(data[users.EMAIL])
-
             return {
                 "message": "User registered successfully",
                 "token": token,
-                "user": new_user.to_dict(),
+                "user": new_user,
             }, HTTPStatus.CREATED
 
+        except users.DuplicateUserError:
+            return {"message": "Email already exists"}, HTTPStatus.CONFLICT
         except ValueError as e:
             return {"message": str(e)}, HTTPStatus.BAD_REQUEST
+        except passwords.HashPoolBusy:
+            raise  # a 503 with Retry-After, not a server error
         except Exception as e:
             return {
                 "message": f"An error occurred: {str(e)}"
@@ -826,29 +1524,12 @@ class ManuscriptValidActions(Resource):
         if state not in STATE_TABLE:
             return {'message': f'Invalid state: {state}'}, HTTPStatus.NOT_ACCEPTABLE
 
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return {'message': 'Missing or invalid token'}, HTTPStatus.UNAUTHORIZED
+        principal = require_principal()
         try:
-            token = auth_header.split(' ')[1]
-            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-            user_email = payload['sub']
-            user = users.get_user(user_email)
-            if not user:
-                return {'message': 'User not found'}, HTTPStatus.UNAUTHORIZED
-            user_roles = user.roles if hasattr(user, 'roles') and user.roles else []
-            valid_actions = []
-            state_actions = STATE_TABLE[state].keys()
-            for action in state_actions:
-                if role_perms.can_perform_action(state, action, user_roles):
-                    valid_actions.append(action)
+            valid_actions = manuscript_query.get_valid_actions(state, principal[ROLES])
             return {
                 'state': state,
-                'valid_actions': valid_actions
+                'valid_actions': list(valid_actions)
             }, HTTPStatus.OK
-        except jwt.ExpiredSignatureError:
-            return {'message': 'Token expired'}, HTTPStatus.UNAUTHORIZED
-        except jwt.InvalidTokenError:
-            return {'message': 'Invalid token'}, HTTPStatus.UNAUTHORIZED
         except Exception as e:
             return {'message': f'Error: {str(e)}'}, HTTPStatus.INTERNAL_SERVER_ERROR
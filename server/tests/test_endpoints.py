@@ -1,8 +1,16 @@
+import io
+import json
 from http import HTTPStatus
 from unittest.mock import patch
 
 import pytest
+from bson import ObjectId
 
+import data.db_connect as dbc
+import data.manuscripts.fields as flds
+import data.manuscripts.query as mqry
+import data.users as users
+import security.passwords as passwords
 import server.endpoints as ep
 from data.users import User
 from datetime import datetime, timedelta
@@ -142,8 +150,8 @@ def test_read(mock_read):
         assert 'name' in user
 
 
-@patch('data.users.get_users', autospec=True, 
-       return_value=[User(email='anotherperson@nyu.edu', name='Another Person', roles=[], affiliation='NYU')])
+@patch('data.users.get_user', autospec=True,
+       return_value=User(email='anotherperson@nyu.edu', name='Another Person', roles=[], affiliation='NYU'))
 def test_get_user(mock_get_user):
     test_email = 'anotherperson@nyu.edu'
     resp = TEST_CLIENT.get(f"{ep.USERS_EP}?email={test_email}")
@@ -344,3 +352,463 @@ def test_update_non_existing_user():
     resp_json = resp.get_json()
     assert "message" in resp_json
     assert "not found" in resp_json["message"]
+
+
+@patch('data.users.stream_users', autospec=True,
+       return_value=iter([{'email': 'a@nyu.edu'}, {'email': 'b@nyu.edu'}]))
+def test_stream_users(mock_stream):
+    resp = TEST_CLIENT.get(ep.USERS_EP, headers={'Accept': ep.NDJSON_MIMETYPE})
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.mimetype == ep.NDJSON_MIMETYPE
+    lines = resp.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['email'] for line in lines] == ['a@nyu.edu', 'b@nyu.edu']
+    mock_stream.assert_called_once_with(ep.DEFAULT_BATCH_SIZE)
+
+
+@patch('data.manuscripts.query.stream_manuscripts', autospec=True,
+       return_value=iter([{'_id': '1', 'title': 'One'}]))
+def test_stream_manuscripts_batch_size(mock_stream):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}?{ep.BATCH_SIZE}=10',
+                           headers={'Accept': ep.NDJSON_MIMETYPE})
+    assert resp.status_code == HTTPStatus.OK
+    lines = resp.get_data(as_text=True).splitlines()
+    assert json.loads(lines[0])['title'] == 'One'
+    mock_stream.assert_called_once_with(10, summary=False, filt={},
+                                        sort_key=None, descending=False)
+
+
+@patch('data.text.stream_texts', autospec=True, return_value=iter([]))
+@patch('server.endpoints.read_texts', autospec=True, return_value=[])
+def test_texts_not_streamed_by_default(mock_read, mock_stream):
+    resp = TEST_CLIENT.get(ep.TEXT_EP)
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json() == []
+    mock_stream.assert_not_called()
+
+
+@patch('data.manuscripts.query.get_all_manuscripts', autospec=True,
+       return_value=[{'_id': '1', 'title': 'One'}])
+def test_get_manuscripts_summary(mock_get_all):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}?{ep.SUMMARY}=true')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json() == [{'_id': '1', 'title': 'One'}]
+    mock_get_all.assert_called_once_with(summary=True, filt={},
+                                         sort_key=None, descending=False)
+
+
+@patch('data.manuscripts.query.get_manuscripts_page', autospec=True,
+       return_value=([{'_id': '1', 'title': 'One'}], 'token'))
+def test_get_manuscripts_page(mock_page):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}?{ep.LIMIT}=1'
+                           f'&{ep.SORT}=submission_date&{ep.ORDER}={ep.DESC}')
+    assert resp.status_code == HTTPStatus.OK
+    resp_json = resp.get_json()
+    assert resp_json[ep.ITEMS] == [{'_id': '1', 'title': 'One'}]
+    assert resp_json[ep.NEXT] == 'token'
+    mock_page.assert_called_once_with(1, None, sort_key='submission_date',
+                                      descending=True, summary=False, filt={})
+
+
+@patch('data.users.get_users_page', autospec=True,
+       side_effect=ValueError('Invalid page token: junk'))
+def test_get_users_bad_page_token(mock_page):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}?{ep.NEXT}=junk')
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+    mock_page.assert_called_once_with(ep.DEFAULT_PAGE_SIZE, 'junk')
+
+
+@pytest.fixture
+def editor_headers():
+    """Headers of a logged-in editor, whose user record is mocked."""
+    users.principal_cache.clear()
+    with patch('data.users.get_user', autospec=True,
+               return_value=User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor'])):
+        token = jwt.encode({'sub': 'ed@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+        yield {'Authorization': f'Bearer {token}'}
+    users.principal_cache.clear()
+
+
+@patch('data.text.bulk_create', autospec=True,
+       return_value={'inserted': 1, 'errors': [{'index': 1, 'code': None, 'message': 'bad'}]})
+def test_bulk_texts_partial_failure(mock_bulk, editor_headers):
+    items = [{'key': 'a', 'title': 'A', 'text': 'a'}, {'key': 'b'}]
+    resp = TEST_CLIENT.post(f'{ep.TEXT_EP}/{ep.BULK}', json={ep.ITEMS: items, ep.ORDERED: False},
+                            headers=editor_headers)
+    assert resp.status_code == HTTPStatus.MULTI_STATUS
+    assert resp.get_json()['errors'][0]['index'] == 1
+    mock_bulk.assert_called_once_with(items, ordered=False, upsert=False)
+
+
+@patch('data.manuscripts.query.bulk_create_manuscripts', autospec=True)
+def test_bulk_manuscripts_refuses_upsert(mock_bulk, editor_headers):
+    resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/{ep.BULK}', json={ep.ITEMS: [], ep.UPSERT: True},
+                            headers=editor_headers)
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+    mock_bulk.assert_not_called()
+
+
+def test_bulk_requires_item_list(editor_headers):
+    resp = TEST_CLIENT.post(f'{ep.TEXT_EP}/{ep.BULK}', json={ep.ITEMS: 'nope'},
+                            headers=editor_headers)
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.parametrize('endpoint', [ep.TEXT_EP, ep.MANUSCRIPTS_EP])
+@patch('data.manuscripts.query.bulk_create_manuscripts', autospec=True)
+@patch('data.text.bulk_create', autospec=True)
+def test_bulk_imports_need_token(mock_texts, mock_manus, endpoint):
+    resp = TEST_CLIENT.post(f'{endpoint}/{ep.BULK}', json={ep.ITEMS: []})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+    mock_texts.assert_not_called()
+    mock_manus.assert_not_called()
+
+
+@patch('data.users.get_users_by_role', autospec=True,
+       return_value=[User(email='ref@nyu.edu', name='Ref', roles=['referee'], affiliation='NYU')])
+def test_get_users_by_several_roles(mock_by_role):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}?role=referee,editor&role=author')
+    assert resp.status_code == HTTPStatus.OK
+    assert 'ref@nyu.edu' in resp.get_json()
+    mock_by_role.assert_called_once_with(['referee', 'editor', 'author'])
+
+
+@patch('data.users.count_users_by_role', autospec=True, return_value={'referee': 3})
+def test_user_role_counts(mock_counts):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}/role_counts?role=referee')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json() == {'referee': 3}
+    mock_counts.assert_called_once_with(['referee'])
+
+
+@patch('data.manuscripts.query.apply_action', autospec=True,
+       side_effect=mqry.StateConflict('Manuscript is in state REJ, not SUB'))
+def test_receive_action_conflict(mock_apply):
+    resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_action',
+                           json={'_id': 'some id', 'state': 'SUB', 'action': 'REJ'})
+    assert resp.status_code == HTTPStatus.CONFLICT
+    mock_apply.assert_called_once_with('some id', 'SUB', 'REJ', actor=None)
+
+
+@patch('data.manuscripts.query.apply_action', autospec=True,
+       return_value={'_id': 'some id', 'state': 'REV', 'ref': ['a referee']})
+def test_receive_action(mock_apply):
+    resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_action',
+                           json={'_id': 'some id', 'state': 'SUB', 'action': 'ARF', 'ref': 'a referee'})
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()['manuscript']['state'] == 'REV'
+    mock_apply.assert_called_once_with('some id', 'SUB', 'ARF', actor=None, ref='a referee')
+
+
+@patch('data.manuscripts.query.get_manuscript', autospec=True)
+@patch('data.manuscripts.query.update_manuscript', autospec=True, return_value=True)
+def test_patch_manuscript_sends_only_given_fields(mock_update, mock_get):
+    resp = TEST_CLIENT.patch(f'{ep.MANUSCRIPTS_EP}/some_id', json={'title': 'New', 'junk': 1})
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()['modified']
+    mock_update.assert_called_once_with('some_id', {'title': 'New'}, actor=None)
+    mock_get.assert_not_called()
+
+
+def content_stream(data=b'0123456789'):
+    return io.BytesIO(data), {'length': len(data), 'content_type': 'text/plain'}
+
+
+@patch('data.manuscripts.query.open_content', autospec=True)
+def test_get_content(mock_open):
+    mock_open.return_value = content_stream()
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/some_id/content')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.data == b'0123456789'
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+
+
+@patch('data.manuscripts.query.open_content', autospec=True)
+def test_get_content_range(mock_open):
+    mock_open.return_value = content_stream()
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/some_id/content',
+                           headers={'Range': 'bytes=2-5'})
+    assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert resp.data == b'2345'
+    assert resp.headers['Content-Range'] == 'bytes 2-5/10'
+
+
+@patch('data.manuscripts.query.open_content', autospec=True)
+def test_get_content_bad_range(mock_open):
+    mock_open.return_value = content_stream()
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/some_id/content',
+                           headers={'Range': 'bytes=20-30'})
+    assert resp.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
+@patch('data.manuscripts.query.open_content', autospec=True,
+       side_effect=mqry.ManuscriptNotFound('not found'))
+def test_get_content_not_found(mock_open):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/some_id/content')
+    assert resp.status_code == HTTPStatus.NOT_FOUND
+
+
+@patch('data.manuscripts.query.add_attachment', autospec=True,
+       return_value={'file_id': 'f1', 'filename': 'fig.png'})
+def test_post_attachment(mock_add):
+    resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/some_id/attachments?filename=fig.png',
+                            data=b'png bytes', content_type='image/png')
+    assert resp.status_code == HTTPStatus.CREATED
+    assert mock_add.call_args.args[2:] == ('fig.png', 'image/png')
+
+
+def test_post_attachment_needs_filename():
+    resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/some_id/attachments', data=b'x')
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
+@patch('data.manuscripts.query.search_manuscripts', autospec=True,
+       return_value=[{'_id': 'some id', 'title': 'Graphs', 'score': 1.5}])
+def test_search_manuscripts(mock_search):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/{ep.SEARCH}?q=graphs&limit=5')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()[ep.ITEMS][0]['score'] == 1.5
+    mock_search.assert_called_once_with('graphs', 5)
+
+
+def test_search_manuscripts_needs_query():
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/{ep.SEARCH}')
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
+@patch('data.manuscripts.query.get_manuscripts_page', autospec=True,
+       return_value=([], None))
+def test_get_manuscripts_filtered(mock_page):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}?{ep.LIMIT}=5&state=REV&ref=x@nyu.edu'
+                           f'&{ep.SINCE}=2024-01-01&{ep.SORT}=submission_date')
+    assert resp.status_code == HTTPStatus.OK
+    assert mock_page.call_args.kwargs['filt'] == {
+        'state': 'REV',
+        'ref': 'x@nyu.edu',
+        'submission_date': {'$gte': datetime(2024, 1, 1)},
+    }
+
+
+@patch('data.manuscripts.query.get_all_manuscripts', autospec=True)
+def test_get_manuscripts_bad_filter(mock_get_all):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}?state=NOPE')
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+    mock_get_all.assert_not_called()
+
+
+@patch('data.manuscripts.query.get_stats', autospec=True,
+       return_value={'SUB': {'count': 2, 'avg_seconds_in_state': 60.0,
+                             'exits': 0, 'avg_seconds_per_exit': None}})
+def test_get_manuscript_stats(mock_stats):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/{ep.STATS}')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()['SUB']['count'] == 2
+
+
+@patch('data.manuscripts.query.apply_action', autospec=True,
+       return_value={'_id': 'some id', 'state': 'REJ'})
+def test_receive_action_actor_comes_from_token(mock_apply):
+    token = jwt.encode({'sub': 'editor@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_action',
+                           headers={'Authorization': f'Bearer {token}'},
+                           json={'_id': 'some id', 'state': 'SUB', 'action': 'REJ',
+                                 'actor': 'someone else'})
+    assert resp.status_code == HTTPStatus.OK
+    mock_apply.assert_called_once_with('some id', 'SUB', 'REJ', actor='editor@nyu.edu')
+
+
+@patch('data.manuscripts.query.get_events', autospec=True,
+       return_value=([{'manu_id': 'some id', 'at': '2024-01-01T00:00:00+00:00'}], None))
+def test_get_manuscript_events(mock_events):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/{ep.EVENTS}?{ep.SINCE}=2024-01-01')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()[ep.NEXT] is None
+    mock_events.assert_called_once_with('2024-01-01', ep.DEFAULT_PAGE_SIZE, None, None)
+
+
+@patch('data.manuscripts.query.get_history', autospec=True,
+       side_effect=ValueError('Invalid MongoDB ObjectId: junk'))
+def test_get_manuscript_history_bad_id(mock_history):
+    resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/junk/{ep.HISTORY}')
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_receive_actions_needs_token():
+    resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_actions', json={ep.ITEMS: []})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+
+
+@patch('data.manuscripts.query.apply_actions', autospec=True,
+       return_value=[{'index': 0, '_id': 'a', 'result': 'applied', 'state': 'REJ'},
+                     {'index': 1, '_id': 'b', 'result': 'conflict', 'message': 'no'}])
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_receive_actions(mock_user, mock_apply):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'ed@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    items = [{'_id': 'a', 'state': 'SUB', 'action': 'REJ'},
+             {'_id': 'b', 'state': 'SUB', 'action': 'REJ'}]
+    resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_actions', json={ep.ITEMS: items},
+                           headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.MULTI_STATUS
+    assert len(resp.get_json()[ep.ITEMS]) == 2
+    mock_apply.assert_called_once_with(items, ['editor'], actor='ed@nyu.edu')
+
+
+def apply_sets(doc: dict, update: list):
+    """
+    Apply the literal $set values of an update pipeline to doc, and the
+    batch action's note of its token.
+    """
+    for stage in update:
+        for fld, value in stage.get('$set', {}).items():
+            if fld == flds.RECENT_ACTIONS:
+                [entry] = value['$slice'][0]['$concatArrays'][1]
+                doc[fld] = [{mqry.ACTION_TOKEN: entry[mqry.ACTION_TOKEN], 'state': doc['state']}]
+            elif not isinstance(value, dict) and not (isinstance(value, str) and value.startswith('$')):
+                doc[fld] = value
+
+
+@patch('data.manuscripts.events.record', autospec=True)
+@patch('data.manuscripts.stats.apply', autospec=True)
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_read_manuscript_after_receive_actions(mock_user, mock_stats, mock_events):
+    users.principal_cache.clear()
+    manu_id = str(ObjectId())
+    stored = {'_id': manu_id, 'title': 'a title', 'author': 'Al',
+              'state': mqry.SUBMITTED, 'submission_date': datetime(2024, 1, 1)}
+
+    def bulk_write(collection, ops, **kwargs):
+        for op in ops:
+            apply_sets(stored, op._doc)
+        return {dbc.ERRORS: []}
+    token = jwt.encode({'sub': 'ed@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    with patch('data.db_connect.bulk_write', autospec=True, side_effect=bulk_write), \
+            patch('data.db_connect.read', autospec=True, side_effect=lambda *a, **kw: [dict(stored)]):
+        resp = TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_actions',
+                               json={ep.ITEMS: [{'_id': manu_id, 'state': mqry.SUBMITTED,
+                                                 'action': mqry.REJECT}]},
+                               headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.OK
+    with patch('data.db_connect.fetch_one', autospec=True, return_value=dict(stored)):
+        resp = TEST_CLIENT.get(f'{ep.MANUSCRIPTS_EP}/{manu_id}')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.get_json()['state'] == mqry.REJECTED
+    assert flds.RECENT_ACTIONS not in resp.get_json()
+    with patch('data.db_connect.read_iter', autospec=True, return_value=iter([dict(stored)])):
+        resp = TEST_CLIENT.get(ep.MANUSCRIPTS_EP, headers={'Accept': ep.NDJSON_MIMETYPE})
+        lines = resp.get_data(as_text=True).splitlines()
+    assert json.loads(lines[0])['state'] == mqry.REJECTED
+    users.principal_cache.clear()
+
+
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Al', 'al@nyu.edu', 'NYU', roles=['author']))
+def test_valid_actions_uses_token_roles(mock_user):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'al@nyu.edu', 'iat': 1}, ep.SECRET_KEY, algorithm='HS256')
+    headers = {'Authorization': f'Bearer {token}'}
+    for _ in range(2):
+        resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/valid_actions',
+                                json={'state': mqry.SUBMITTED}, headers=headers)
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.get_json()['valid_actions'] == [mqry.WITHDRAW]
+    mock_user.assert_called_once_with('al@nyu.edu', cached=False)  # the principal is cached
+    users.principal_cache.clear()
+
+
+def test_valid_actions_needs_token():
+    resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/valid_actions', json={'state': mqry.SUBMITTED})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+    assert resp.get_json()['message'] == 'Missing or invalid token'
+
+
+def test_valid_actions_bad_token():
+    resp = TEST_CLIENT.post(f'{ep.MANUSCRIPTS_EP}/valid_actions', json={'state': mqry.SUBMITTED},
+                            headers={'Authorization': 'Bearer junk'})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+    assert resp.get_json()['message'] == 'Invalid token'
+
+
+@patch('data.users.get_user', autospec=True, return_value=None)
+def test_delete_user_unknown_principal(mock_user):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'gone@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    resp = TEST_CLIENT.delete(f'{ep.USERS_EP}/someone@nyu.edu',
+                              headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_bulk_users_needs_token():
+    resp = TEST_CLIENT.post(f'{ep.USERS_EP}/{ep.BULK}', json={ep.ITEMS: [], ep.UPSERT: True})
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+
+
+@patch('data.users.bulk_create_users', autospec=True)
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Al', 'al@nyu.edu', 'NYU', roles=['author']))
+def test_bulk_users_is_for_editors(mock_user, mock_bulk):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'al@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    resp = TEST_CLIENT.post(f'{ep.USERS_EP}/{ep.BULK}', json={ep.ITEMS: [], ep.UPSERT: True},
+                            headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.FORBIDDEN
+    mock_bulk.assert_not_called()
+    users.principal_cache.clear()
+
+
+def test_audit_needs_token():
+    resp = TEST_CLIENT.get(ep.AUDIT_EP)
+    assert resp.status_code == HTTPStatus.UNAUTHORIZED
+
+
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Al', 'al@nyu.edu', 'NYU', roles=['author']))
+def test_audit_is_for_editors(mock_user):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'al@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    resp = TEST_CLIENT.get(ep.AUDIT_EP, headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.FORBIDDEN
+    users.principal_cache.clear()
+
+
+@patch('security.audit.read_page', autospec=True,
+       return_value=([{'user': 'al@nyu.edu', 'at': '2024-01-01T00:00:00+00:00'}], None))
+@patch('data.users.get_user', autospec=True,
+       return_value=User('Ed', 'ed@nyu.edu', 'NYU', roles=['editor']))
+def test_get_audit(mock_user, mock_read):
+    users.principal_cache.clear()
+    token = jwt.encode({'sub': 'ed@nyu.edu'}, ep.SECRET_KEY, algorithm='HS256')
+    resp = TEST_CLIENT.get(f'{ep.AUDIT_EP}?{ep.USER}=al@nyu.edu&{ep.SINCE}=2024-01-01',
+                           headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == HTTPStatus.OK
+    assert len(resp.get_json()[ep.ITEMS]) == 1
+    mock_read.assert_called_once_with('al@nyu.edu', '2024-01-01', ep.DEFAULT_PAGE_SIZE, None)
+    users.principal_cache.clear()
+
+
+@patch('security.audit.log', autospec=True, return_value=True)
+def test_writes_are_audited(mock_log):
+    TEST_CLIENT.put(f'{ep.MANUSCRIPTS_EP}/receive_actions', json={ep.ITEMS: []})
+    mock_log.assert_called_once_with(None, f'{ep.MANUSCRIPTS_EP}/receive_actions', 'PUT',
+                                     allowed=False, status=HTTPStatus.UNAUTHORIZED)
+    TEST_CLIENT.get(ep.ROLES_EP)
+    assert mock_log.call_count == 1  # reads aren't
+
+
+@patch('security.passwords.check_password', autospec=True,
+       side_effect=passwords.HashPoolBusy('busy'))
+@patch('data.users.get_user_raw', autospec=True,
+       return_value={'email': 'ed@nyu.edu', 'password': 'some hash'})
+def test_login_when_hashing_is_busy(mock_user, mock_check):
+    resp = TEST_CLIENT.post('/login', json={'email': 'ed@nyu.edu', 'password': 'password12'})
+    assert resp.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert resp.headers['Retry-After'] == '1'
+
+
+@patch('data.users.create_user', autospec=True, side_effect=passwords.HashPoolBusy('busy'))
+def test_register_when_hashing_is_busy(mock_create):
+    resp = TEST_CLIENT.post('/register', json={'name': 'Al', 'email': 'al@nyu.edu',
+                                               'affiliation': 'NYU', 'password': 'password12'})
+    assert resp.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert resp.headers['Retry-After'] == '1'